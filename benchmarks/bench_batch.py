@@ -0,0 +1,114 @@
+"""Small-file throughput of one request per file against the batch API:
+stat and read of 1KiB files, one by one then with stat_many and
+open_many.
+
+usage: python bench_batch.py [files]
+
+The file server and a name server answering for it run in their own
+process.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'servers'))
+sys.path.insert(0, os.path.join(HERE, '..', 'clients'))
+
+PORT = 8797
+NAME_PORT = 8798
+SIZE = 1024
+
+
+class NameServer:
+
+    def GET(self, filepath):
+        return '127.0.0.1:%d' % PORT
+
+    def POST(self, filepath):
+        import web
+        return json.dumps(dict((fp, '127.0.0.1:%d' % PORT)
+                               for fp in json.loads(web.data())))
+
+
+def serve(root):
+    os.chdir(root)
+    import web
+    import distributed_transparent_file_access as fs
+    import runtime
+
+    fs._config['directories'] = set(['/bench'])
+    names = web.application(('(/.*)', 'NameServer'),
+                            {'NameServer': NameServer}, autoreload=False)
+    server = runtime.make_server(names.wsgifunc(), ('127.0.0.1', NAME_PORT))
+    t = threading.Thread(target=server.start)
+    t.daemon = True
+    t.start()
+
+    app = web.application(('(/.*)', 'FileServer'),
+                          {'FileServer': fs.FileServer}, autoreload=False)
+    runtime.serve(app.wsgifunc(), ('127.0.0.1', PORT))
+
+
+def timed(label, count, fn):
+    start = time.time()
+    fn()
+    elapsed = time.time() - start
+    print('  %-24s %9.0f files/s' % (label, count / elapsed))
+    return elapsed
+
+
+def main(argv):
+    if len(argv) > 2 and argv[1] == '--serve':
+        return serve(argv[2])
+
+    count = int(argv[1]) if len(argv) > 1 else 2000
+    root = tempfile.mkdtemp()
+    os.makedirs(os.path.join(root, 'fs', 'bench'))
+    data = os.urandom(SIZE)
+    filepaths = ['/bench/file%d' % i for i in range(count)]
+    for filepath in filepaths:
+        with open(os.path.join(root, 'fs', filepath[1:]), 'wb') as f:
+            f.write(data)
+
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                               '--serve', root])
+    try:
+        time.sleep(1)
+        import clientcaching
+
+        clientcaching._config['directoryserver'] = '127.0.0.1:%d' % NAME_PORT
+        clientcaching._locations.get_many(filepaths)
+        pool = clientcaching._pool
+
+        def one_by_one(method):
+            for filepath in filepaths:
+                response = pool.request('127.0.0.1', PORT, method, filepath)
+                assert response.status == 200
+
+        def read_all():
+            files = clientcaching.open_many(filepaths, 'rt')
+            assert all(f.read() == data for f in files.values())
+
+        print('%d files of %d bytes' % (count, SIZE))
+        single = timed('HEAD one by one', count, lambda: one_by_one('HEAD'))
+        batched = timed('stat_many', count,
+                        lambda: clientcaching.stat_many(filepaths))
+        print('  %-24s %9.1fx' % ('speedup', single / batched))
+        single = timed('GET one by one', count, lambda: one_by_one('GET'))
+        batched = timed('open_many', count, read_all)
+        print('  %-24s %9.1fx' % ('speedup', single / batched))
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
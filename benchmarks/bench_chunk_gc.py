@@ -0,0 +1,73 @@
+"""Disk usage of the chunk store as files are overwritten and deleted,
+and time to collect the chunks no file uses anymore.
+
+usage: python bench_chunk_gc.py [files] [size_mb] [rewrites]
+
+Files are written through the chunk store of the file server, then
+rewritten with new data and half of them deleted; collect_chunks must
+bring the store back to the chunks of the remaining files.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'servers'))
+
+
+def store_size(root):
+    total = count = 0
+    for directory, dirs, files in os.walk(root):
+        for name in files:
+            total += os.path.getsize(os.path.join(directory, name))
+            count += 1
+    return total, count
+
+
+def main(argv):
+    files = int(argv[1]) if len(argv) > 1 else 20
+    size = int(float(argv[2]) * 1024**2) if len(argv) > 2 else 1024**2
+    rewrites = int(argv[3]) if len(argv) > 3 else 4
+
+    root = tempfile.mkdtemp()
+    try:
+        os.chdir(root)
+        os.makedirs(os.path.join('fs', 'bench'))
+        import chunk_store
+        import distributed_transparent_file_access as fs
+
+        fs._chunks = chunk_store.ChunkStore(os.path.join(root, 'chunks'))
+        paths = [fs.get_local_path('/bench/file%d' % i) for i in range(files)]
+
+        for i in range(rewrites + 1):
+            for p in paths:
+                fs.write_content(p, [os.urandom(size)])
+        for p in paths[::2]:
+            os.unlink(p)
+
+        live = set(digest for p in paths[1::2] for digest, length
+                   in chunk_store.load_manifest(p)['chunks'])
+        before, chunks = store_size(fs._chunks.root)
+
+        start = time.time()
+        deleted = fs.collect_chunks(grace=0)
+        elapsed = time.time() - start
+        after, left = store_size(fs._chunks.root)
+
+        print('%d files of %.1f MiB written %d times, half deleted'
+              % (files, size / 1024.0**2, rewrites + 1))
+        print('  before collection %9.1f MiB %8d chunks'
+              % (before / 1024.0**2, chunks))
+        print('  after collection  %9.1f MiB %8d chunks'
+              % (after / 1024.0**2, left))
+        print('  %d chunks deleted in %.3f s' % (deleted, elapsed))
+        assert left == len(live), 'chunks in use were deleted or kept'
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,60 @@
+"""Speed of the content-defined chunking, with the hashes computed by
+numpy when it's installed and in pure Python, and the chunks an insertion
+changes.
+
+usage: python bench_chunking.py [size in MiB] [block KiB]
+
+The data is cut as it's received, by blocks, like the body of a PUT. Both
+ways of hashing must give the same chunks.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'servers'))
+
+import chunk_store
+
+
+def chunks(data, block):
+    return list(chunk_store.iter_chunks(
+        data[i:i + block] for i in range(0, len(data), block)))
+
+
+def main(argv):
+    size = int(float(argv[1]) * 1024**2) if len(argv) > 1 else 16 * 1024**2
+    block = int(argv[2]) * 1024 if len(argv) > 2 else 64 * 1024
+    data = os.urandom(size)
+
+    backends = [('python', None)]
+    if chunk_store.numpy is not None:
+        backends.insert(0, ('numpy', chunk_store.numpy))
+
+    print('%.1f MiB of random data by blocks of %d KiB'
+          % (size / 1024.0**2, block / 1024))
+    found = []
+    for name, backend in backends:
+        chunk_store.numpy = backend
+        start = time.time()
+        found.append(chunks(data, block))
+        elapsed = time.time() - start
+        print('  %-7s %8.1f MB/s %8d chunks of %.1f KiB on average'
+              % (name, size / 1024.0**2 / elapsed, len(found[-1]),
+                 size / 1024.0 / len(found[-1])))
+    chunk_store.numpy = backends[0][1]
+
+    assert all(cut == found[0] for cut in found), 'the backends disagree'
+    assert b''.join(found[0]) == data, 'the chunks lose data'
+
+    inserted = data[:size // 2] + b'inserted' + data[size // 2:]
+    before = set(found[0])
+    changed = [chunk for chunk in chunks(inserted, block)
+               if chunk not in before]
+    print('  an insertion in the middle changes %d chunks, %.1f KiB'
+          % (len(changed), sum(map(len, changed)) / 1024.0))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
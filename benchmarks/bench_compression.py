@@ -0,0 +1,110 @@
+"""Ratio and speed of the content codings on typical file types, and the
+decision of the sampler to compress them or send them as is.
+
+usage: python bench_compression.py [size in MiB]
+"""
+
+import json
+import os
+import random
+import sys
+import time
+import zlib
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'servers'))
+
+import compression
+
+
+def log_data(size, rand):
+    lines = []
+    total = 0
+    while total < size:
+        line = ('2024-03-%02d 12:%02d:%02d INFO [worker-%d] GET /data/file%d'
+                ' 200 %d bytes in %d ms\n'
+                % (rand.randint(1, 28), rand.randint(0, 59),
+                   rand.randint(0, 59), rand.randint(1, 8),
+                   rand.randint(0, 10000), rand.randint(0, 1 << 20),
+                   rand.randint(1, 500)))
+        lines.append(line)
+        total += len(line)
+    return ''.join(lines)[:size]
+
+
+def csv_data(size, rand):
+    lines = []
+    total = 0
+    while total < size:
+        line = '%d,%s,%.4f,%.4f,%d\n' % (
+            rand.randint(0, 1 << 30), rand.choice(['eu', 'us', 'asia']),
+            rand.random() * 100, rand.gauss(0, 1), rand.randint(0, 9))
+        lines.append(line)
+        total += len(line)
+    return ''.join(lines)[:size]
+
+
+def json_data(size, rand):
+    items = []
+    total = 0
+    while total < size:
+        item = json.dumps({'id': rand.randint(0, 1 << 30),
+                           'name': 'user%d' % rand.randint(0, 100000),
+                           'tags': rand.sample(['a', 'b', 'c', 'd', 'e'], 2),
+                           'score': rand.random()})
+        items.append(item)
+        total += len(item) + 2
+    return ('[' + ',\n'.join(items) + ']')[:size]
+
+
+def random_data(size, rand):
+    return os.urandom(size)
+
+
+def compressed_data(size, rand):
+    return zlib.compress(log_data(size * 4, rand), 9)[:size]
+
+
+TYPES = [('log', log_data), ('csv', csv_data), ('json', json_data),
+         ('random', random_data), ('compressed', compressed_data)]
+
+
+def codings():
+    yield 'gzip', 1
+    yield 'gzip', 6
+    if 'zstd' in compression.CODINGS:
+        yield 'zstd', 1
+        yield 'zstd', 3
+
+
+def main(argv):
+    size = int(float(argv[1]) * 1024 * 1024) if len(argv) > 1 else 8 << 20
+    rand = random.Random(42)
+    mib = size / float(1 << 20)
+
+    print('%-11s %-7s %8s %10s %10s %10s %s' % (
+        'type', 'coding', 'ratio', 'comp MB/s', 'dec MB/s', 'saved KiB',
+        'sampler'))
+    for name, make in TYPES:
+        data = make(size, rand)
+        start = time.time()
+        worth = compression.compressible(data)
+        sampled = time.time() - start
+        decision = '%s (%.1f ms)' % ('compress' if worth else 'as is',
+                                     sampled * 1000)
+        for coding, level in codings():
+            start = time.time()
+            compressed = compression.compress_string(data, coding, level)
+            compressing = time.time() - start
+            start = time.time()
+            assert compression.decompress_string(compressed, coding) == data
+            decompressing = time.time() - start
+            print('%-11s %-7s %8.3f %10.1f %10.1f %10d %s' % (
+                name, '%s-%d' % (coding, level),
+                len(compressed) / float(len(data)), mib / compressing,
+                mib / decompressing, (len(data) - len(compressed)) / 1024,
+                decision))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
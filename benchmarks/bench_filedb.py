@@ -0,0 +1,81 @@
+"""Batched inserts and metadata queries of the FileDb backends over a
+million files spread over 20 nodes with 1 to 3 replicas each.
+
+usage: python bench_filedb.py [files] [queries]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'servers'))
+
+from replication import loadFileDb
+
+NODES = ['node%d:8080' % i for i in range(20)]
+BATCH = 10000
+
+
+def files(count):
+    rand = random.Random(42)
+    for i in range(count):
+        yield ('/data/dir%d/file%d' % (i % 1000, i), rand.randint(1, 1 << 24),
+               rand.sample(NODES, rand.randint(1, 3)))
+
+
+def timed(label, n, fn):
+    start = time.time()
+    for i in range(n):
+        fn(i)
+    elapsed = time.time() - start
+    print('  %-24s %9.1f us/op' % (label, elapsed / n * 1e6))
+
+
+def bench(db, count, queries):
+    start = time.time()
+    batch = []
+    for data in files(count):
+        batch.append(data)
+        if len(batch) == BATCH:
+            db.addFiles(batch)
+            batch = []
+    db.addFiles(batch)
+    elapsed = time.time() - start
+    print('  %-24s %9.0f files/s' % ('addFiles', count / elapsed))
+
+    rand = random.Random(7)
+    names = ['/data/dir%d/file%d' % (i % 1000, i)
+             for i in (rand.randrange(count) for j in range(queries))]
+    timed('getKn', queries, lambda i: db.getKn(names[i]))
+    timed('getMaxKnInNode', queries,
+          lambda i: db.getMaxKnInNode(NODES[i % len(NODES)]))
+    timed('selectFileToReplicate', queries,
+          lambda i: db.selectFileToReplicate(NODES[i % len(NODES)]))
+    timed('addNode + removeNode', queries,
+          lambda i: (db.addNode(names[i], 'spare:8080'),
+                     db.removeNode(names[i], 'spare:8080')))
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 1000000
+    queries = int(argv[2]) if len(argv) > 2 else 10000
+
+    print('memory, %d files' % count)
+    bench(loadFileDb('memory'), count, queries)
+
+    directory = tempfile.mkdtemp()
+    try:
+        print('sqlite, %d files' % count)
+        db = loadFileDb('sqlite', os.path.join(directory, 'filedb.sqlite'))
+        bench(db, count, queries)
+        db.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,130 @@
+"""Read latency of a file replicated on 3 servers, one of which is slow
+on some requests, without then with hedged reads.
+
+usage: python bench_hedged.py [reads] [slow fraction] [slow seconds]
+
+Every file server and a name server answering the replicas run in
+their own process. Leases are off so every read asks the servers.
+"""
+
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'servers'))
+sys.path.insert(0, os.path.join(HERE, '..', 'clients'))
+
+PORTS = [8794, 8795, 8796]
+NAME_PORT = 8793
+SIZE = 4096
+REPLICAS = ','.join('127.0.0.1:%d' % port for port in PORTS)
+
+
+class NameServer:
+
+    def GET(self, filepath):
+        return REPLICAS
+
+
+def serve(root, port, slow, delay):
+    os.chdir(root)
+    import web
+    import distributed_transparent_file_access as fs
+    import runtime
+
+    fs._config['directories'] = set(['/bench'])
+    fs._leases.url = None
+    app = web.application(('(/.*)', 'FileServer'),
+                          {'FileServer': fs.FileServer},
+                          autoreload=False).wsgifunc()
+    rand = random.Random(port)
+
+    def slowed(environ, start_response):
+        if rand.random() < slow:
+            time.sleep(delay)
+        return app(environ, start_response)
+
+    if port == PORTS[0]:
+        names = web.application(('(/.*)', 'NameServer'),
+                                {'NameServer': NameServer}, autoreload=False)
+        server = runtime.make_server(names.wsgifunc(),
+                                     ('127.0.0.1', NAME_PORT))
+        t = threading.Thread(target=server.start)
+        t.daemon = True
+        t.start()
+
+    runtime.serve(slowed, ('127.0.0.1', port))
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(label, reads, data):
+    import clientcaching
+
+    latencies = []
+    for i in range(reads):
+        start = time.time()
+        f = clientcaching.File('/bench/file', 'r')
+        assert f.read() == data
+        f.close()
+        latencies.append(time.time() - start)
+
+    latencies.sort()
+    print('  %-16s %9.1f %9.1f %9.1f'
+          % (label, percentile(latencies, 0.5) * 1000,
+             percentile(latencies, 0.99) * 1000, latencies[-1] * 1000))
+
+
+def main(argv):
+    if len(argv) > 2 and argv[1] == '--serve':
+        return serve(argv[2], int(argv[3]), float(argv[4]), float(argv[5]))
+
+    reads = int(argv[1]) if len(argv) > 1 else 1000
+    slow = argv[2] if len(argv) > 2 else '0.05'
+    delay = argv[3] if len(argv) > 3 else '0.1'
+
+    roots = []
+    servers = []
+    data = os.urandom(SIZE)
+    try:
+        for i, port in enumerate(PORTS):
+            root = tempfile.mkdtemp()
+            roots.append(root)
+            os.makedirs(os.path.join(root, 'fs', 'bench'))
+            with open(os.path.join(root, 'fs', 'bench', 'file'), 'wb') as f:
+                f.write(data)
+            # only the first replica, read first, is slow
+            servers.append(subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), '--serve', root,
+                 str(port), slow if i == 0 else '0', delay]))
+        time.sleep(1)
+
+        import clientcaching
+
+        clientcaching._config['directoryserver'] = '127.0.0.1:%d' % NAME_PORT
+
+        print('%d reads of %d bytes, %s of them %ss slower on the first '
+              'replica' % (reads, SIZE, slow, delay))
+        print('  %-16s %9s %9s %9s' % ('', 'p50 (ms)', 'p99 (ms)', 'max (ms)'))
+        clientcaching._config['hedged_reads'] = False
+        run('single replica', reads, data)
+        clientcaching._config['hedged_reads'] = True
+        run('hedged', reads, data)
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+        for root in roots:
+            shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
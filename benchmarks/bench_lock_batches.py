@@ -0,0 +1,99 @@
+"""Throughput of acquire_all batches under contention, with leases
+shorter than the waits, and check that no two holders ever overlap.
+
+usage: python bench_lock_batches.py [workers] [rounds] [lease ttl]
+
+Every worker locks a few names out of a small set at once and holds
+them for up to a lease, so batches wait for their later names longer
+than the lease of the names they already got. Each grant is recorded
+with the time it was held, and the holds of every name must not
+overlap.
+"""
+
+import os
+import random
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'servers'))
+sys.path.insert(0, os.path.join(HERE, '..', 'clients'))
+
+from locking import LockerServer
+from client_locking import LockerClient
+
+URL = 'tcp://127.0.0.1:7897'
+NAMES = ['name%d' % i for i in range(6)]
+BATCH = 3
+
+
+def worker(idx, rounds, ttl, holds, lock_):
+    rand = random.Random(idx)
+    client = LockerClient(URL)
+    client.start()
+
+    for i in range(rounds):
+        names = rand.sample(NAMES, BATCH)
+        client.acquire_all(names)
+        granted = time.time()
+        time.sleep(rand.uniform(0, ttl))
+        released = time.time()
+        with lock_:
+            holds.extend((name, granted, released, client.tokens[name])
+                         for name in names)
+        client.release_all()
+
+    client.finalize()
+
+
+def overlaps(holds):
+    """Returns the pairs of holds of a name overlapping in time"""
+    found = []
+    by_name = {}
+    for hold in holds:
+        by_name.setdefault(hold[0], []).append(hold)
+    for name, spans in by_name.items():
+        spans.sort(key=lambda hold: hold[1])
+        for a, b in zip(spans, spans[1:]):
+            if b[1] < a[2]:
+                found.append((a, b))
+    return found
+
+
+def main(argv):
+    workers = int(argv[1]) if len(argv) > 1 else 8
+    rounds = int(argv[2]) if len(argv) > 2 else 10
+    ttl = float(argv[3]) if len(argv) > 3 else 0.3
+
+    server = threading.Thread(target=LockerServer(URL, lease_ttl=ttl).run)
+    server.start()
+
+    holds = []
+    lock_ = threading.Lock()
+    threads = [threading.Thread(target=worker,
+                                args=(i, rounds, ttl, holds, lock_))
+               for i in range(workers)]
+
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    LockerClient(URL).send_done()
+    server.join()
+
+    print('%d workers x %d batches of %d names out of %d, lease %.1f s: '
+          '%.1f batches/s' % (workers, rounds, BATCH, len(NAMES), ttl,
+                              workers * rounds / elapsed))
+    found = overlaps(holds)
+    for a, b in found:
+        print('  %s held with token %d and %d at once' % (a[0], a[3], b[3]))
+    assert not found, 'mutual exclusion broken'
+    print('  no overlapping holds')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
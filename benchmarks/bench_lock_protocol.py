@@ -0,0 +1,67 @@
+"""Lock operations per second of the string protocol, one LOCK/UNLOCK
+round-trip per name, against the binary protocol locking and unlocking
+all the names of a job in one round-trip each.
+
+usage: python bench_lock_protocol.py [names per job] [jobs]
+"""
+
+import os
+import sys
+import threading
+import time
+
+import zmq
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'servers'))
+sys.path.insert(0, os.path.join(HERE, '..', 'clients'))
+
+from locking import LockerServer
+from client_locking import LockerClient
+
+URL = 'tcp://127.0.0.1:7894'
+
+
+def string_protocol(names, jobs):
+    socket_ = zmq.Context.instance().socket(zmq.REQ)
+    socket_.connect(URL)
+    for i in range(jobs):
+        for command in (LockerServer.LOCK, LockerServer.UNLOCK):
+            for name in names:
+                socket_.send_string(LockerServer.DELIMITER.join(
+                    [command, name, 'bench']))
+                socket_.recv_string()
+    socket_.close()
+
+
+def binary_protocol(names, jobs):
+    client = LockerClient(URL)
+    client.start()
+    for i in range(jobs):
+        client.acquire_all(names)
+        client.release_all()
+    client.finalize()
+
+
+def main(argv):
+    n = int(argv[1]) if len(argv) > 1 else 50
+    jobs = int(argv[2]) if len(argv) > 2 else 200
+    names = ['/bench/file%d' % i for i in range(n)]
+
+    server = threading.Thread(target=LockerServer(URL).run)
+    server.start()
+
+    for label, protocol in (('string', string_protocol),
+                            ('binary batch', binary_protocol)):
+        start = time.time()
+        protocol(names, jobs)
+        elapsed = time.time() - start
+        print('%-13s %5d names/job  %8.0f lock ops/s  %7.3f ms/job'
+              % (label, n, 2 * n * jobs / elapsed, elapsed / jobs * 1e3))
+
+    LockerClient(URL).send_done()
+    server.join()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,64 @@
+"""Aggregate lock operations per second of the lock service run as 1, 2
+and 4 shards, each shard in its own process, driven by client processes
+locking and unlocking their own names one at a time.
+
+usage: python bench_lock_shards.py [client processes] [locks per client]
+"""
+
+import multiprocessing as mp
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'servers'))
+sys.path.insert(0, os.path.join(HERE, '..', 'clients'))
+
+from locking import run_shards
+from client_locking import LockerClient, ShardedLockerClient
+
+BASE_PORT = 7880
+
+
+def locks(urls, client_id, count, start):
+    client = ShardedLockerClient(urls)
+    names = ['/bench/%d/file%d' % (client_id, i) for i in range(count)]
+    start.wait()
+    for name in names:
+        client.acquire_all([name])
+        client.release_all([name])
+    client.finalize()
+
+
+def main(argv):
+    clients = int(argv[1]) if len(argv) > 1 else 8
+    count = int(argv[2]) if len(argv) > 2 else 2000
+
+    for shards in (1, 2, 4):
+        urls = ['tcp://127.0.0.1:%d' % (BASE_PORT + i) for i in range(shards)]
+        servers = run_shards(urls)
+        time.sleep(0.5)
+
+        start = mp.Event()
+        workers = [mp.Process(target=locks, args=(urls, i, count, start))
+                   for i in range(clients)]
+        for worker in workers:
+            worker.start()
+        time.sleep(0.5)
+        begin = time.time()
+        start.set()
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - begin
+
+        print('%d shard(s) %3d clients  %8.0f lock ops/s'
+              % (shards, clients, 2 * clients * count / elapsed))
+
+        for url in urls:
+            LockerClient(url).send_done()
+        for server in servers:
+            server.join()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,81 @@
+"""Lock operations per second of a lock server without log, with a log
+fsynced after every request, and with a group-committed log fsynced
+once per batch of the requests waiting.
+
+usage: python bench_lock_wal.py [client processes] [locks per client]
+"""
+
+import logging
+import multiprocessing as mp
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'servers'))
+sys.path.insert(0, os.path.join(HERE, '..', 'clients'))
+
+from locking import LockerServer
+from lock_log import LockLog
+from client_locking import LockerClient
+
+URL = 'tcp://127.0.0.1:7893'
+
+
+def serve(directory, batch):
+    logging.basicConfig(level=logging.WARNING)
+    log = None if directory is None else LockLog(directory).recover()
+    server = LockerServer(URL, log=log)
+    server.MAX_BATCH = batch
+    server.run()
+
+
+def locks(client_id, count, start):
+    client = LockerClient(URL)
+    client.start()
+    names = ['/bench/%d/file%d' % (client_id, i) for i in range(count)]
+    start.wait()
+    for name in names:
+        client.acquire_all([name])
+        client.release_all([name])
+    client.finalize()
+
+
+def main(argv):
+    clients = int(argv[1]) if len(argv) > 1 else 16
+    count = int(argv[2]) if len(argv) > 2 else 500
+
+    for label, logged, batch in (('no log', False, 1),
+                                 ('fsync per request', True, 1),
+                                 ('group commit', True,
+                                  LockerServer.MAX_BATCH)):
+        directory = tempfile.mkdtemp() if logged else None
+        server = mp.Process(target=serve, args=(directory, batch))
+        server.start()
+        time.sleep(0.5)
+
+        start = mp.Event()
+        workers = [mp.Process(target=locks, args=(i, count, start))
+                   for i in range(clients)]
+        for worker in workers:
+            worker.start()
+        time.sleep(0.5)
+        begin = time.time()
+        start.set()
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - begin
+
+        print('%-18s %3d clients  %8.0f lock ops/s'
+              % (label, clients, 2 * clients * count / elapsed))
+
+        LockerClient(URL).send_done()
+        server.join()
+        if directory is not None:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,85 @@
+"""Lock handoff latency and fairness of the lock server under contention.
+
+usage: python bench_locking.py [workers] [rounds]
+
+Every worker takes the same lock `rounds` times. The handoff latency is
+the time between a release and the GO received by the next holder. With
+FIFO queues, waiters are served in the order they asked, so the grants
+go round-robin and the longest wait stays bounded by the number of
+workers.
+"""
+
+import os
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'servers'))
+sys.path.insert(0, os.path.join(HERE, '..', 'clients'))
+
+from locking import LockerServer
+from client_locking import LockerClient
+
+URL = 'tcp://127.0.0.1:7898'
+
+
+def worker(idx, rounds, events, lock_):
+    client = LockerClient(URL)
+    client.start()
+
+    for i in range(rounds):
+        asked = time.time()
+        client.acquire()
+        granted = time.time()
+        released = time.time()
+        with lock_:
+            events.append((granted, released, asked, idx))
+        client.release()
+
+    client.finalize()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main(argv):
+    workers = int(argv[1]) if len(argv) > 1 else 16
+    rounds = int(argv[2]) if len(argv) > 2 else 200
+
+    server = threading.Thread(target=LockerServer(URL).run)
+    server.start()
+
+    events = []
+    lock_ = threading.Lock()
+    threads = [threading.Thread(target=worker,
+                                args=(i, rounds, events, lock_))
+               for i in range(workers)]
+
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    LockerClient(URL).send_done()
+    server.join()
+
+    events.sort()
+    handoffs = [b[0] - a[1] for a, b in zip(events, events[1:])]
+    waits = [granted - asked for granted, released, asked, idx in events]
+
+    print('%d workers x %d rounds: %.0f lock ops/s'
+          % (workers, rounds, len(events) / elapsed))
+    print('handoff  p50 %.3f ms  p99 %.3f ms'
+          % (percentile(handoffs, 0.5) * 1e3,
+             percentile(handoffs, 0.99) * 1e3))
+    print('wait     p50 %.3f ms  max %.3f ms'
+          % (percentile(waits, 0.5) * 1e3, max(waits) * 1e3))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
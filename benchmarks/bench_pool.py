@@ -0,0 +1,100 @@
+"""Small-file operations per second against a local file server, with a
+new connection per request and with the keep-alive connection pool.
+
+usage: python bench_pool.py [requests] [threads]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from contextlib import closing
+from httplib import HTTPConnection
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'servers'))
+
+import web
+from web.httpserver import WSGIServer
+
+import distributed_transparent_file_access as fs
+from connection_pool import ConnectionPool
+
+
+def serve():
+    """Start a file server with one small file on a free port in a
+       background thread and return (server, port, root).
+    """
+
+    root = tempfile.mkdtemp()
+    os.mkdir(os.path.join(root, 'bench'))
+    with open(os.path.join(root, 'bench', 'small'), 'wb') as f:
+        f.write('x' * 1024)
+
+    fs._config['fsroot'] = root
+    fs._config['directories'] = set(['/bench'])
+    fs._leases.ttl = 0
+
+    app = web.application(('(/.*)', 'FileServer'),
+                          {'FileServer': fs.FileServer})
+    server = WSGIServer(('127.0.0.1', 0), app.wsgifunc())
+    server.numthreads = 32
+
+    t = threading.Thread(target=server.start)
+    t.daemon = True
+    t.start()
+
+    while not server.ready:
+        time.sleep(0.01)
+
+    return server, server.socket.getsockname()[1], root
+
+
+def without_pool(port, n):
+    for i in range(n):
+        with closing(HTTPConnection('127.0.0.1', port)) as con:
+            con.request('GET', '/bench/small')
+            con.getresponse().read()
+
+
+def with_pool(pool, port, n):
+    for i in range(n):
+        pool.request('127.0.0.1', port, 'GET', '/bench/small')
+
+
+def run(name, target, args, n, threads):
+    workers = [threading.Thread(target=target, args=args + (n // threads,))
+               for i in range(threads)]
+
+    start = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.time() - start
+
+    print('%-14s %8.0f ops/s' % (name, n // threads * threads / elapsed))
+
+
+def main(argv):
+    n = int(argv[1]) if len(argv) > 1 else 5000
+    threads = int(argv[2]) if len(argv) > 2 else 4
+
+    server, port, root = serve()
+    try:
+        run('no pool', without_pool, (port,), n, threads)
+
+        pool = ConnectionPool(max_per_host=threads)
+        run('pool', with_pool, (pool, port), n, threads)
+        print('pool stats: %s' % pool.stats)
+        pool.close()
+    finally:
+        server.stop()
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
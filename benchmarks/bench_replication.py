@@ -0,0 +1,133 @@
+"""Files replicated per second by the pool of workers of the Replicator,
+and the files it keeps in flight, over the in-memory FileDb.
+
+usage: python bench_replication.py [files] [workers] [download seconds]
+
+Every file has one replica on another node and the downloads only take
+some time, so the pool is limited by the files the scheduler gives it:
+with a file in flight per worker, it must queue as many other files.
+The files are selected by the FileDb at once, then by a node selecting
+one file at a time.
+"""
+
+import os
+import random
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'servers'))
+
+from replication import Replicator, loadFileDb
+
+HOST = 'node0:8080'
+
+
+class Node(object):
+    """The Filesystem of a node, downloading files in delay seconds."""
+
+    def __init__(self, db, workers, delay, batched):
+        self.host = HOST
+        self.db = db
+        self.filedb = db if batched else SingleFileDb(db)
+        self.config = {'replicatorWorkers': workers,
+                       'replicatorIdleTime': 1,
+                       'replicatorInterval': 0.01}
+        self.delay = delay
+        self.rand = random.Random(42)
+        self.lock = threading.Lock()
+        self.active = self.peak = self.done = 0
+
+    def selectFileToReplicate(self):
+        # one of the files of fewest replicas, not always the same
+        files = self.db.selectFilesToReplicate(self.host, 64)
+        return self.rand.choice(files) if files else None
+
+    def downloadFile(self, file, nodes):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(self.delay)
+        self.db.addNode(file, self.host)
+        with self.lock:
+            self.active -= 1
+            self.done += 1
+        return True
+
+    def getFreeDisk(self):
+        return 1 << 50
+
+    def deleteFile(self, file):
+        pass
+
+    def debug(self, *args):
+        pass
+
+    def error(self, message):
+        print('  error: %s' % message)
+
+
+class SingleFileDb(object):
+    """A FileDb without selectFilesToReplicate."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __getattr__(self, name):
+        if name == 'selectFilesToReplicate':
+            raise AttributeError(name)
+        return getattr(self.db, name)
+
+
+def make_node(files, workers, delay, batched):
+    db = loadFileDb('memory')
+    db.addFiles(('/data/file%d' % i, 1024, ['node1:8080'])
+                for i in range(files))
+    return Node(db, workers, delay, batched)
+
+
+def check_schedule(files, workers, batched):
+    """Checks that with a file in flight per worker, the scheduler queues
+    a file for every worker again, none of them in flight"""
+    node = make_node(files, workers, 0, batched)
+    replicator = Replicator(node)
+    replicator.workers = [None] * workers
+    replicator.inFlight = set(data['file'] for data in
+                              node.db.selectFilesToReplicate(HOST, workers))
+    replicator.schedule()
+    queued = set(replicator.queue.entries)
+    assert len(queued) == workers, 'workers left idle'
+    assert not queued & replicator.inFlight, 'files downloaded twice'
+
+
+def run(label, files, workers, delay, batched):
+    check_schedule(files, workers, batched)
+    node = make_node(files, workers, delay, batched)
+
+    replicator = Replicator(node)
+    start = time.time()
+    replicator.start()
+    while node.done < files:
+        time.sleep(0.01)
+    elapsed = time.time() - start
+    replicator.shutdown()
+    replicator.join()
+
+    print('  %-22s %9.1f files/s %6d of %d workers busy at most'
+          % (label, files / elapsed, node.peak, workers))
+
+
+def main(argv):
+    files = int(argv[1]) if len(argv) > 1 else 200
+    workers = int(argv[2]) if len(argv) > 2 else 8
+    delay = float(argv[3]) if len(argv) > 3 else 0.05
+
+    print('%d files downloaded in %.0f ms each by %d workers, at best '
+          '%.1f files/s' % (files, delay * 1000, workers, workers / delay))
+    run('selected at once', files, workers, delay, True)
+    run('selected one by one', files, workers, delay, False)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,141 @@
+"""Latency and throughput of the file server under 1 to 1000 concurrent
+clients, 90% GETs and 10% PUTs of 64KiB files, one connection per
+request.
+
+usage: python bench_server.py [seconds per level] [clients ...]
+
+The server runs in its own process with the limits of its config;
+rejected requests (503) are counted apart from the errors.
+"""
+
+import httplib
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'servers'))
+
+PORT = 8799
+FILES = 100
+SIZE = 64 * 1024
+LEVELS = [1, 10, 100, 1000]
+
+
+def serve(root):
+    os.chdir(root)
+    import web
+    import distributed_transparent_file_access as fs
+    import runtime
+
+    fs._config['directories'] = set(['/bench'])
+    app = web.application(('(/.*)', 'FileServer'),
+                          {'FileServer': fs.FileServer}, autoreload=False)
+    runtime.serve(app.wsgifunc(), ('127.0.0.1', PORT),
+                  threads=fs._config['server_threads'],
+                  max_reads=fs._config['max_reads'],
+                  max_writes=fs._config['max_writes'],
+                  backlog=fs._config['request_backlog'],
+                  queue_timeout=fs._config['queue_timeout'],
+                  timeout=fs._config['client_timeout'])
+
+
+def request(method, path, body=None):
+    conn = httplib.HTTPConnection('127.0.0.1', PORT, timeout=30)
+    try:
+        conn.request(method, path, body)
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    finally:
+        conn.close()
+
+
+def client(deadline, data, latencies, counts, lock):
+    rand = random.Random()
+    while time.time() < deadline:
+        path = '/bench/file%d' % rand.randrange(FILES)
+        start = time.time()
+        try:
+            if rand.random() < 0.1:
+                status = request('PUT', path, data)
+            else:
+                status = request('GET', path)
+        except Exception:
+            status = None
+        elapsed = time.time() - start
+        with lock:
+            if status == 200:
+                latencies.append(elapsed)
+            key = 'rejected' if status == 503 else 'errors'
+            if status != 200:
+                counts[key] += 1
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run_level(clients, seconds, data):
+    latencies = []
+    counts = {'rejected': 0, 'errors': 0}
+    lock = threading.Lock()
+    deadline = time.time() + seconds
+    threads = [threading.Thread(target=client,
+                                args=(deadline, data, latencies, counts, lock))
+               for i in range(clients)]
+    start = time.time()
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    latencies.sort()
+    if not latencies:
+        print('%7d  no request served, %d rejected, %d errors'
+              % (clients, counts['rejected'], counts['errors']))
+        return
+    print('%7d %9.1f %9.1f %9.1f %9d %7d'
+          % (clients, len(latencies) / elapsed,
+             percentile(latencies, 0.5) * 1000,
+             percentile(latencies, 0.99) * 1000,
+             counts['rejected'], counts['errors']))
+
+
+def main(argv):
+    if len(argv) > 2 and argv[1] == '--serve':
+        return serve(argv[2])
+
+    seconds = float(argv[1]) if len(argv) > 1 else 5
+    levels = [int(n) for n in argv[2:]] or LEVELS
+    threading.stack_size(512 * 1024)
+
+    root = tempfile.mkdtemp()
+    os.makedirs(os.path.join(root, 'fs', 'bench'))
+    data = os.urandom(SIZE)
+    for i in range(FILES):
+        with open(os.path.join(root, 'fs', 'bench', 'file%d' % i), 'wb') as f:
+            f.write(data)
+
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                               '--serve', root])
+    try:
+        time.sleep(1)
+        print('clients     req/s  p50 (ms)  p99 (ms)  rejected  errors')
+        for clients in levels:
+            run_level(clients, seconds, data)
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
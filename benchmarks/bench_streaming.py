@@ -0,0 +1,69 @@
+"""Throughput and peak RSS of the streaming GET/PUT path of the file server.
+
+usage: python bench_streaming.py [size_mb ...]
+
+Every size runs in its own process, so the reported peak RSS (ru_maxrss)
+belongs to that size only.
+"""
+
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'servers'))
+
+SIZES_MB = [1, 16, 256, 1024, 4096]
+
+
+def generate(size, chunk_size):
+    """Yield size bytes by blocks of chunk_size, like a request body."""
+
+    block = os.urandom(chunk_size)
+    while size > 0:
+        yield block[:min(size, chunk_size)]
+        size -= chunk_size
+
+
+def run_one(size):
+    import distributed_transparent_file_access as fs
+
+    chunk_size = fs._config['chunk_size']
+    root = tempfile.mkdtemp()
+    p = os.path.join(root, 'bench')
+
+    try:
+        start = time.time()
+        fs.write_atomically(p, generate(size, chunk_size))
+        put = time.time() - start
+
+        start = time.time()
+        for chunk in fs.iter_file(p):
+            pass
+        get = time.time() - start
+    finally:
+        if os.path.exists(p):
+            os.unlink(p)
+        os.rmdir(root)
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    mb = size / 1024.0**2
+    print('%8d MB  PUT %8.1f MB/s  GET %8.1f MB/s  peak RSS %7.1f MB'
+          % (mb, mb / put, mb / get, rss))
+
+
+def main(argv):
+    if len(argv) > 2 and argv[1] == '--one':
+        return run_one(int(argv[2]))
+
+    sizes = [int(a) for a in argv[1:]] or SIZES_MB
+    for mb in sizes:
+        subprocess.check_call([sys.executable, os.path.abspath(__file__),
+                               '--one', str(mb * 1024**2)])
+
+
+if __name__ == '__main__':
+    main(sys.argv)
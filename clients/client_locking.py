@@ -1,29 +1,148 @@
+import itertools
 import time
 import os
 import multiprocessing as mp
 import socket
+import threading
 import zmq
 import random
-from locking_server import LockerServer
+from locking import HashRing, LockerServer
+
+
+class ShardMoved(RuntimeError):
+    """ Raised when a shard doesn't own a lock name anymore """
+
+    def __init__(self, urls):
+        RuntimeError.__init__(self, 'Lock service shards are now `%s`'
+                              % '`, `'.join(urls))
+        self.urls = urls
+
+
+class Heartbeat(threading.Thread):
+    """ Renews the leases of the locks held in this process
+
+    One thread serves all the LockerClients, so acquiring a lock doesn't
+    start a thread: each client registers one RENEW request for all the
+    locks it holds. A server that doesn't answer in time is failed over
+    to the next of the urls of the client, which the client then uses
+    too. Clients whose leases could not be renewed, because one already
+    expired or no server answered, are moved to `lost`. Every client has
+    its own id, hence its own renewals.
+
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        # id -> [time of the next renewal, interval, frames, urls]
+        self._due = {}
+        self.lost = set()
+        self._started = False
+        self._cond = threading.Condition()
+
+    def add(self, key, frames, interval, urls):
+        with self._cond:
+            self._due[key] = [time.time() + interval, interval, frames, urls]
+            self.lost.discard(key)
+            if not self._started:
+                self._started = True
+                self.start()
+            self._cond.notify()
+
+    def remove(self, key):
+        with self._cond:
+            self._due.pop(key, None)
+
+    def run(self):
+        sockets = {}
+        while True:
+            with self._cond:
+                now = time.time()
+                due = [(key, interval, frames, urls)
+                       for key, (next_, interval, frames, urls)
+                       in self._due.items() if next_ <= now]
+                for key, interval, frames, urls in due:
+                    self._due[key][0] = now + interval
+                if not due:
+                    timeout = None
+                    if self._due:
+                        timeout = min(d[0] for d in self._due.values()) - now
+                    self._cond.wait(timeout)
+                    continue
+
+            for key, interval, frames, urls in due:
+                if self._renew(sockets, frames, interval, urls):
+                    continue
+                with self._cond:
+                    # Unless the client changed its locks meanwhile: the
+                    # names it released are the ones that failed
+                    entry = self._due.get(key)
+                    if entry is not None and entry[2] is frames:
+                        del self._due[key]
+                        self.lost.add(key)
+
+    @staticmethod
+    def _renew(sockets, frames, interval, urls):
+        """Sends the RENEW `frames` to the first of `urls` answering,
+        moved first, and tells if the leases were renewed"""
+        for attempt in range(len(urls)):
+            url = urls[0]
+            if url not in sockets:
+                sockets[url] = zmq.Context.instance().socket(zmq.REQ)
+                sockets[url].setsockopt(zmq.LINGER, 0)
+                sockets[url].connect(url)
+            socket_ = sockets[url]
+            socket_.send_multipart(frames)
+            if socket_.poll(int(interval * 1000)):
+                reply = socket_.recv_multipart()
+                status, ttl = LockerServer.REPLY.unpack(reply[0])
+                return status == LockerServer.ST_DONE
+            # A REQ socket without answer can't send anymore
+            socket_.close()
+            del sockets[url]
+            urls.append(urls.pop(0))
+        return False
 
 
 class LockerClient(object):
-    """ Implements a Lock using req-rep scheme with LockerServer """
+    """ Implements a Lock using req-rep scheme with LockerServer
+
+    `url` is the url of the server, or the list of the urls of a primary
+    server and of its standbys. With several urls, a server that doesn't
+    answer within `failover_timeout` seconds is pinged while a lock is
+    waited for, and the request is sent again to the next url if it
+    doesn't answer the ping either.
+
+    """
 
 
     def __init__(self, url="tcp://127.0.0.1:7899", 
-                 lock_name=LockerServer.DEFAULT_LOCK):
+                 lock_name=LockerServer.DEFAULT_LOCK, failover_timeout=5.0):
         self.lock_name = lock_name
-        self.url = url
+        # urls of the servers, the one in use first
+        self.urls = list(url) if isinstance(url, (list, tuple)) else [url]
+        self.failover_timeout = failover_timeout
         self._context = None
         self._socket = None
+        self._connected = None
+        # names of the locks held, renewed together by the heartbeat
+        self._held = set()
+        self._lease_ttl = None
         self.id = None
+        self._pid = None
+        self.token = None
+        self.tokens = {}
+
+    @property
+    def url(self):
+        return self.urls[0]
 
     def __getstate__(self):
         result_dict = self.__dict__.copy()
         # Do not pickle zmq data
         result_dict['_context'] = None
         result_dict['_socket'] = None
+        result_dict['_connected'] = None
         return result_dict
 
     def start(self):
@@ -33,12 +152,49 @@ class LockerClient(object):
 
         """
         self._context = zmq.Context()
+        self._connect()
+        self.test_ping()
+        if self._pid != os.getpid():
+            # create a unique id based on host name, process id and
+            # client, kept when reconnecting to release the locks held
+            self._pid = os.getpid()
+            self.id = (socket.getfqdn().replace(LockerServer.DELIMITER, '-') +
+                       '__' + str(self._pid) + '__' + str(next(_client_ids)))
+
+    def _connect(self):
         self._socket = self._context.socket(zmq.REQ)
+        self._socket.setsockopt(zmq.LINGER, 0)
         self._socket.connect(self.url)
-        self.test_ping()
-        # create a unique id based on host name and process id
-        self.id = (socket.getfqdn().replace(LockerServer.DELIMITER, '-') + 
-                   '__' + str(os.getpid()))
+        self._connected = self.url
+
+    def _fail_over(self):
+        """Sends the next requests to the next server, unless the
+        heartbeat already failed over"""
+        self._socket.close()
+        if self._connected == self.url:
+            self.urls.append(self.urls.pop(0))
+        self._connect()
+
+    def _answered(self, wait=False):
+        """Tells if the server answered the request sent, `False` if it
+        failed. With `wait`, e.g. for a lock, the server is pinged every
+        `failover_timeout` seconds until it answers."""
+        if len(self.urls) == 1:
+            return True
+        timeout = int(self.failover_timeout * 1000)
+        while not self._socket.poll(timeout):
+            if not wait:
+                return False
+            ping = self._context.socket(zmq.REQ)
+            ping.setsockopt(zmq.LINGER, 0)
+            try:
+                ping.connect(self.url)
+                ping.send_string(LockerServer.PING)
+                if not ping.poll(timeout):
+                    return False
+            finally:
+                ping.close()
+        return True
 
     def send_done(self):
         """Notifies the Server to shutdown"""
@@ -48,8 +204,11 @@ class LockerClient(object):
         self._socket.recv_string()  # Final receiving of closing
 
     def test_ping(self):
-        """Connection test"""
+        """Connection test, failing over until a server answers"""
         self._socket.send_string(LockerServer.PING)
+        while not self._answered():
+            self._fail_over()
+            self._socket.send_string(LockerServer.PING)
         response = self._socket.recv_string()
         if response != LockerServer.PONG:
             raise RuntimeError('Connection Error to Lock Server')
@@ -61,36 +220,248 @@ class LockerClient(object):
             self._socket = None
             self._context = None
 
-    def acquire(self):
+    def _request(self, op, names, mode=0, timeout=None):
+        """Sends a binary request about `names` to the server
+
+        Returns the status, the lease ttl and the other frames of the
+        reply.
+
+        """
+        header = LockerServer.HEADER.pack(
+            op, mode, -1.0 if timeout is None else float(timeout))
+        request = ([header, self.id.encode('utf-8')] +
+                   [name.encode('utf-8') for name in names])
+        if self._connected != self.url:
+            # The heartbeat failed over
+            self._socket.close()
+            self._connect()
+        self._socket.send_multipart(request)
+        while not self._answered(wait=op == LockerServer.OP_LOCK):
+            # The standby taking over has the locks granted by the primary
+            self._fail_over()
+            self._socket.send_multipart(request)
+        frames = self._socket.recv_multipart()
+        status, ttl = LockerServer.REPLY.unpack(frames[0])
+        return status, ttl, frames[1:]
+
+    def acquire(self, timeout=None, shared=False):
         """Acquires lock and returns `True`
 
-        Blocks until lock is available.
+        Blocks until lock is available: the server only answers once
+        the lock is handed over to this client, in the order clients
+        asked for it. With a `timeout` in seconds, returns `False` if
+        the lock is still not available by then.
+
+        A `shared` lock can be held by several clients at once, as long
+        as no one holds or waits for it exclusively.
+
+        The fencing token of the grant is stored in `self.token`, and
+        the lease is renewed in the background until `release`.
+
+        """
+        if self.acquire_all([self.lock_name], timeout, shared):
+            self.token = self.tokens[self.lock_name]
+            return True
+        return False
+
+    def try_acquire(self, shared=False):
+        """Acquires lock if it's available right away
+
+        Returns `True` if it was acquired, `False` otherwise.
+
+        """
+        return self.acquire(timeout=0, shared=shared)
+
+    def acquire_all(self, names, timeout=None, shared=False):
+        """Acquires all the locks `names` in one request and returns `True`
+
+        Either all of them are acquired or none: like `acquire`, blocks
+        until they are all available or until `timeout`. The server
+        takes them in a global order, so jobs locking overlapping sets
+        of names can't deadlock.
+
+        The fencing tokens are stored by name in `self.tokens`.
 
         """
         if self._context is None:
             self.start()
-        request = (LockerServer.LOCK + LockerServer.DELIMITER +
-                   self.lock_name + LockerServer.DELIMITER + self.id)
-        while True:
-            self._socket.send_string(request)
-            response = self._socket.recv_string()
-            if response == LockerServer.GO:
-                return True
-            elif response == LockerServer.WAIT:
-                time.sleep(self.SLEEP)
-            else:
-                raise RuntimeError('Response `%s` not understood' % response)
+        names = sorted(set(names))
+        mode = LockerServer.MODES.index(
+            LockerServer.SHARED if shared else LockerServer.EXCLUSIVE)
+        status, ttl, frames = self._request(LockerServer.OP_LOCK, names,
+                                            mode, timeout)
+        if status == LockerServer.ST_GO:
+            for name, frame in zip(names, frames):
+                self.tokens[name] = LockerServer.TOKEN.unpack(frame)[0]
+            self._held.update(names)
+            self._lease_ttl = ttl
+            self._start_heartbeat(ttl)
+            return True
+        elif status == LockerServer.ST_WAIT:
+            return False
+        elif status == LockerServer.ST_MOVED:
+            raise ShardMoved([frame.decode('utf-8') for frame in frames])
+        else:
+            raise RuntimeError('Could not acquire locks `%s` because of '
+                               '`%s`!' % ('`, `'.join(names),
+                                          b''.join(frames).decode('utf-8')))
+
+    def _start_heartbeat(self, ttl):
+        key = self.id
+        if not self._held:
+            _heartbeat.remove(key)
+            return
+        frames = ([LockerServer.HEADER.pack(LockerServer.OP_RENEW, 0, -1.0),
+                   self.id.encode('utf-8')] +
+                  [name.encode('utf-8') for name in sorted(self._held)])
+        # Three heartbeats per lease, so one can be lost
+        _heartbeat.add(key, frames, ttl / 3.0, self.urls)
+
+    def lease_lost(self):
+        """Tells if the leases of the locks could not be renewed"""
+        return self.id in _heartbeat.lost
 
     def release(self):
         """Releases lock"""
-        request = (LockerServer.UNLOCK + LockerServer.DELIMITER +
-                   self.lock_name + LockerServer.DELIMITER + self.id)
-        self._socket.send_string(request)
-        response = self._socket.recv_string()
-        if response != LockerServer.UNLOCKED:
-            raise RuntimeError('Could not release lock `%s` (`%s`) '
-                               'because of `%s`!' % (self.lock_name, 
-                                                     self.id, response))
+        self.release_all([self.lock_name])
+
+    def release_all(self, names=None):
+        """Releases the locks `names`, all the locks held if `None`"""
+        names = sorted(self._held if names is None else set(names))
+        self._held.difference_update(names)
+        self._start_heartbeat(self._lease_ttl)
+        status, ttl, frames = self._request(LockerServer.OP_UNLOCK, names)
+        if status != LockerServer.ST_DONE:
+            raise RuntimeError('Could not release locks `%s` (`%s`) '
+                               'because of `%s`!' % (
+                                   '`, `'.join(names), self.id,
+                                   b''.join(frames).decode('utf-8')))
+
+
+class ShardedLockerClient(object):
+    """ Implements Locks over the shards of a sharded lock service
+
+    Every name is routed to the shard owning it by consistent hashing.
+    The names of a job spread over several shards are taken shard after
+    shard in the order of their urls, which keeps the global order
+    deadlock-free, and what was taken is released if a later shard
+    can't be locked in time. When a shard replies that the ring
+    changed, the client routes again with the new one.
+
+    """
+
+    MAX_REROUTES = 3
+
+    def __init__(self, urls, lock_name=LockerServer.DEFAULT_LOCK):
+        self.lock_name = lock_name
+        self.ring = HashRing(urls)
+        self._clients = {}
+        self.token = None
+        self.tokens = {}
+
+    def _client(self, url):
+        if url not in self._clients:
+            self._clients[url] = LockerClient(url, self.lock_name)
+            self._clients[url].start()
+        return self._clients[url]
+
+    def _route(self, names):
+        """Returns the (url, names) of the shards owning `names`"""
+        shards = {}
+        for name in set(names):
+            shards.setdefault(self.ring.get(name), []).append(name)
+        return sorted(shards.items())
+
+    def set_shards(self, urls, announce=False):
+        """Routes the next requests to the shards `urls`
+
+        With `announce`, the shards are told about the new ring too, so
+        they send the clients still using the old one to the right
+        shard. The names moving to another shard must not be held.
+
+        """
+        previous, self.ring = self.ring.urls, HashRing(urls)
+        if announce:
+            for url in sorted(set(previous) | set(self.ring.urls)):
+                status, ttl, frames = self._client(url)._request(
+                    LockerServer.OP_RING, self.ring.urls)
+                if status != LockerServer.ST_DONE:
+                    raise RuntimeError('Could not update shards of `%s`: %s'
+                                       % (url, b''.join(frames)))
+
+    def add_shard(self, url, announce=True):
+        self.set_shards(self.ring.urls + [url], announce)
+
+    def remove_shard(self, url, announce=True):
+        self.set_shards([u for u in self.ring.urls if u != url], announce)
+
+    def acquire(self, timeout=None, shared=False):
+        """Acquires lock, like `LockerClient.acquire`"""
+        if self.acquire_all([self.lock_name], timeout, shared):
+            self.token = self.tokens[self.lock_name]
+            return True
+        return False
+
+    def try_acquire(self, shared=False):
+        return self.acquire(timeout=0, shared=shared)
+
+    def acquire_all(self, names, timeout=None, shared=False):
+        """Acquires all the locks `names` or none, like
+        `LockerClient.acquire_all`, with one request per shard"""
+        deadline = None if timeout is None else time.time() + timeout
+        for attempt in range(self.MAX_REROUTES + 1):
+            taken = []
+            try:
+                for url, shard_names in self._route(names):
+                    remaining = None
+                    if deadline is not None:
+                        remaining = max(0, deadline - time.time())
+                    client = self._client(url)
+                    if not client.acquire_all(shard_names, remaining,
+                                              shared):
+                        for client, shard_names in taken:
+                            client.release_all(shard_names)
+                        return False
+                    taken.append((client, shard_names))
+            except ShardMoved as e:
+                for client, shard_names in taken:
+                    client.release_all(shard_names)
+                if attempt == self.MAX_REROUTES:
+                    raise
+                self.set_shards(e.urls)
+                continue
+            for client, shard_names in taken:
+                for name in shard_names:
+                    self.tokens[name] = client.tokens[name]
+            return True
+
+    def lease_lost(self):
+        return any(client.lease_lost() for client in self._clients.values())
+
+    def release(self):
+        """Releases lock"""
+        self.release_all([self.lock_name])
+
+    def release_all(self, names=None):
+        """Releases the locks `names`, all the locks held if `None`"""
+        for client in self._clients.values():
+            # Names are released where they were locked,
+            # even if the ring changed since
+            held = client._held
+            if names is not None:
+                held = held & set(names)
+            if held:
+                client.release_all(held)
+
+    def finalize(self):
+        for client in self._clients.values():
+            client.finalize()
+        self._clients = {}
+
+
+_heartbeat = Heartbeat()
+# numbers of the LockerClients of this process, told apart by the server
+_client_ids = itertools.count()
 
 
 def the_job(idx):
@@ -1,11 +1,28 @@
-from contextlib import closing
-from httplib import HTTPConnection
+from collections import OrderedDict, deque
 from tempfile import SpooledTemporaryFile
+import atexit
+import hashlib
+import io
 import json
+import logging
 import os.path
+import Queue
+import shutil
+import threading
+import time
+import uuid
 
-from contextlib import closing
-from httplib import HTTPConnection
+import batch
+import chunk_store
+import compression
+import versions
+from connection_pool import ConnectionPool
+
+try:
+    import zmq
+    import client_locking
+except ImportError:
+    zmq = client_locking = None
 
 class memoize:
 
@@ -63,48 +80,881 @@ def get_server(filepath, host, port):
        host & port: the address & port of a name server.
     """
 
-    with closing(HTTPConnection(host, port)) as con:
-        con.request('GET', filepath)
-        response = con.getresponse()
-        status, srv = response.status, response.read()
+    response = _pool.request(host, port, 'GET', filepath)
+    status, srv = response.status, response.data
 
     if status == 200:
         return srv
 
     return None
 
+def get_servers(filepaths, host, port):
+    """Return a dict filepath -> server owning it (None if no server owns
+       it) for all the filepaths, asked to the name server in one request.
+       host & port: the address & port of a name server.
+
+       The name server answers a POST on / of a JSON list of filepaths by
+       200 and a JSON object filepath -> server, a filepath no server owns
+       being null or left out. Fall back to one request per file if it
+       answers anything else, e.g. a name server that doesn't answer
+       batches.
+    """
+
+    if len(filepaths) == 1:
+        return {filepaths[0]: get_server(filepaths[0], host, port)}
+
+    response = _pool.request(host, port, 'POST', '/', json.dumps(filepaths),
+                             {'Content-Type': 'application/json'})
+    status, body = response.status, response.data
+
+    if status == 200:
+        try:
+            servers = json.loads(body)
+        except ValueError:
+            servers = None
+
+        if isinstance(servers, dict):
+            return dict((fp, servers.get(fp)) for fp in filepaths)
+
+    return dict((fp, get_server(fp, host, port)) for fp in filepaths)
+
+class Locations:
+    """A cache of the servers owning the files, as told by the name
+       server. The files no server owns are cached too, for negative_ttl
+       seconds instead of ttl.
+
+       The name server may answer the servers holding a replica of a file,
+       separated by commas, the first one owning it.
+    """
+
+    def __init__(self, ttl, negative_ttl):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # filepath -> (server or None, expiry)
+        self.entries = {}
+        self._pruned_size = 0
+        self._lock = threading.Lock()
+
+    def get(self, filepath):
+        """Return the server owning filepath, or None."""
+
+        return self.get_many([filepath])[filepath]
+
+    def get_replicas(self, filepath):
+        """Return the servers holding a replica of filepath, the one owning
+           it first, or [] if no server owns it.
+        """
+
+        srv = self._resolve([filepath])[filepath]
+        return srv.split(',') if srv else []
+
+    def get_many(self, filepaths):
+        """Return a dict filepath -> server owning it (or None), asking the
+           name server in one request for the files not in the cache.
+        """
+
+        return dict((filepath, srv.split(',')[0] if srv else None)
+                    for filepath, srv in self._resolve(filepaths).items())
+
+    def _resolve(self, filepaths):
+        now = time.time()
+        found = {}
+
+        with self._lock:
+            for filepath in filepaths:
+                entry = self.entries.get(filepath)
+                if entry is not None and entry[1] > now:
+                    found[filepath] = entry[0]
+
+        missing = list(set(filepaths) - set(found))
+        if not missing:
+            return found
+
+        host, port = get_host_port(_config['directoryserver'])
+        servers = get_servers(missing, host, port)
+
+        with self._lock:
+            for filepath, srv in servers.items():
+                ttl = self.ttl if srv is not None else self.negative_ttl
+                self.entries[filepath] = (srv, now + ttl)
+
+            if len(self.entries) > 2 * self._pruned_size + 1024:
+                self._prune(now)
+
+        found.update(servers)
+        return found
+
+    def prefetch(self, filepaths):
+        """Resolve filepaths in a background thread, so they're already in
+           the cache when they're opened. Return the thread.
+        """
+
+        t = threading.Thread(target=self.get_many, args=(list(filepaths),))
+        t.daemon = True
+        t.start()
+
+        return t
+
+    def invalidate(self, filepath):
+        """Forget the server owning filepath, e.g. when it answered that
+           it doesn't serve it anymore.
+        """
+
+        with self._lock:
+            self.entries.pop(filepath, None)
+
+    def _prune(self, now):
+        for filepath, (srv, expires) in self.entries.items():
+            if expires <= now:
+                del self.entries[filepath]
+
+        self._pruned_size = len(self.entries)
+
+def encode(data, headers={}):
+    """Return data and headers of a request body compressed with the
+       coding of the config, if it's worth it. A body with a Content-Range
+       is sent as is, the server checking the range against its length.
+    """
+
+    coding = _config['compression']
+
+    if (not coding or 'Content-Range' in headers or
+            len(data) < _config['compression_min_size'] or
+            not compression.compressible(data)):
+        return data, headers
+
+    headers = dict(headers)
+    headers['Content-Encoding'] = coding
+    return compression.compress_string(data, coding), headers
+
+
+def accept(headers):
+    """Return headers of a read request with the Accept-Encoding of the
+       codings the responses can be decoded from, best first. The servers
+       send ranges as is, and compress the whole file only.
+    """
+
+    headers = dict(headers)
+    headers['Accept-Encoding'] = ', '.join(compression.CODINGS)
+    return headers
+
+
+def decode(response):
+    """Decompress in place the data of response from its Content-Encoding,
+       if it has one, and return response.
+    """
+
+    coding = (response.getheader('Content-Encoding') or 'identity').lower()
+
+    if coding != 'identity':
+        if not compression.supported(coding):
+            raise Error('Unsupported content coding %s.' % coding)
+        response.data = compression.decompress_string(response.data, coding)
+
+    return response
+
+
+def add_range(ranges, start, end):
+    """Add the byte range [start, end) to ranges, a sorted list of
+       disjoint ranges, merging it with the ranges it overlaps or touches.
+    """
+
+    if start >= end:
+        return
+
+    merged = []
+
+    for s, e in ranges:
+        if e < start or s > end:
+            merged.append((s, e))
+        else:
+            start, end = min(s, start), max(e, end)
+
+    merged.append((start, end))
+    merged.sort()
+    ranges[:] = merged
+
+class Cache:
+    """A LRU cache of the closed files, bounded by a number of entries and
+       a total size in bytes. A file taken from the cache leaves it until
+       it's put back when closed, so an eviction never closes a file in
+       use.
+
+       The files evicted from memory are spilled to the directory (if not
+       None), itself bounded by max_disk_size bytes, from which they can be
+       loaded back, even by another process after a restart.
+    """
+
+    def __init__(self, max_entries, max_size, directory=None,
+                 max_disk_size=None):
+
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.directory = directory
+        self.max_disk_size = max_disk_size
+
+        # filepath -> (file, size), the least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        # filepath -> file taken from the cache and not put back yet
+        self.taken = {}
+
+        # key -> size of the spilled files, loaded from the directory when
+        # it's first needed
+        self.disk = None
+        self.disk_size = 0
+
+        self.stats = dict.fromkeys(('hits', 'disk_hits', 'misses',
+                                    'evictions', 'invalidations'), 0)
+
+    def __contains__(self, filepath):
+        return filepath in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, filepath):
+        """Return the file filepath if it's in memory, otherwise None."""
+
+        if filepath not in self.entries:
+            return None
+
+        self.stats['hits'] += 1
+        entry = self.entries.pop(filepath)
+        self.entries[filepath] = entry
+
+        return entry[0]
+
+    def take(self, filepath):
+        """Remove the file filepath from the memory and return it, or None
+           if it isn't there. It's put back by put().
+        """
+
+        f = self.get(filepath)
+
+        if f is not None:
+            self.size -= self.entries.pop(filepath)[1]
+            self.taken[filepath] = f
+
+        return f
+
+    def load(self, filepath):
+        """Return a tuple (metadata, path) of the file filepath spilled to
+           the disk, or None if it isn't there.
+        """
+
+        key = self._key(filepath)
+
+        if key not in self._disk_index():
+            self.stats['misses'] += 1
+            return None
+
+        self.stats['disk_hits'] += 1
+        self.disk[key] = self.disk.pop(key)
+
+        data, meta = self._paths(key)
+        os.utime(data, None)
+
+        with io.open(meta, 'rb') as m:
+            return json.loads(m.read()), data
+
+    def put(self, filepath, f):
+        """Add or refresh the file f in the cache, evicting the least
+           recently used files if the cache is over its bounds.
+        """
+
+        self.taken.pop(filepath, None)
+
+        if filepath in self.entries:
+            old, size = self.entries.pop(filepath)
+            self.size -= size
+            if old is not f:
+                SpooledTemporaryFile.close(old)
+
+        f.seek(0, 2)
+        size = f.tell()
+
+        self.entries[filepath] = (f, size)
+        self.size += size
+
+        while self.entries and (len(self.entries) > self.max_entries or
+                                self.size > self.max_size):
+            self.evict()
+
+    def evict(self):
+        """Spill the least recently used file to the disk and close it."""
+
+        filepath, (f, size) = self.entries.popitem(last=False)
+        self.size -= size
+        self.stats['evictions'] += 1
+
+        if self.directory is not None:
+            self.spill(filepath, f)
+
+        SpooledTemporaryFile.close(f)
+
+    def revoke(self, filepath):
+        """End the lease of the file filepath if it's in memory, so it's
+           revalidated the next time it's asked.
+        """
+
+        entry = self.entries.get(filepath)
+        if entry is not None:
+            entry[0].lease_expires = 0
+
+        if filepath in self.taken:
+            self.taken[filepath].lease_expires = 0
+
+    def discard(self, filepath):
+        """Remove the file filepath from the memory and from the disk. A
+           file taken isn't closed, only not put back.
+        """
+
+        self.stats['invalidations'] += 1
+        self.taken.pop(filepath, None)
+
+        if filepath in self.entries:
+            f, size = self.entries.pop(filepath)
+            self.size -= size
+            SpooledTemporaryFile.close(f)
+
+        key = self._key(filepath)
+        if key in self._disk_index():
+            self._unlink(key)
+
+    def spill(self, filepath, f):
+        """Write the file f and its metadata to the cache directory."""
+
+        key = self._key(filepath)
+        index = self._disk_index()
+        data, meta = self._paths(key)
+
+        if key in index:
+            self._unlink(key)
+
+        f.seek(0)
+        # open is the DFS File in this module, io.open is the local one
+        with io.open(data + '.part', 'wb') as d:
+            shutil.copyfileobj(f, d)
+            size = d.tell()
+
+        with io.open(meta + '.part', 'wb') as m:
+            m.write(json.dumps({
+                'filepath': filepath,
+                'etag': f.etag,
+                'last_modified': f.last_modified,
+                'size': size,
+            }))
+
+        os.rename(data + '.part', data)
+        os.rename(meta + '.part', meta)
+
+        index[key] = size
+        self.disk_size += size
+
+        while (self.max_disk_size is not None and
+                self.disk_size > self.max_disk_size):
+            self._unlink(next(iter(index)))
+
+    def close(self):
+        """Spill all the files in memory to the disk."""
+
+        while self.entries:
+            filepath, (f, size) = self.entries.popitem(last=False)
+            if self.directory is not None:
+                self.spill(filepath, f)
+            SpooledTemporaryFile.close(f)
+
+        self.size = 0
+
+    def _key(self, filepath):
+        return hashlib.sha1(filepath).hexdigest()
+
+    def _paths(self, key):
+        return (os.path.join(self.directory, key + '.data'),
+                os.path.join(self.directory, key + '.json'))
+
+    def _unlink(self, key):
+        self.disk_size -= self.disk.pop(key)
+
+        for p in self._paths(key):
+            if os.path.exists(p):
+                os.unlink(p)
+
+    def _disk_index(self):
+        """Return the index of the spilled files, the least recently used
+           first, reading the cache directory if it's not loaded yet.
+        """
+
+        if self.disk is not None:
+            return self.disk
+
+        self.disk = OrderedDict()
+        self.disk_size = 0
+
+        if self.directory is None:
+            return self.disk
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        spilled = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+
+            data, meta = self._paths(name[:-len('.json')])
+            if os.path.exists(data):
+                st = os.stat(data)
+                spilled.append((st.st_mtime, name[:-len('.json')],
+                                st.st_size))
+
+        for mtime, key, size in sorted(spilled):
+            self.disk[key] = size
+            self.disk_size += size
+
+        return self.disk
+
+class Invalidations(threading.Thread):
+    """Listen to the invalidations published by the file servers and
+       revoke the leases of the files of the cache they concern.
+
+       A subscription is only live once the server sent its welcome
+       message, the invalidations published before are lost: a lease
+       granted before then can't be trusted.
+    """
+
+    POLL_TIMEOUT = 100  # ms
+    # sent first to every subscriber, not a path
+    WELCOME = 'WELCOME'
+
+    def __init__(self, cache):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.cache = cache
+        self.urls = set()
+        # url -> time its subscription was known to be live
+        self.ready = {}
+        self._pending = Queue.Queue()
+
+    def connect(self, url, since):
+        """Subscribe to the invalidation channel url of a file server.
+           Return False if the invalidations published since the time
+           since can't all be received, in which case the leases granted
+           since mustn't be trusted.
+        """
+
+        if zmq is None:
+            return False
+
+        if url not in self.urls:
+            self.urls.add(url)
+            self._pending.put(url)
+
+            if not self.is_alive():
+                self.start()
+
+        return self.ready.get(url, since) < since
+
+    def run(self):
+        # one socket per server, to tell whose welcome is received
+        sockets = {}
+        poller = zmq.Poller()
+
+        while True:
+            while not self._pending.empty():
+                url = self._pending.get()
+                socket_ = zmq.Context.instance().socket(zmq.SUB)
+                socket_.setsockopt(zmq.SUBSCRIBE, b'')
+                socket_.connect(url)
+                sockets[socket_] = url
+                poller.register(socket_, zmq.POLLIN)
+
+            for socket_, event in poller.poll(self.POLL_TIMEOUT):
+                filepath = socket_.recv_string()
+                if filepath == self.WELCOME:
+                    self.ready.setdefault(sockets[socket_], time.time())
+                else:
+                    self.cache.revoke(filepath)
+
 class Error(IOError):
 
     pass
 
+class Latencies:
+    """The latencies of the last requests, to tell when a request is slower
+       than most of them.
+    """
+
+    def __init__(self, size=1000):
+        self.samples = deque(maxlen=size)
+        self._sorted = []
+        # samples added, sorted again every 50 once there are enough
+        self._added = 0
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self.samples.append(seconds)
+            self._added += 1
+            if self._added % 50 == 0 or self._added < 50:
+                self._sorted = sorted(self.samples)
+
+    def percentile(self, p):
+        """Return the latency under which are the fraction p of the last
+           requests, None if there are too few of them to tell.
+        """
+
+        with self._lock:
+            if len(self._sorted) < 20:
+                return None
+            return self._sorted[min(len(self._sorted) - 1,
+                                    int(len(self._sorted) * p))]
+
+def get_version(response):
+    """Return the version vector of the X-Version header of response, {}
+       if it has none or if it's malformed.
+    """
+
+    try:
+        return versions.parse(response.getheader('X-Version'))
+    except ValueError:
+        return {}
+
+def _request(results, srv, method, url, body, headers):
+    """Send a request to the server srv and put its (srv, response,
+       latency) in the queue results, or (srv, None, exception) if it
+       failed.
+    """
+
+    start = time.time()
+
+    try:
+        host, port = get_host_port(srv)
+        response = _pool.request(host, port, method, url, body, headers)
+    except Exception as e:
+        results.put((srv, None, e))
+        return
+
+    results.put((srv, response, time.time() - start))
+
+def _start_request(results, srv, method, url, body=None, headers={}):
+    t = threading.Thread(target=_request,
+                         args=(results, srv, method, url, body, headers))
+    t.daemon = True
+    t.start()
+
+def request_hedged(replicas, method, url, headers={}):
+    """Send a request to the first of the servers replicas, and to the next
+       one if it fails or if it doesn't answer within the hedge_percentile
+       of the latencies of the last ones. Return the (srv, response) of the
+       first server which answered without a server error.
+    """
+
+    results = Queue.Queue()
+    pending = list(replicas)
+    sent = failed = 0
+
+    _start_request(results, pending.pop(0), method, url, None, headers)
+    sent += 1
+
+    while True:
+        delay = (_latencies.percentile(_config['hedge_percentile']) or
+                 _config['hedge_delay'])
+
+        try:
+            srv, response, latency = results.get(
+                timeout=delay if pending else None)
+        except Queue.Empty:
+            # the request is slower than most, ask another replica too
+            _start_request(results, pending.pop(0), method, url, None,
+                           headers)
+            sent += 1
+            continue
+
+        if response is not None and response.status < 500:
+            _latencies.add(latency)
+            return srv, response
+
+        if response is not None:
+            latency = '%s %s' % (response.status, response.reason)
+
+        failed += 1
+        if pending:
+            _start_request(results, pending.pop(0), method, url, None,
+                           headers)
+            sent += 1
+        elif failed == sent:
+            raise Error('No replica of %s answered (%s).' % (url, latency))
+
+def request_quorum(replicas, count, method, url, body=None, headers={},
+                   statuses=(200, 204, 206)):
+    """Send a request to all the servers replicas at once, and return the
+       (srv, response) of the first count of them which answered with one
+       of the statuses. The others go on in the background. Raise an Error
+       if fewer than count of them can.
+    """
+
+    results = Queue.Queue()
+    for srv in replicas:
+        _start_request(results, srv, method, url, body, headers)
+
+    answers = []
+    failed = 0
+
+    while len(answers) < count:
+        if failed > len(replicas) - count:
+            raise Error('Only %d of the %d replicas of %s answered %s.'
+                        % (len(answers), len(replicas), url, method))
+
+        srv, response, latency = results.get()
+
+        if response is not None and response.status in statuses:
+            if method in ('GET', 'HEAD'):
+                _latencies.add(latency)
+            answers.append((srv, response))
+        else:
+            failed += 1
+
+    return answers
+
+class ReadAhead(threading.Thread):
+    """Download a File by ranges of read_ahead_range bytes in the
+       background, keeping up to read_ahead bytes downloaded after the
+       position the application reads at. A read elsewhere, after a seek,
+       moves the download there.
+    """
+
+    def __init__(self, f, size, loaded):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.f = f
+        self.size = size
+        self.range_size = _config['read_ahead_range']
+        self.window = _config['read_ahead']
+        # byte ranges downloaded, the next byte to download and the
+        # position of the last read
+        self.loaded = []
+        add_range(self.loaded, 0, loaded)
+        self.next = loaded
+        self.position = 0
+        self.error = None
+        self.stopped = False
+        self._cond = threading.Condition()
+
+    def complete(self):
+        return self.size == 0 or self.loaded == [(0, self.size)]
+
+    def wait(self, start, end):
+        """Wait until the bytes [start, end) are downloaded. Raise the
+           Error of the download if it failed.
+        """
+
+        end = min(end, self.size)
+
+        with self._cond:
+            while True:
+                missing = self._missing(start, end)
+                if missing is None:
+                    return
+
+                if self.error is not None:
+                    raise self.error
+
+                # the window of the download starts at the first byte
+                # waited for, and the download jumps there if it's far
+                if not self.next <= missing < self.next + self.window:
+                    self.next = missing
+                self.position = missing
+
+                self._cond.notify_all()
+                self._cond.wait()
+
+    def stop(self):
+        with self._cond:
+            self.stopped = True
+            self._cond.notify_all()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self.stopped:
+                        return
+
+                    start = self._missing(self.next, self.size)
+                    if (start is not None and
+                            start < self.position + self.window):
+                        break
+                    self._cond.wait()
+
+                end = min(start + self.range_size, self.size)
+                for s, e in self.loaded:
+                    if start < s < end:
+                        end = s
+                self.next = start
+
+            try:
+                data = self.f._get_range(start, end)
+                self.f._store(start, data)
+            except Exception as e:
+                with self._cond:
+                    self.error = e if isinstance(e, Error) else Error(str(e))
+                    self._cond.notify_all()
+                return
+
+            with self._cond:
+                add_range(self.loaded, start, start + len(data))
+                if self.next == start:
+                    self.next = start + len(data)
+                self._cond.notify_all()
+
+    def _missing(self, start, end):
+        """Return the first byte of [start, end) not downloaded yet, or
+           None if they all are.
+        """
+
+        for s, e in self.loaded:
+            if s <= start < e:
+                start = e
+
+        return start if start < end else None
+
+class WriteBehind(threading.Thread):
+    """Commit the changes of a File in the background, so flush() doesn't
+       wait for the server. The flushes done while a commit is being sent
+       are coalesced in the next one.
+    """
+
+    def __init__(self, f):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.f = f
+        self.pending = False
+        self.busy = False
+        self.error = None
+        self.stopped = False
+        self._cond = threading.Condition()
+
+    def schedule(self):
+        """Commit the changes of the file as soon as possible."""
+
+        with self._cond:
+            self.pending = True
+            self._cond.notify_all()
+
+            if not self.is_alive():
+                self.start()
+
+    def wait(self):
+        """Wait until the changes flushed so far are committed, and raise
+           the Error of a commit which failed since the last wait.
+        """
+
+        with self._cond:
+            while self.pending or self.busy:
+                self._cond.wait()
+
+            error, self.error = self.error, None
+
+        if error is not None:
+            raise error
+
+    def stop(self):
+        with self._cond:
+            self.stopped = True
+            self._cond.notify_all()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self.pending and not self.stopped:
+                    self._cond.wait()
+
+                if not self.pending:
+                    return
+
+                self.pending = False
+                self.busy = True
+
+            try:
+                self.f.commit()
+            except Exception as e:
+                with self._cond:
+                    if self.error is None:
+                        self.error = (e if isinstance(e, Error)
+                                      else Error(str(e)))
+            finally:
+                with self._cond:
+                    self.busy = False
+                    self._cond.notify_all()
+
 class File(SpooledTemporaryFile):
     """Is a distant file, it's stored in memory if it size if less than
        the max_size parameter, otherwise it's stored on the disk.
+
+       A file opened for reading is downloaded by ranges as it's read, see
+       ReadAhead. With write_behind, flush() sends the changes in the
+       background and fsync() waits until they're on the server; close()
+       waits for them too.
     """
 
-    def __init__(self, filepath, mode='rtc'):
-        """filepath: the path of the distant file"""
+    def __init__(self, filepath, mode='rtc', fetch=True):
+        """filepath: the path of the distant file
+           fetch: whether to download it, when opened for reading only
+        """
 
         self.mode = mode
         self.filepath = filepath
-        host, port = get_host_port()
-        self.srv = get_server(filepath, host, port)
+        self.srv = _locations.get(filepath)
 
         if self.srv is None:
             raise Error('Impossible to find a server that serve %s.'
                     % filepath)
 
         self.last_modified = None
-        SpooledTemporaryFile.__init__(self, _config['max_size'], mode.replace('c', ''))
+        self.etag = None
+        # byte ranges written since the last commit, and the size of the
+        # file on the server after the last commit
+        self.dirty = []
+        self.committed_size = 0
+        # until when the file can be read from the cache without asking
+        # the server
+        self.lease_expires = 0
+        # version vector of the file as last read or written, and the
+        # server it's read from
+        self.version = {}
+        self.read_srv = self.srv
+        # guards the position of the file, shared with the background
+        # downloads and commits
+        self._io = threading.RLock()
+        self._committing = threading.Lock()
+        self._reader = None
+        self._writer = None
+        self._lock = None
+        # size of the file on the replicas before the appends, in quorum
+        # mode
+        self._append_base = 0
+        # the local copy is written with the data downloaded whatever the
+        # mode
+        SpooledTemporaryFile.__init__(self, _config['max_size'], 'w+b')
 
         if 'a' in mode or 'w' in mode:
-            # automatically gets a lock if we're in write/append mode
-            host, port = utils.get_host_port(_config['lockserver'])
-            self.lock_id = int(utils.get_lock(filepath, host, port))
+            # automatically gets a lock if we're in write/append mode, its
+            # fencing token telling the servers about stale writers
+            if client_locking is None:
+                raise Error('Writing %s needs the lock service, and zmq.'
+                            % filepath)
+            self._lock = client_locking.LockerClient(_config['lockserver'],
+                                                     filepath)
+            self._lock.acquire()
+            self.lock_id = self._lock.token
 
+            if _config['write_behind']:
+                self._writer = WriteBehind(self)
+        elif fetch:
+            self._open_remote()
 
-        if 'c' in mode:
-            File._cache[filepath] = self
 
     def __exit__(self, exc, value, tb):
         """Send the change to the DFS, and close the file."""
@@ -117,57 +967,511 @@ class File(SpooledTemporaryFile):
         return False
 
     def close(self):
-        """Send the change to the DFS, and close the file."""
+        """Send the change to the DFS, wait until it's there, release the
+           lock of the file, and close the file. A file opened in cache mode
+           is kept open in the cache instead, unless it wasn't read
+           entirely.
+        """
 
-        self.flush()
+        try:
+            self.flush()
+            self.fsync()
+        finally:
+            self._unlock()
 
-        if 'c' not in self.mode:
+        if self._writer is not None:
+            self._writer.stop()
+
+        if self._reader is not None:
+            self._reader.stop()
+
+            if not self._reader.complete():
+                SpooledTemporaryFile.close(self)
+                return
+
+        if 'c' in self.mode:
+            File._cache.put(self.filepath, self)
+        else:
             SpooledTemporaryFile.close(self)
 
+    def _unlock(self):
+        if self._lock is None:
+            return
+
+        lock, self._lock = self._lock, None
+        try:
+            lock.release()
+        finally:
+            lock.finalize()
+
     def flush(self):
-        """Flush the data to the server."""
+        """Flush the data to the server, in the background with
+           write_behind.
+        """
 
         SpooledTemporaryFile.flush(self)
-        self.commit()
+
+        if self._writer is not None:
+            self._writer.schedule()
+        else:
+            self.commit()
+
+    def fsync(self):
+        """Wait until the data flushed is on the server. Raise an Error if
+           it couldn't be sent.
+        """
+
+        if self._writer is not None:
+            self._writer.wait()
+
+    def read(self, n=-1):
+        if self._reader is not None:
+            start = self.tell()
+            if n is None or n < 0:
+                self._reader.wait(start, self._reader.size)
+            else:
+                self._reader.wait(start, start + n)
+
+        with self._io:
+            return SpooledTemporaryFile.read(self, n)
+
+    def readline(self, *args):
+        self._wait_rest()
+
+        with self._io:
+            return SpooledTemporaryFile.readline(self, *args)
+
+    def readlines(self, *args):
+        self._wait_rest()
+
+        with self._io:
+            return SpooledTemporaryFile.readlines(self, *args)
+
+    def __iter__(self):
+        self._wait_rest()
+        return SpooledTemporaryFile.__iter__(self)
+
+    def seek(self, offset, whence=0):
+        with self._io:
+            if whence == 2 and self._reader is not None:
+                return SpooledTemporaryFile.seek(self,
+                                                 self._reader.size + offset)
+
+            return SpooledTemporaryFile.seek(self, offset, whence)
+
+    def tell(self):
+        with self._io:
+            return SpooledTemporaryFile.tell(self)
+
+    def write(self, s):
+        """Write s to the file and remember the bytes written as dirty."""
+
+        with self._io:
+            if 'a' in self.mode:
+                self.seek(0, 2)
+
+            start = self.tell()
+            SpooledTemporaryFile.write(self, s)
+            add_range(self.dirty, start, self.tell())
+
+    def writelines(self, iterable):
+        for line in iterable:
+            self.write(line)
 
     def commit(self):
-        if 'a' in self.mode or 'w' in self.mode:
-            # send the file from the begining
-            self.seek(0)
-            data = self.read()
-            host, port = utils.get_host_port(self.srv)
-            with closing(HTTPConnection(host, port)) as con:
-                con.request('PUT', self.filepath + '?lock_id=%s' % self.lock_id,
-                            data)
-
-                response = con.getresponse()
-                self.last_modified = response.getheader('Last-Modified')
-                status = response.status
+        """Send the changes made since the last commit to the server.
+
+           In append mode only the data appended since the last commit is
+           sent. In write mode the whole file is sent the first time, then
+           only the dirty byte ranges, so the cost of a commit depends on
+           the size of the change and not on the size of the file.
+
+           The changes are read with the file locked, then sent without it
+           so the application can keep on writing meanwhile.
+        """
+
+        if 'a' not in self.mode and 'w' not in self.mode:
+            return
+
+        with self._committing:
+            with self._io:
+                pos = self.tell()
+                self.seek(0, 2)
+                size = self.tell()
+                dirty, self.dirty = self.dirty, []
+
+                # (method, start, end, Content-Range, If-Match)
+                changes = []
+
+                if 'a' in self.mode:
+                    if size > self.committed_size:
+                        changes.append(('PATCH', self.committed_size, size,
+                                        None, False))
+                elif _config['write_quorum'] > 1:
+                    # the replicas may differ, they all get the whole file
+                    if (self.etag is None or dirty or
+                            size != self.committed_size):
+                        changes.append(('PUT', 0, size, None, False))
+                elif self.etag is None and _config['chunked_upload']:
+                    try:
+                        self._push()
+                    except:
+                        self.dirty = dirty
+                        raise
+                elif self.etag is None:
+                    changes.append(('PUT', 0, size, None, False))
+                else:
+                    ranges = [(s, min(e, size)) for s, e in dirty if s < size]
+
+                    for start, end in ranges:
+                        changes.append(('PATCH', start, end, 'bytes %d-%d/%d'
+                                        % (start, end - 1, size), True))
+
+                    if not ranges and size != self.committed_size:
+                        changes.append(('PATCH', 0, 0, 'bytes */%d' % size,
+                                        True))
+
+                requests = []
+                for method, start, end, content_range, conditional in changes:
+                    self.seek(start)
+                    requests.append((method, self.read(end - start),
+                                     content_range, conditional))
+
+                self.seek(pos)
+
+            try:
+                for method, data, content_range, conditional in requests:
+                    headers = {}
+                    if content_range is not None:
+                        headers['Content-Range'] = content_range
+                    if conditional:
+                        headers['If-Match'] = self.etag
+                    self._send(method, data, headers)
+            except:
+                with self._io:
+                    for start, end in dirty:
+                        add_range(self.dirty, start, end)
+                raise
+
+            self.committed_size = size
+
+    def _push(self):
+        """Send the whole file to a server using a chunk store: only the
+           content-defined chunks the server doesn't have are uploaded,
+           then the file is replaced by the manifest of the chunks.
+        """
+
+        self.seek(0)
+        chunks = []
+        offset = 0
+        for chunk in chunk_store.iter_chunks(iter(lambda: self.read(64 * 1024),
+                                                  b'')):
+            chunks.append((hashlib.sha1(chunk).hexdigest(), offset,
+                           len(chunk)))
+            offset += len(chunk)
+
+        host, port = get_host_port(self.srv)
+        manifest = json.dumps({'chunks': [[digest, length] for digest,
+                                          offset, length in chunks]})
+
+        # the manifest is refused if chunks were collected in between
+        for attempt in range(2):
+            response = _pool.request(host, port, 'POST',
+                                     self.filepath + '?missing=1',
+                                     json.dumps([c[0] for c in chunks]))
+            if response.status != 200:
+                break
+
+            missing = set(json.loads(response.data))
+            for digest, offset, length in chunks:
+                if digest not in missing:
+                    continue
+                missing.discard(digest)
+                self.seek(offset)
+                data, headers = encode(self.read(length))
+                response = _pool.request(host, port, 'PUT', '%s?chunk=%s'
+                                         % (self.filepath, digest),
+                                         data, headers)
+                if response.status not in (200, 204):
+                    raise Error('Impossible to send a chunk of %s to %s '
+                                '(%s %s).' % (self.filepath, self.srv,
+                                              response.status,
+                                              response.reason))
+
+            response = _pool.request(host, port, 'PUT', self.filepath +
+                                     '?lock_id=%s&manifest=1' % self.lock_id,
+                                     manifest)
+            if response.status != 409:
+                break
+
+        self.last_modified = response.getheader('Last-Modified')
+        self.etag = response.getheader('ETag')
+
+        if response.status not in (200, 204):
+            raise Error('Impossible to send %s to %s (%s %s).'
+                        % (self.filepath, self.srv, response.status,
+                           response.reason))
+
+    def _send(self, method, data, headers={}):
+        """Send data, bytes of the file, to the server with the http method
+           and headers given, or to write_quorum of its replicas for a PUT
+           or an append with write_quorum.
+        """
+
+        if (_config['write_quorum'] > 1 and
+                (method == 'PUT' or 'a' in self.mode)):
+            return self._send_quorum(method, data, headers)
+
+        data, headers = encode(data, headers)
+
+        for attempt in range(2):
+            host, port = get_host_port(self.srv)
+            response = _pool.request(host, port, method,
+                                     self.filepath + '?lock_id=%s'
+                                     % self.lock_id, data, headers)
+
+            self.last_modified = response.getheader('Last-Modified')
+            self.etag = response.getheader('ETag')
+            status = response.status
+
+            if status != 406:
+                break
+
+            # the server doesn't serve the file anymore, ask again who does
+            _locations.invalidate(self.filepath)
+            self.srv = _locations.get(self.filepath)
+            if self.srv is None:
+                break
+
+        if status not in (200, 204):
+            raise Error('Impossible to send %s to %s (%s %s).'
+                        % (self.filepath, self.srv, status, response.reason))
+
+    def _open_remote(self):
+        """Download the first range of the file, then the next ones in the
+           background if there are more.
+        """
 
+        now = time.time()
+        headers = {}
+        if _config['read_ahead_range']:
+            headers['Range'] = 'bytes=0-%d' % (_config['read_ahead_range'] - 1)
+        self.read_srv, response = self._read_replicas('GET', accept(headers))
+        decode(response)
+
+        if response.status == 206:
+            size = int(response.getheader('Content-Range').rsplit('/', 1)[1])
+        elif response.status == 200:
+            size = len(response.data)
+        elif response.status == 416:
+            size = 0
+        else:
+            raise Error('Impossible to read %s from %s (%s %s).'
+                        % (self.filepath, self.read_srv, response.status,
+                           response.reason))
+
+        self.etag = response.getheader('ETag')
+        self.last_modified = response.getheader('Last-Modified')
+        self.version = get_version(response)
+        self.committed_size = size
+        self._renew_lease(response.getheader('X-Lease'),
+                          response.getheader('X-Invalidation'), now)
+
+        self._store(0, response.data)
+
+        if len(response.data) < size:
+            self._reader = ReadAhead(self, size, len(response.data))
+            self._reader.start()
+
+    def _get_range(self, start, end):
+        """Download the bytes [start, end) of the file, of the same version
+           as the first ones.
+        """
+
+        host, port = get_host_port(self.read_srv)
+        headers = {'Range': 'bytes=%d-%d' % (start, end - 1)}
+        if self.etag is not None:
+            headers['If-Range'] = self.etag
+
+        response = decode(_pool.request(host, port, 'GET', self.filepath,
+                                        None, accept(headers)))
+
+        if response.status == 200:
+            raise Error('%s changed on %s while it was read.'
+                        % (self.filepath, self.read_srv))
+
+        if response.status != 206:
+            raise Error('Impossible to read %s from %s (%s %s).'
+                        % (self.filepath, self.read_srv, response.status,
+                           response.reason))
+
+        return response.data
+
+    def _read_replicas(self, method, headers):
+        """Send a read request for the file to its replicas: to read_quorum
+           of them, keeping the answer of the newest version, or hedged
+           to another replica if the first one is slow. Return the server
+           which answered and its response.
+        """
+
+        replicas = _locations.get_replicas(self.filepath) or [self.srv]
+        quorum = min(_config['read_quorum'], len(replicas))
+
+        if quorum > 1:
+            answers = request_quorum(replicas, quorum, method, self.filepath,
+                                     None, headers, (200, 206, 416))
+            found = [get_version(response) for srv, response in answers]
+            best = versions.newest(found)
+
+            for (srv, response), version in zip(answers, found):
+                if not versions.descends(version, found[best]):
+                    logging.warning('The replica of %s on %s is stale.',
+                                    self.filepath, srv)
+
+            return answers[best]
+
+        if _config['hedged_reads'] and len(replicas) > 1:
+            return request_hedged(replicas, method, self.filepath, headers)
+
+        host, port = get_host_port(self.srv)
+        return self.srv, _pool.request(host, port, method, self.filepath,
+                                       None, headers)
+
+    def _send_quorum(self, method, data, headers):
+        """Send data to all the replicas of the file with the version
+           following the last one, and wait until write_quorum of them
+           stored it: the whole file for a PUT, the bytes appended since the
+           last commit for a PATCH in append mode. The first write follows
+           the versions of the replicas asked, and appends start at the end
+           of the newest one.
+        """
+
+        replicas = _locations.get_replicas(self.filepath) or [self.srv]
+        quorum = min(_config['write_quorum'], len(replicas))
+
+        if self.etag is None:
+            answers = request_quorum(replicas, quorum, 'HEAD', self.filepath,
+                                     statuses=(200, 204))
+            found = [get_version(response) for srv, response in answers]
+            self.version = versions.merge(found)
+            newest = answers[versions.newest(found)][1]
+            self._append_base = int(newest.getheader('Content-Length') or 0)
+
+        headers = dict(headers)
+        if method == 'PATCH':
+            # the same range on every replica, which a stale replica
+            # refuses instead of appending after other data
+            start = self._append_base + self.committed_size
+            headers['Content-Range'] = ('bytes %d-%d/%d' % (
+                start, start + len(data) - 1, start + len(data)))
+
+        version = versions.increment(self.version, _config['client_id'])
+        data, headers = encode(data, headers)
+        headers['X-Version'] = versions.dump(version)
+
+        answers = request_quorum(replicas, quorum, method, self.filepath +
+                                 '?lock_id=%s' % self.lock_id, data, headers,
+                                 (200, 204))
+        self.version = version
+
+        srv, response = answers[0]
+        for answer in answers:
+            if answer[0] == self.srv:
+                srv, response = answer
+
+        self.last_modified = response.getheader('Last-Modified')
+        self.etag = response.getheader('ETag')
+
+    def _store(self, start, data):
+        """Write data downloaded at the offset start, without moving the
+           position of the file.
+        """
+
+        with self._io:
+            pos = SpooledTemporaryFile.tell(self)
+            SpooledTemporaryFile.seek(self, start)
+            SpooledTemporaryFile.write(self, data)
+            SpooledTemporaryFile.seek(self, pos)
+
+    def _wait_rest(self):
+        """Wait until the file is downloaded from the position to its
+           end.
+        """
+
+        if self._reader is not None:
+            self._reader.wait(self.tell(), self._reader.size)
+
+    def _renew_lease(self, lease, url, now):
+        """Trust the cached file until now + lease seconds, if its
+           invalidations can be received from url.
+        """
+
+        if lease and url and File._invalidations.connect(url, now):
+            self.lease_expires = now + float(lease)
+
+    @staticmethod
     def from_cache(filepath):
         """Try to retrieve a file from the cache
            filepath: the path of the file to retrieve from cache.
            Return None if the file isn't in the cache or if the cache expired.
+           The file returned is out of the cache until it's closed.
         """
 
-        if filepath in File._cache:
-            f = File._cache[filepath]
+        f = File._cache.take(filepath)
 
-            host, port = get_host_port()
-            fs = get_server(filepath, host, port)
-            host, port = get_host_port(fs)
+        if f is not None and f.lease_expires > time.time():
+            f.seek(0)
+            return f
 
-            with closing(HTTPConnection(host, port)) as con:
-                con.request('HEAD', filepath)
+        if f is None:
+            spilled = File._cache.load(filepath)
+            if spilled is None:
+                return None
 
-                if (f.last_modified ==
-                        con.getresponse().getheader('Last-Modified')):
-                    f.seek(0)
-                    return f
-                else:
-                    del File._cache[filepath]
+            meta, data = spilled
+            f = File(filepath, fetch=False)
+            with io.open(data, 'rb') as d:
+                shutil.copyfileobj(d, f)
+            f.etag = meta['etag']
+            f.last_modified = meta['last_modified']
+            f.dirty = []
+            f.committed_size = meta['size']
+
+        fs = _locations.get(filepath)
+        if fs is None:
+            File._cache.discard(filepath)
+            SpooledTemporaryFile.close(f)
+            return None
+
+        host, port = get_host_port(fs)
+
+        headers = {}
+        if f.etag is not None:
+            headers['If-None-Match'] = f.etag
 
-        return None
+        now = time.time()
+        response = _pool.request(host, port, 'HEAD', filepath, None, headers)
+
+        f._renew_lease(response.getheader('X-Lease'),
+                       response.getheader('X-Invalidation'), now)
+
+        if response.status == 406:
+            # the server doesn't serve the file anymore
+            _locations.invalidate(filepath)
+            fresh = False
+        elif f.etag is not None:
+            fresh = response.status == 304
+        else:
+            fresh = (f.last_modified ==
+                     response.getheader('Last-Modified'))
+
+        if not fresh:
+            File._cache.discard(filepath)
+            SpooledTemporaryFile.close(f)
+            return None
+
+        f.seek(0)
+        return f
 
 
 def rename(filepath, newfilepath):
@@ -180,10 +1484,251 @@ def rename(filepath, newfilepath):
         unlink(filepath, f.lock_id)
 
 
+def run_batch(srv, ops):
+    """Send the operations ops, dicts of the method, path and optionally
+       the query, headers and body of a request, to the server srv in one
+       batch request. Return the (status, headers, body) of each of them in
+       order, the names of the headers in lower case. A server which doesn't
+       answer batches gets one request per operation instead.
+    """
+
+    host, port = get_host_port(srv)
+    body = b''.join(batch.encode_frame(
+        dict((k, op[k]) for k in ('method', 'path', 'query', 'headers')
+             if k in op), op.get('body', b'')) for op in ops)
+
+    response = _pool.request(host, port, 'POST', '/?batch=1', body,
+                             {'Content-Type': batch.CONTENT_TYPE})
+
+    if (response.status == 200 and
+            response.getheader('Content-Type') == batch.CONTENT_TYPE):
+        try:
+            return [(header['status'],
+                     dict((k.lower(), v)
+                          for k, v in header['headers'].items()), data)
+                    for header, data in
+                    batch.read_frames(io.BytesIO(response.data))]
+        except (ValueError, KeyError):
+            raise Error('Invalid batch response from %s.' % srv)
+
+    results = []
+    for op in ops:
+        url = op['path']
+        if op.get('query'):
+            url += '?' + op['query']
+        response = _pool.request(host, port, op['method'], url,
+                                 op.get('body'), op.get('headers', {}))
+        results.append((response.status, dict(response.getheaders()),
+                        response.data))
+
+    return results
+
+
+def run_batches(ops):
+    """Run the operations ops, one per path, grouped by the server owning
+       their path in batches of at most batch_size operations, sent in
+       parallel. An operation on a file which moved to another server is
+       sent again to the new one. Return a dict path -> (status, headers,
+       body), without the paths no server owns.
+    """
+
+    results = {}
+
+    for attempt in range(2):
+        servers = _locations.get_many([op['path'] for op in ops])
+        groups = {}
+        for op in ops:
+            srv = servers[op['path']]
+            if srv is not None:
+                groups.setdefault(srv, []).append(op)
+
+        size = _config['batch_size']
+        batches = Queue.Queue()
+        for srv, group in groups.items():
+            for i in range(0, len(group), size):
+                batches.put((srv, group[i:i + size]))
+
+        outputs = []
+
+        def send():
+            while True:
+                try:
+                    srv, group = batches.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    outputs.append((srv, group, run_batch(srv, group)))
+                except Exception as e:
+                    outputs.append((srv, group, e))
+
+        threads = [threading.Thread(target=send) for i in
+                   range(min(batches.qsize(), _config['batch_parallelism']))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        moved = []
+        for srv, group, output in outputs:
+            if isinstance(output, Exception):
+                raise Error('Impossible to send a batch to %s (%s).'
+                            % (srv, output))
+
+            for op, result in zip(group, output):
+                if result[0] == 406 and not attempt:
+                    # the server doesn't serve the file anymore
+                    _locations.invalidate(op['path'])
+                    moved.append(op)
+                else:
+                    results[op['path']] = result
+
+        ops = moved
+        if not ops:
+            break
+
+    return results
+
+
+def stat_many(filepaths):
+    """Return a dict filepath -> dict of the size, etag and last_modified
+       of the file, or None if it doesn't exist, asked in batches to the
+       servers owning the files.
+    """
+
+    results = run_batches([{'method': 'HEAD', 'path': filepath}
+                           for filepath in filepaths])
+    stats = {}
+
+    for filepath in filepaths:
+        if filepath not in results:
+            raise Error('Impossible to find a server that serve %s.'
+                        % filepath)
+
+        status, headers, body = results[filepath]
+
+        if status == 204:
+            stats[filepath] = None
+        elif status == 200:
+            stats[filepath] = {
+                'size': int(headers.get('content-length', 0)),
+                'etag': headers.get('etag'),
+                'last_modified': headers.get('last-modified'),
+            }
+        else:
+            raise Error('Impossible to stat %s (%s).' % (filepath, status))
+
+    return stats
+
+
+def open_many(filepaths, mode='rtc'):
+    """Open the files filepaths for reading and return a dict filepath ->
+       File, downloaded in batches from the servers owning them. In cache
+       mode, the files whose lease is still valid are taken from the cache,
+       and the other cached ones are only downloaded again if modified.
+    """
+
+    if 'w' in mode or 'a' in mode:
+        raise ValueError('open_many only opens files for reading.')
+
+    files = {}
+    cached = {}
+    ops = []
+
+    for filepath in filepaths:
+        f = File._cache.take(filepath) if 'c' in mode else None
+
+        if f is not None and f.lease_expires > time.time():
+            f.seek(0)
+            files[filepath] = f
+            continue
+
+        headers = {}
+        if f is not None:
+            cached[filepath] = f
+        if f is not None and f.etag is not None:
+            headers['If-None-Match'] = f.etag
+        ops.append({'method': 'GET', 'path': filepath, 'headers': headers})
+
+    now = time.time()
+    results = run_batches(ops)
+
+    for op in ops:
+        filepath = op['path']
+        if filepath not in results:
+            raise Error('Impossible to find a server that serve %s.'
+                        % filepath)
+
+        status, headers, body = results[filepath]
+
+        if status == 304 and filepath in cached:
+            f = cached.pop(filepath)
+        elif status == 200:
+            f = File(filepath, mode, fetch=False)
+            SpooledTemporaryFile.write(f, body)
+            f.etag = headers.get('etag')
+            f.last_modified = headers.get('last-modified')
+            f.committed_size = len(body)
+        else:
+            raise Error('Impossible to open %s (%s).' % (filepath, status))
+
+        if filepath in cached:
+            # the copy taken from the cache is replaced by the new one
+            File._cache.discard(filepath)
+            SpooledTemporaryFile.close(cached.pop(filepath))
+
+        f._renew_lease(headers.get('x-lease'), headers.get('x-invalidation'),
+                       now)
+
+        f.seek(0)
+        files[filepath] = f
+
+    return files
+
+
 open = File
-File._cache = {}
 _config = {
+    'directoryserver': None,
+    # url of the lock service granting the writers their fencing token
+    'lockserver': 'tcp://127.0.0.1:7899',
     'filedb': None,
-    'max_size': 1024**2
+    'max_size': 1024**2,
+    'cache_entries': 256,
+    'cache_size': 64 * 1024**2,
+    'cache_dir': os.path.expanduser('~/.cache/dfs'),
+    'cache_disk_size': 1024**3,
+    'location_ttl': 60,
+    'location_negative_ttl': 5,
+    'pool_size': 8,
+    'pool_idle_timeout': 30,
+    'chunked_upload': False,
+    # content coding of the data sent, None to send it as is
+    'compression': 'gzip',
+    'compression_min_size': 1024,
+    # operations per batch request, and batch requests sent at once
+    'batch_size': 256,
+    'batch_parallelism': 8,
+    # bytes downloaded by request, None to download files at once and
+    # compressed, and bytes downloaded ahead of the reads
+    'read_ahead_range': 1024**2,
+    'read_ahead': 4 * 1024**2,
+    # flush() sends the changes in the background, fsync() waits for them
+    'write_behind': True,
+    # replicas which must store a write, and answer a read, before it's
+    # done, and the id of this client in the version vectors
+    'write_quorum': 1,
+    'read_quorum': 1,
+    'client_id': uuid.uuid4().hex,
+    # reads sent to a second replica when slower than this percentile of
+    # the last ones, or than hedge_delay seconds until there are enough
+    'hedged_reads': True,
+    'hedge_percentile': 0.95,
+    'hedge_delay': 0.05,
 }
-File._cache = {}
\ No newline at end of file
+File._cache = Cache(_config['cache_entries'], _config['cache_size'],
+                    _config['cache_dir'], _config['cache_disk_size'])
+atexit.register(File._cache.close)
+File._invalidations = Invalidations(File._cache)
+_pool = ConnectionPool(_config['pool_size'], _config['pool_idle_timeout'])
+_locations = Locations(_config['location_ttl'],
+                       _config['location_negative_ttl'])
+_latencies = Latencies()
@@ -0,0 +1,67 @@
+"""Framing of the batch requests of the file server.
+
+A batch request or response is a sequence of frames, one per operation
+in order. A frame is the length of its JSON header and of its body, then
+the header and the body:
+
+    !II header_length body_length | header | body
+
+The header of an operation has its "method", "path" and optionally the
+"query" and "headers" of the request it stands for, the one of a result
+has its "status" and "headers".
+"""
+
+import json
+import struct
+
+CONTENT_TYPE = 'application/x-dfs-batch'
+METHODS = frozenset(['GET', 'HEAD', 'PUT', 'PATCH', 'DELETE'])
+
+_PREFIX = struct.Struct('!II')
+
+
+def encode_frame(header, body=b''):
+    return frame_prefix(header, len(body)) + body
+
+
+def frame_prefix(header, body_length):
+    """Returns the start of the frame of `header`, to be followed by a
+    body of `body_length` bytes"""
+    header = json.dumps(header).encode('utf-8')
+    return _PREFIX.pack(len(header), body_length) + header
+
+
+def _read_exactly(f, n):
+    data = f.read(n)
+    if len(data) != n:
+        raise ValueError('Truncated frame')
+    return data
+
+
+def read_frames(f):
+    """Yields the (header, body) of the frames read from the file `f`,
+    raises ValueError on a malformed frame"""
+    while True:
+        prefix = f.read(_PREFIX.size)
+        if not prefix:
+            return
+        if len(prefix) != _PREFIX.size:
+            raise ValueError('Truncated frame')
+        header_length, body_length = _PREFIX.unpack(prefix)
+        header = json.loads(_read_exactly(f, header_length).decode('utf-8'))
+        if not isinstance(header, dict):
+            raise ValueError('Frame header is not an object')
+        yield header, _read_exactly(f, body_length)
+
+
+def check_operation(header):
+    """Raises ValueError if `header` isn't the one of an operation"""
+    if header.get('method') not in METHODS:
+        raise ValueError('Unsupported method %r' % header.get('method'))
+    path = header.get('path')
+    if not isinstance(path, basestring) or not path.startswith('/'):
+        raise ValueError('Invalid path %r' % path)
+    if not isinstance(header.get('query', ''), basestring):
+        raise ValueError('Invalid query')
+    if not isinstance(header.get('headers', {}), dict):
+        raise ValueError('Invalid headers')
@@ -0,0 +1,350 @@
+"""Content-addressed storage of files as chunks, with deduplication.
+
+Files are cut by content-defined chunking: a gear hash rolls over the
+bytes and a chunk ends where its top bits are zero, so an insertion
+only changes the chunks around it and identical data gives identical
+chunks wherever it is. Chunks are stored once under their sha1, and a
+file becomes a manifest listing its chunks.
+
+The hashes are computed with numpy when it's installed, several times
+faster than byte by byte.
+"""
+
+import errno
+import hashlib
+import io
+import json
+import os
+import random
+import tempfile
+import time
+import zlib
+
+from bisect import bisect_right
+
+import compression
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MIN_SIZE = 2 * 1024
+AVG_BITS = 13  # 8KiB chunks on average
+MAX_SIZE = 64 * 1024
+
+# A manifest is MAGIC, the size of the content and a newline, then the
+# JSON of {"size": size, "chunks": [[sha1, length], ...]}
+MAGIC = b'DFS-MANIFEST 1 '
+
+_GEAR = [random.Random(0x5eed + i).getrandbits(64) for i in range(256)]
+_MASK = ((1 << AVG_BITS) - 1) << (64 - AVG_BITS)
+_BITS = (1 << 64) - 1
+if numpy is not None:
+    _GEAR_ARRAY = numpy.array(_GEAR, dtype=numpy.uint64)
+
+
+def iter_chunks(blocks, min_size=MIN_SIZE, max_size=MAX_SIZE):
+    """Yields the content-defined chunks of the data in the iterable of
+    strings `blocks`"""
+    # The cuts are searched in bulk, by windows of many chunks
+    scan = 16 * max_size
+    buf = b''
+    for block in blocks:
+        buf += block
+        start = 0
+        while len(buf) - start >= scan:
+            for length in _cuts(buf[start:start + scan], min_size, max_size):
+                yield buf[start:start + length]
+                start += length
+        buf = buf[start:]
+    while buf:
+        start = 0
+        for length in _cuts(buf[:scan], min_size, max_size,
+                            last=len(buf) <= scan):
+            yield buf[start:start + length]
+            start += length
+        buf = buf[start:]
+
+
+def _cuts(buf, min_size, max_size, last=False):
+    """Returns the lengths of the chunks `buf` starts with: a chunk ends
+    after the first hit past `min_size` bytes, or at `max_size`. Unless
+    `buf` is the `last` data, the data left after them may be cut
+    elsewhere once more arrives."""
+    hits = _hits(buf)
+    lengths = []
+    start = i = 0
+    while start < len(buf):
+        i = bisect_right(hits, start + min_size, i)
+        if i < len(hits) and hits[i] <= start + max_size:
+            end = hits[i]
+        elif start + max_size <= len(buf):
+            end = start + max_size
+        elif last:
+            end = len(buf)
+        else:
+            break
+        lengths.append(end - start)
+        start = end
+    return lengths
+
+
+def _hits(buf):
+    """Returns the sorted ends of the 64 bytes windows of `buf` whose gear
+    hash has its top AVG_BITS zero, the hash of a byte being shifted out
+    64 bytes later"""
+    if numpy is not None:
+        # Doubling the sums of the 1, 2, 4... last gears gives the hashes
+        # of all the windows in 6 vector operations
+        h = _GEAR_ARRAY[numpy.frombuffer(buf, numpy.uint8)]
+        for k in (1, 2, 4, 8, 16, 32):
+            h[k:] += h[:-k] << numpy.uint64(k)
+        return (numpy.flatnonzero(h[63:] & numpy.uint64(_MASK) == 0)
+                + 64).tolist()
+    gear = _GEAR
+    mask = _MASK
+    bits = _BITS
+    hits = []
+    h = end = 0
+    for g in map(gear.__getitem__, bytearray(buf)):
+        h = ((h << 1) + g) & bits
+        end += 1
+        if not h & mask and end >= 64:
+            hits.append(end)
+    return hits
+
+
+def dump_manifest(manifest):
+    return (MAGIC + str(manifest['size']).encode('ascii') + b'\n' +
+            json.dumps(manifest).encode('utf-8'))
+
+
+def manifest_size(p):
+    """Returns the size of the content of the manifest in the local file
+    p, or None if p is a plain file"""
+    with io.open(p, 'rb') as f:
+        line = f.readline(64)
+    if not line.startswith(MAGIC) or not line.endswith(b'\n'):
+        return None
+    return int(line[len(MAGIC):])
+
+
+def load_manifest(p):
+    """Returns the manifest in the local file p, or None if p is a plain
+    file"""
+    with io.open(p, 'rb') as f:
+        line = f.readline(64)
+        if not line.startswith(MAGIC) or not line.endswith(b'\n'):
+            return None
+        return json.loads(f.read().decode('utf-8'))
+
+
+class ChunkStore(object):
+    """ Chunks stored under `root`, as root/<2 first hex>/<sha1>
+
+    With `compress`, the chunks worth it are stored compressed with
+    zlib as root/<2 first hex>/<sha1>.z, the sha1 being the one of the
+    uncompressed data.
+
+    """
+
+    def __init__(self, root, compress=False):
+        self.root = root
+        self.compress = compress
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def has(self, digest):
+        p = self.path(digest)
+        return os.path.exists(p) or os.path.exists(p + '.z')
+
+    def missing(self, digests):
+        """Returns the `digests` not stored. The ones stored are touched,
+        so `collect` spares them until the manifest using them is
+        written."""
+        return [digest for digest in digests if not self._touch(digest)]
+
+    def _touch(self, digest):
+        """Updates the mtime of the chunk `digest`, returns `False` if
+        it's not stored"""
+        p = self.path(digest)
+        for path in (p, p + '.z'):
+            try:
+                os.utime(path, None)
+                return True
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return False
+
+    def get(self, digest):
+        p = self.path(digest)
+        if os.path.exists(p + '.z'):
+            with io.open(p + '.z', 'rb') as f:
+                return zlib.decompress(f.read())
+        with io.open(p, 'rb') as f:
+            return f.read()
+
+    def put(self, data, digest=None):
+        """Stores the chunk `data` if it's not stored yet, returns its
+        sha1. A `digest` given must be the one of `data`."""
+        actual = hashlib.sha1(data).hexdigest()
+        if digest is not None and digest != actual:
+            raise ValueError('Chunk %s has sha1 %s' % (digest, actual))
+        if self._touch(actual):
+            return actual
+        p = self.path(actual)
+        if self.compress:
+            compressed = zlib.compress(data, 1)
+            if len(compressed) < compression.MAX_RATIO * len(data):
+                data = compressed
+                p += '.z'
+        directory = os.path.dirname(p)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, tmp = tempfile.mkstemp(prefix='.', suffix='.part', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, p)
+        except:
+            os.unlink(tmp)
+            raise
+        return actual
+
+    def store(self, blocks):
+        """Stores the chunks of the data in the iterable `blocks` and
+        returns the manifest of the data."""
+        chunks = []
+        size = 0
+        for chunk in iter_chunks(blocks):
+            chunks.append([self.put(chunk), len(chunk)])
+            size += len(chunk)
+        return {'size': size, 'chunks': chunks}
+
+    def open(self, manifest):
+        return ManifestReader(self, manifest)
+
+    def collect(self, manifests, grace=3600):
+        """Deletes the chunks older than `grace` seconds that none of the
+        `manifests` refers to. Returns the number of chunks deleted.
+
+        The grace period keeps the chunks uploaded for a manifest not
+        written yet. A chunk is moved aside before it's deleted, and put
+        back if it was touched in the meantime: a `put` or `missing` after
+        the move doesn't find it and stores it again.
+
+        """
+        live = set(digest for manifest in manifests
+                   for digest, length in manifest['chunks'])
+        deleted = 0
+        if not os.path.isdir(self.root):
+            return deleted
+        deadline = time.time() - grace
+        for prefix in os.listdir(self.root):
+            directory = os.path.join(self.root, prefix)
+            for name in os.listdir(directory):
+                p = os.path.join(directory, name)
+                digest = name[:-2] if name.endswith('.z') else name
+                if name.startswith('.') or digest in live or os.path.getmtime(p) > deadline:
+                    continue
+                trash = os.path.join(directory, '.%s.trash' % name)
+                os.rename(p, trash)
+                if os.path.getmtime(trash) > deadline:
+                    os.rename(trash, p)
+                    continue
+                os.unlink(trash)
+                deleted += 1
+        return deleted
+
+
+class ManifestReader(object):
+    """ Read-only file over the chunks of a manifest """
+
+    def __init__(self, store, manifest):
+        self.store = store
+        self.manifest = manifest
+        self.size = manifest['size']
+        self.offsets = []
+        offset = 0
+        for digest, length in manifest['chunks']:
+            self.offsets.append(offset)
+            offset += length
+        self.pos = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc, value, tb):
+        self.close()
+        return False
+
+    def close(self):
+        pass
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+        self.pos = max(0, offset)
+
+    def tell(self):
+        return self.pos
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self.size - self.pos
+        data = []
+        while n > 0 and self.pos < self.size:
+            i = bisect_right(self.offsets, self.pos) - 1
+            digest, length = self.manifest['chunks'][i]
+            start = self.pos - self.offsets[i]
+            piece = self.store.get(digest)[start:start + n]
+            data.append(piece)
+            self.pos += len(piece)
+            n -= len(piece)
+        return b''.join(data)
+
+
+def fetch(pool, host, port, filepath, store, local_path):
+    """Updates `local_path` to the manifest of `filepath` on host:port,
+    only downloading the chunks missing from `store`.
+
+    Returns the number of bytes received and of bytes already stored.
+
+    """
+    response = pool.request(host, port, 'GET', filepath + '?manifest=1')
+    if response.status != 200:
+        raise IOError('Manifest of %s from %s:%s failed with %d'
+                      % (filepath, host, port, response.status))
+    manifest = json.loads(response.data)
+
+    received = reused = 0
+    for digest, length in manifest['chunks']:
+        if store.has(digest):
+            reused += length
+            continue
+        response = pool.request(host, port, 'GET',
+                                '%s?chunk=%s' % (filepath, digest))
+        if response.status != 200:
+            raise IOError('Chunk %s of %s from %s:%s failed with %d'
+                          % (digest, filepath, host, port, response.status))
+        store.put(response.data, digest)
+        received += length
+
+    fd, tmp = tempfile.mkstemp(prefix='.', suffix='.part',
+                               dir=os.path.dirname(local_path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(dump_manifest(manifest))
+        os.rename(tmp, local_path)
+    except:
+        os.unlink(tmp)
+        raise
+    return received, reused
@@ -0,0 +1,121 @@
+"""Streaming compression of transfers and of stored data.
+
+gzip is always available, zstd when the zstandard module is installed.
+Data that doesn't compress, e.g. media or archives, is detected on a
+sample compressed at the fastest level and sent as is.
+"""
+
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SAMPLE_SIZE = 64 * 1024
+# Data compressing to more than this ratio of its size isn't worth it
+MAX_RATIO = 0.9
+
+CODINGS = (('zstd',) if zstandard is not None else ()) + ('gzip',)
+
+
+def supported(coding):
+    """Tells if bodies sent with the content coding `coding` can be
+    decompressed"""
+    return (coding in ('gzip', 'deflate') or
+            (coding == 'zstd' and zstandard is not None))
+
+
+def compressible(sample):
+    """Tells if the data starting with `sample` is worth compressing"""
+    sample = sample[:SAMPLE_SIZE]
+    if not sample:
+        return False
+    return len(zlib.compress(sample, 1)) < MAX_RATIO * len(sample)
+
+
+def choose_coding(accept_encoding, codings=CODINGS):
+    """Returns the first of `codings` accepted by the Accept-Encoding
+    header `accept_encoding`, or None"""
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(','):
+        parts = item.strip().split(';')
+        q = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[parts[0].strip().lower()] = q
+    for coding in codings:
+        if coding not in CODINGS:
+            continue
+        if accepted.get(coding, accepted.get('*', 0.0)) > 0:
+            return coding
+    return None
+
+
+def _compressor(coding, level):
+    if coding == 'gzip':
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if coding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    raise ValueError('Unsupported coding %s' % coding)
+
+
+def _decompressor(coding):
+    if coding == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if coding == 'deflate':
+        return zlib.decompressobj()
+    if coding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError('Unsupported coding %s' % coding)
+
+
+def compress(blocks, coding, level=1):
+    """Yields the data of the iterable of strings `blocks` compressed
+    with `coding`"""
+    compressor = _compressor(coding, level)
+    for block in blocks:
+        data = compressor.compress(block)
+        if data:
+            yield data
+    data = compressor.flush()
+    if data:
+        yield data
+
+
+def decompress(blocks, coding, max_block=256 * 1024):
+    """Yields the data of the iterable of strings `blocks` decompressed
+    from `coding`, by blocks of at most `max_block` bytes for gzip so a
+    small body can't expand at once in memory"""
+    decompressor = _decompressor(coding)
+    bounded = coding != 'zstd'
+    for block in blocks:
+        if not bounded:
+            data = decompressor.decompress(block)
+            if data:
+                yield data
+            continue
+        while block:
+            data = decompressor.decompress(block, max_block)
+            if data:
+                yield data
+            block = decompressor.unconsumed_tail
+    if bounded:
+        data = decompressor.flush()
+        if data:
+            yield data
+
+
+def compress_string(data, coding, level=1):
+    return b''.join(compress([data], coding, level))
+
+
+def decompress_string(data, coding):
+    return b''.join(decompress([data], coding))
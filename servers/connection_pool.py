@@ -0,0 +1,130 @@
+import select
+import socket
+import threading
+import time
+
+from contextlib import contextmanager
+from httplib import HTTPConnection, HTTPException
+
+# Methods a server may receive twice with the same effect
+IDEMPOTENT = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+
+
+class ConnectionPool(object):
+    """ Keep-alive HTTP connections shared between threads, per (host, port)
+
+    At most `max_per_host` connections to one host are used at once, the
+    others wait for one to be released. Idle connections are closed after
+    `idle_timeout` seconds, and checked before being reused.
+
+    """
+
+    def __init__(self, max_per_host=8, idle_timeout=30.0, timeout=None):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = {}   # (host, port) -> [(connection, last used)]
+        self._slots = {}  # (host, port) -> semaphore of max_per_host
+        self._lock = threading.Lock()
+        self.stats = dict.fromkeys(('created', 'reused', 'discarded'), 0)
+
+    @contextmanager
+    def connection(self, host, port):
+        """Yields a connection to host:port, back to the pool on exit.
+
+        The response must be read completely before exiting, otherwise the
+        connection is closed instead of being reused.
+
+        """
+        key = (host, int(port))
+        with self._lock:
+            slots = self._slots.setdefault(
+                key, threading.BoundedSemaphore(self.max_per_host))
+
+        slots.acquire()
+        con = None
+        try:
+            con = self._get(key)
+            yield con
+        except:
+            if con is not None:
+                con.close()
+            raise
+        finally:
+            if con is not None:
+                self._put(key, con)
+            slots.release()
+
+    def request(self, host, port, method, url, body=None, headers={}):
+        """Sends a request and returns the response, its body already read
+        in `response.data`.
+
+        A request failing on a reused connection, which the server may
+        have closed in the meantime, is retried once on a new one: if it
+        couldn't be sent, or if it's idempotent, since a server may have
+        applied a request whose response was lost (e.g. a PATCH append).
+
+        """
+        for attempt in range(2):
+            with self.connection(host, port) as con:
+                retry = con.sock is not None and not attempt
+                try:
+                    con.request(method, url, body, headers)
+                except (socket.error, HTTPException):
+                    con.close()
+                    if not retry:
+                        raise
+                    continue
+                try:
+                    response = con.getresponse()
+                except (socket.error, HTTPException):
+                    con.close()
+                    if not retry or method not in IDEMPOTENT:
+                        raise
+                    continue
+                response.data = response.read()
+                return response
+
+    def close(self):
+        """Closes all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for con, used in connections:
+                con.close()
+
+    def _get(self, key):
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                con, used = idle.pop()
+                if now - used <= self.idle_timeout and self._healthy(con):
+                    self.stats['reused'] += 1
+                    return con
+                con.close()
+                self.stats['discarded'] += 1
+            self.stats['created'] += 1
+        return HTTPConnection(key[0], key[1], timeout=self.timeout)
+
+    def _put(self, key, con):
+        response = getattr(con, '_HTTPConnection__response', None)
+        if con.sock is None or (response is not None and
+                                not response.isclosed()):
+            # Closed by the server, or the response wasn't read
+            con.close()
+            return
+        with self._lock:
+            self._idle.setdefault(key, []).append((con, time.time()))
+
+    @staticmethod
+    def _healthy(con):
+        """An idle keep-alive socket is readable only if the server closed
+        it (or sent something unexpected), both making it unusable."""
+        if con.sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([con.sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
@@ -0,0 +1,196 @@
+"""Delta transfer of files, the way rsync does it.
+
+The node holding an old version of a file sends the signatures of its
+blocks: a weak rolling checksum (adler32) and a strong one (md5) per
+block. The node holding the new version slides a window over its file,
+rolling the weak checksum one byte at a time, and answers with the ops
+rebuilding the new version: COPY an old block, or DATA not found in any
+old block. Only the changed bytes cross the network.
+"""
+
+import hashlib
+import io
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+
+BLOCK_SIZE = 8 * 1024
+CHUNK_SIZE = 64 * 1024
+
+# A signature per block: weak checksum, strong checksum
+SIGNATURE = struct.Struct('!I16s')
+# An op: COPY with the index of a block, or DATA with the length of the
+# data that follows
+OP = struct.Struct('!BI')
+COPY = 0
+DATA = 1
+
+_MOD = 65521  # adler32
+
+
+def weak_checksum(block):
+    return zlib.adler32(block) & 0xffffffff
+
+
+def strong_checksum(block):
+    return hashlib.md5(block).digest()
+
+
+def signatures(f, block_size=BLOCK_SIZE):
+    """Yields the (weak, strong) checksums of the full blocks of `f`"""
+    while True:
+        block = f.read(block_size)
+        if len(block) < block_size:
+            break
+        yield weak_checksum(block), strong_checksum(block)
+
+
+def encode_signatures(sigs):
+    for weak, strong in sigs:
+        yield SIGNATURE.pack(weak, strong)
+
+
+def decode_signatures(data):
+    return [SIGNATURE.unpack_from(data, offset)
+            for offset in range(0, len(data) - SIGNATURE.size + 1,
+                                SIGNATURE.size)]
+
+
+def delta(sigs, f, block_size=BLOCK_SIZE, chunk_size=CHUNK_SIZE):
+    """Yields the ops rebuilding the file `f` from the blocks of the file
+    whose signatures are `sigs`: (COPY, index) or (DATA, bytes).
+
+    At most `chunk_size` bytes of `f` are held in memory besides the
+    current block.
+
+    """
+    blocks = {}
+    for index, (weak, strong) in enumerate(sigs):
+        blocks.setdefault(weak, {}).setdefault(strong, index)
+
+    buf = b''
+    pos = 0      # start of the window in buf
+    literal = 0  # start of the bytes of buf not sent yet
+    eof = False
+    a = b = None
+    while True:
+        if len(buf) - pos <= block_size and not eof:
+            # One byte past the window is needed to roll it
+            if literal < pos:
+                yield DATA, buf[literal:pos]
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf = buf[pos:] + chunk
+            pos = literal = 0
+            continue
+        if len(buf) - pos < block_size:
+            break
+
+        if a is None:
+            weak = weak_checksum(buf[pos:pos + block_size])
+            a, b = weak & 0xffff, weak >> 16
+        index = None
+        candidates = blocks.get((b << 16) | a)
+        if candidates:
+            index = candidates.get(
+                strong_checksum(buf[pos:pos + block_size]))
+
+        if index is not None:
+            if literal < pos:
+                yield DATA, buf[literal:pos]
+            yield COPY, index
+            pos += block_size
+            literal = pos
+            a = b = None
+        elif pos + block_size < len(buf):
+            out, in_ = ord(buf[pos]), ord(buf[pos + block_size])
+            a = (a - out + in_) % _MOD
+            b = (b - block_size * out + a - 1) % _MOD
+            pos += 1
+            if pos - literal >= chunk_size:
+                yield DATA, buf[literal:pos]
+                literal = pos
+        else:
+            break
+
+    if literal < len(buf):
+        yield DATA, buf[literal:]
+
+
+def encode_delta(ops):
+    for op, value in ops:
+        if op == COPY:
+            yield OP.pack(COPY, value)
+        else:
+            yield OP.pack(DATA, len(value)) + value
+
+
+def decode_delta(read):
+    """Yields the ops read from the stream of an `encode_delta` through
+    the `read(n)` function"""
+    while True:
+        header = read(OP.size)
+        if not header:
+            break
+        if len(header) < OP.size:
+            raise IOError('Truncated delta')
+        op, value = OP.unpack(header)
+        if op == DATA:
+            data = read(value)
+            if len(data) < value:
+                raise IOError('Truncated delta')
+            value = data
+        yield op, value
+
+
+def patch(old, ops, out, block_size=BLOCK_SIZE):
+    """Writes to `out` the file rebuilt from the blocks of the file `old`
+    and the `ops` of a delta. Returns the number of bytes copied from
+    `old` and of bytes received."""
+    copied = received = 0
+    for op, value in ops:
+        if op == COPY:
+            old.seek(value * block_size)
+            out.write(old.read(block_size))
+            copied += block_size
+        else:
+            out.write(value)
+            received += len(value)
+    return copied, received
+
+
+def fetch(pool, host, port, filepath, local_path, block_size=BLOCK_SIZE):
+    """Updates `local_path` to the version of `filepath` on host:port by
+    a delta transfer through the ConnectionPool `pool`.
+
+    The new version replaces the old one atomically. Returns the number
+    of bytes copied from the old version and of bytes received.
+
+    """
+    with io.open(local_path, 'rb') as old:
+        body = b''.join(encode_signatures(signatures(old, block_size)))
+
+    with pool.connection(host, port) as con:
+        con.request('POST', '%s?delta=%d' % (filepath, block_size), body,
+                    {'Content-Type': 'application/octet-stream'})
+        response = con.getresponse()
+        if response.status != 200:
+            response.read()
+            raise IOError('Delta of %s from %s:%s failed with %d'
+                          % (filepath, host, port, response.status))
+
+        fd, tmp = tempfile.mkstemp(prefix='.', suffix='.part',
+                                   dir=os.path.dirname(local_path))
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                with io.open(local_path, 'rb') as old:
+                    counts = patch(old, decode_delta(response.read), out,
+                                   block_size)
+            shutil.copymode(local_path, tmp)
+            os.rename(tmp, local_path)
+        except:
+            os.unlink(tmp)
+            raise
+    return counts
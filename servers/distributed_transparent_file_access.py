@@ -1,14 +1,33 @@
 #-*- coding: utf-8 -*-
 
+import datetime
+import hashlib
+import io
+import json
 import logging
 import os.path
+import re
+import shutil
+import tempfile
+import threading
 import time
-
-from contextlib import closing
-from httplib import HTTPConnection
+from stat import S_ISDIR
 
 import web
 
+import batch
+import chunk_store
+import compression
+import delta
+import runtime
+import versions
+from connection_pool import ConnectionPool
+
+try:
+    import zmq
+except ImportError:
+    zmq = None
+
 def get_local_path(filepath):
     """Convert the filepath url to an absolute path in the FS."""
 
@@ -17,73 +36,1129 @@ def get_local_path(filepath):
 
 def raise_if_dir_or_not_servable(filepath):
     """Raise a 406 notacceptable if the filepath isn't supposed to be
-       served, or if it's a directory.
+       served, or if it's a directory or the version of a file.
     """
 
-    p = get_local_path(filepath)
-
     if (os.path.dirname(filepath) not in _config['directories'] or
-            os.path.isdir(p)):
+            versions.is_sidecar(filepath) or
+            _metadata.get(filepath).isdir):
         raise web.notacceptable()
 
 
 def raise_if_not_exists(filepath):
-    """Raise a 204 No Content if the file doesn't exists."""
+    """Raise a 204 No Content if the file doesn't exists, otherwise return
+       its Metadata.
+    """
 
-    p = get_local_path(filepath)
+    meta = _metadata.get(filepath)
 
-    if not os.path.exists(p):
+    if meta.st is None:
         raise web.webapi.HTTPError('204 No Content',
                                    {'Content-Type': 'plain/text'})
 
+    return meta
+
+
+def get_etag(st, coding=None):
+    """Return a strong ETag for the os.stat result st, built from the
+       size and the modification time in nanoseconds, and from the content
+       coding of the representation if it's not sent as is.
+    """
+
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 10**9)
+
+    if coding is not None:
+        return '"%x-%x-%s"' % (st.st_size, mtime_ns, coding)
+
+    return '"%x-%x"' % (st.st_size, mtime_ns)
+
+
+def etag_matches(tags, st):
+    """Tell if one of the comma separated ETags tags, or *, is the ETag of
+       the os.stat result st, whatever the content coding it was sent with,
+       weak or not: the coding suffix of get_etag is stripped before.
+    """
+
+    etag = get_etag(st)
+
+    for tag in tags.split(','):
+        tag = tag.strip()
+        if tag == '*':
+            return True
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        size_mtime = tag.strip('"').split('-', 2)[:2]
+        if '"%s"' % '-'.join(size_mtime) == etag:
+            return True
+
+    return False
+
+
+class ContentStat(object):
+    """The os.stat result of a manifest, with the size of its content."""
+
+    def __init__(self, st, size):
+        self._st = st
+        self.st_size = size
+
+    def __getattr__(self, name):
+        return getattr(self._st, name)
+
+
+def stat(p, st=None):
+    """Return the os.stat result of the local file p, with the size of the
+       content for a manifest of the chunk store. st is the os.stat result
+       of p if it was already read.
+    """
+
+    if st is None:
+        st = os.stat(p)
+    if _chunks is None:
+        return st
+
+    size = chunk_store.manifest_size(p)
+    if size is None:
+        return st
+
+    return ContentStat(st, size)
+
+
+def open_content(p):
+    """Open the content of the local file p for reading, from the chunk
+       store if p is a manifest.
+    """
+
+    if _chunks is not None:
+        manifest = chunk_store.load_manifest(p)
+        if manifest is not None:
+            return _chunks.open(manifest)
+
+    return open(p, 'rb')
+
+
+class Metadata(object):
+    """The local path of a filepath, its os.stat result, None if it
+       doesn't exist, and its version vector, as of the time it was checked.
+    """
+
+    def __init__(self, filepath):
+        self.p = get_local_path(filepath)
+        self.checked = time.time()
+        self.isdir = False
+
+        self.st = None
+
+        try:
+            st = os.stat(self.p)
+            if S_ISDIR(st.st_mode):
+                self.isdir = True
+            else:
+                self.st = stat(self.p, st)
+        except (IOError, OSError):
+            pass
+
+        self.version = read_version(self.p) if self.st is not None else {}
+
+
+class MetadataCache(object):
+    """Metadata of the filepaths served, so a hot GET or HEAD costs no
+       syscall before the file is opened.
+
+       Entries are checked again after ttl seconds, for the changes made
+       outside of the server, e.g. by the replicator, and dropped by
+       invalidate() on every write of the server. Every invalidate() bumps
+       a version, so the stat of a file done before a write can't be
+       cached after it.
+    """
+
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.entries = {}
+        # filepath -> version of its last invalidation
+        self.versions = {}
+        # version of the invalidations forgotten
+        self.floor = 0
+        self.version = 0
+        self.lock = threading.Lock()
+
+    def get(self, filepath):
+        """Return the Metadata of filepath, checked at most ttl seconds ago
+           and after its last write.
+        """
+
+        meta = self.entries.get(filepath)
+        if meta is not None and time.time() - meta.checked < self.ttl:
+            return meta
+
+        version = self.version
+        meta = Metadata(filepath)
+
+        with self.lock:
+            if self.versions.get(filepath, self.floor) <= version:
+                if len(self.entries) >= self.size:
+                    self.entries.clear()
+                self.entries[filepath] = meta
+
+        return meta
+
+    def invalidate(self, filepath):
+        """Drop the metadata of filepath, after a write on it."""
+
+        with self.lock:
+            self.version += 1
+            if len(self.versions) >= self.size:
+                self.versions.clear()
+                self.floor = self.version
+            self.versions[filepath] = self.version
+            self.entries.pop(filepath, None)
+
+
+def send_validators(p, coding=None, st=None):
+    """Set the Last-Modified and ETag headers of the local file p, sent
+       with the content coding given, and return its os.stat result st,
+       read again if not given.
+    """
+
+    if st is None:
+        st = stat(p)
+    web.header('Last-Modified',
+               web.httpdate(datetime.datetime.utcfromtimestamp(st.st_mtime)))
+    web.header('ETag', get_etag(st, coding))
+
+    return st
+
+
+def raise_if_not_modified(st):
+    """Raise a 304 Not Modified if the If-None-Match or, failing that, the
+       If-Modified-Since header of the request matches the os.stat result st.
+    """
+
+    env = web.ctx.env
+    if_none_match = env.get('HTTP_IF_NONE_MATCH')
+
+    if if_none_match is not None:
+        if etag_matches(if_none_match, st):
+            raise web.notmodified()
+
+        return
+
+    since = env.get('HTTP_IF_MODIFIED_SINCE')
+    if since is not None:
+        since = web.parsehttpdate(since)
+
+    if since is not None:
+        mtime = datetime.datetime.utcfromtimestamp(int(st.st_mtime))
+        if mtime <= since:
+            raise web.notmodified()
+
+
+def raise_if_precondition_failed(p):
+    """Raise a 412 Precondition Failed if the request has an If-Match
+       header that doesn't match the current ETag of the local file p.
+    """
+
+    if_match = web.ctx.env.get('HTTP_IF_MATCH')
+
+    if if_match is None:
+        return
+
+    if not os.path.exists(p):
+        raise web.preconditionfailed()
+
+    if not etag_matches(if_match, stat(p)):
+        raise web.preconditionfailed()
+
+
+def raise_if_stale_lock(filepath):
+    """Raise a 409 Conflict if the lock_id of the request, the fencing
+       token of the lock held by the writer, is older than the token of a
+       write already done on filepath: its lease has expired since.
+    """
+
+    lock_id = web.input(_method='get').get('lock_id')
+
+    try:
+        token = int(lock_id)
+    except (TypeError, ValueError):
+        return
+
+    with _fences_lock:
+        if token < _fences.get(filepath, 0):
+            raise web.conflict()
+
+        _fences[filepath] = token
+
+
+def read_version(p):
+    """Return the version vector of the local file p, {} if it has none."""
+
+    try:
+        with open(versions.sidecar(p)) as f:
+            return versions.parse(f.read())
+    except (IOError, ValueError):
+        return {}
+
+
+def get_new_version(p, partial=False):
+    """Return the version vector of the X-Version header of the request.
+       Raise a 400 if it's malformed, and a 409 Conflict if it doesn't
+       include all the writes of the version of the local file p: this
+       replica already has a newer or concurrent write. A partial write
+       must follow the version of p by exactly one write, since it only
+       makes sense on the content it was made from.
+
+       A write without X-Version, e.g. from a client without quorums, is
+       counted as a write of this server in the version of p, None if p
+       has no version.
+    """
+
+    header = web.ctx.env.get('HTTP_X_VERSION')
+
+    if header is None:
+        current = read_version(p)
+        if not current:
+            return None
+        return versions.increment(current, 'srv:%s' % _config['srv'])
+
+    try:
+        version = versions.parse(header)
+    except ValueError:
+        raise web.badrequest()
+
+    current = read_version(p)
+    if not (versions.follows(version, current) if partial
+            else versions.descends(version, current)):
+        raise web.conflict()
+
+    return version
+
+
+def write_version(p, version):
+    """Record version as the version vector of the local file p after a
+       write, and send it in the X-Version header. None drops the version
+       of p, e.g. once it's deleted.
+    """
+
+    if version is None:
+        if os.path.exists(versions.sidecar(p)):
+            os.unlink(versions.sidecar(p))
+        return
+
+    write_atomically(versions.sidecar(p), [versions.dump(version)])
+    web.header('X-Version', versions.dump(version))
+
+
+def get_content_range():
+    """Return the (start, total) of the Content-Range header of the
+       request, each of them None if missing or '*'. Return None if there's
+       no Content-Range header and raise a 400 if it's malformed or if it
+       doesn't match the length of the body.
+    """
+
+    env = web.ctx.env
+    header = env.get('HTTP_CONTENT_RANGE')
+
+    if header is None:
+        return None
+
+    try:
+        unit, spec = header.strip().split(' ', 1)
+        span, total = spec.strip().split('/')
+        assert unit == 'bytes'
+
+        total = None if total == '*' else int(total)
+        length = int(env.get('CONTENT_LENGTH') or 0)
+
+        if span == '*':
+            assert length == 0
+            return None, total
+
+        first, last = span.split('-')
+        start, end = int(first), int(last)
+        assert start <= end and end - start + 1 == length
+    except (AssertionError, ValueError):
+        raise web.badrequest()
+
+    return start, total
+
+
+def get_range(st):
+    """Return the (start, length) byte range asked by the Range header of
+       the request for a file of os.stat result st, or None if the whole
+       file must be sent. Raise a 416 if the range starts past the end of
+       the file (or asks for the last 0 bytes).
+
+       Only single ranges are honoured, a multi-range request gets the
+       whole file. An invalid range, e.g. bytes=5-2, is ignored like the
+       RFC 7233 says, and gets the whole file too. An If-Range that doesn't
+       match the current ETag also gets the whole file.
+    """
+
+    env = web.ctx.env
+    header = env.get('HTTP_RANGE', '').replace(' ', '')
+
+    if not header.startswith('bytes=') or ',' in header:
+        return None
+
+    if_range = env.get('HTTP_IF_RANGE')
+    if if_range is not None and (
+            if_range.strip() == '*' or not etag_matches(if_range, st)):
+        return None
+
+    first, sep, last = header[len('bytes='):].partition('-')
+    size = st.st_size
+
+    if not sep or not (first + last).isdigit():
+        return None
+    elif not first:
+        # bytes=-N: the last N bytes
+        start = max(size - int(last), 0)
+        end = size - 1
+    elif last and int(last) < int(first):
+        return None
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+
+    if start > end or start >= size:
+        raise web.webapi.HTTPError('416 Requested Range Not Satisfiable',
+                                   {'Content-Range': 'bytes */%d' % size})
+
+    return start, end - start + 1
+
+
+def write_at(p, offset, chunks, size=None):
+    """Write the blocks of chunks in the local file p from offset, or at
+       its end if offset is None, then resize the file to size bytes if
+       size isn't None. The file is created if it doesn't exist.
+
+       With the chunk store, the new content is chunked again: only the
+       chunks around the change are new.
+    """
+
+    if _chunks is not None:
+        write_content(p, iter_patched(p, offset, chunks, size))
+        return
+
+    flags = os.O_WRONLY | os.O_CREAT
+    if offset is None:
+        flags |= os.O_APPEND
+
+    with os.fdopen(os.open(p, flags, 0o644), 'wb') as f:
+        if offset is not None:
+            f.seek(offset)
+
+        for chunk in chunks:
+            f.write(chunk)
+
+        if size is not None:
+            f.truncate(size)
+
+
+def iter_file(p, start=0, length=None, chunk_size=None):
+    """Yield length bytes (up to the end if None) of the local file p
+       from the offset start by blocks of chunk_size bytes, so serving a
+       file never holds more than one block in memory.
+    """
+
+    chunk_size = chunk_size or _config['chunk_size']
+
+    with open_content(p) as f:
+        f.seek(start)
+
+        while length is None or length > 0:
+            n = chunk_size if length is None else min(chunk_size, length)
+            chunk = f.read(n)
+            if not chunk:
+                break
+            if length is not None:
+                length -= len(chunk)
+            yield chunk
+
+
+def get_checksums(p, chunk_size):
+    """Return the size of the local file p and the md5 of each of its
+       chunks of chunk_size bytes, as JSON, for parallel downloads.
+    """
+
+    try:
+        chunk_size = int(chunk_size)
+    except ValueError:
+        raise web.badrequest()
+
+    if chunk_size <= 0:
+        raise web.badrequest()
+
+    size = 0
+    md5 = []
+    with open_content(p) as f:
+        while True:
+            h = hashlib.md5()
+            n = 0
+            while n < chunk_size:
+                block = f.read(min(_config['chunk_size'], chunk_size - n))
+                if not block:
+                    break
+                h.update(block)
+                n += len(block)
+            if not n:
+                break
+            size += n
+            md5.append(h.hexdigest())
+
+    web.header('Content-Type', 'application/json')
+    return json.dumps({'size': size, 'md5': md5})
+
+
+def iter_request_body(chunk_size=None):
+    """Yield the body of the current request by blocks of chunk_size
+       bytes, read straight from wsgi.input instead of web.data(), and
+       decompressed if it has a Content-Encoding.
+    """
+
+    chunk_size = chunk_size or _config['chunk_size']
+    env = web.ctx.env
+    coding = env.get('HTTP_CONTENT_ENCODING', 'identity').strip().lower()
+
+    if coding == 'identity':
+        return iter_raw_request_body(chunk_size)
+
+    if not compression.supported(coding):
+        raise web.webapi.HTTPError('415 Unsupported Media Type',
+                                   {'Content-Type': 'plain/text'})
+
+    return compression.decompress(iter_raw_request_body(chunk_size), coding,
+                                  chunk_size)
+
+
+def read_request_body(max_size):
+    """Return the body of the current request, decompressed, or raise a
+       413 as soon as it's over max_size bytes.
+    """
+
+    body = io.BytesIO()
+
+    for chunk in iter_request_body():
+        body.write(chunk)
+        if body.tell() > max_size:
+            raise web.webapi.HTTPError('413 Request Entity Too Large',
+                                       {'Content-Type': 'plain/text'})
+
+    return body.getvalue()
+
+
+def spool_request_body(chunk_size=None):
+    """Receive the whole body of the current request, in memory or in a
+       temporary file if it's large, and return an iterator on its blocks
+       like iter_request_body: a body written in place must be complete
+       before the file is touched.
+    """
+
+    chunk_size = chunk_size or _config['chunk_size']
+    f = tempfile.SpooledTemporaryFile(chunk_size)
+
+    try:
+        for chunk in iter_request_body(chunk_size):
+            f.write(chunk)
+    except:
+        f.close()
+        raise
+    f.seek(0)
+
+    def iter_spooled():
+        with f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield chunk
+
+    return iter_spooled()
+
+
+def iter_raw_request_body(chunk_size):
+    """Yield the Content-Length bytes of the body of the current request,
+       and raise a 400 if the client disconnects before sending them all,
+       so that a truncated body is never written.
+    """
+
+    env = web.ctx.env
+    stream = env['wsgi.input']
+    remaining = int(env.get('CONTENT_LENGTH') or 0)
+
+    while remaining > 0:
+        chunk = stream.read(min(chunk_size, remaining))
+        if not chunk:
+            raise web.badrequest()
+        remaining -= len(chunk)
+        yield chunk
+
+
+def get_coding(p, st):
+    """Return the content coding to send the local file p, of os.stat
+       result st, with, as negotiated with the Accept-Encoding header, or
+       None to send it as is: for a Range request, a small file or data
+       that doesn't compress.
+    """
+
+    if not _config['compression']:
+        return None
+
+    env = web.ctx.env
+    web.header('Vary', 'Accept-Encoding')
+
+    coding = compression.choose_coding(env.get('HTTP_ACCEPT_ENCODING'),
+                                       _config['compression'])
+    if coding is None or 'HTTP_RANGE' in env:
+        return None
+
+    if st.st_size < _config['compression_min_size']:
+        return None
+
+    key = (p, get_etag(st))
+    if key not in _compressible:
+        if len(_compressible) > 10000:
+            _compressible.clear()
+        with open_content(p) as f:
+            _compressible[key] = compression.compressible(
+                f.read(compression.SAMPLE_SIZE))
+
+    return coding if _compressible[key] else None
+
+
+def iter_patched(p, offset, chunks, size=None):
+    """Yield the content of the local file p with the blocks of chunks
+       written at offset, or at its end if offset is None, resized to
+       size bytes if size isn't None.
+    """
+
+    old_size = stat(p).st_size if os.path.exists(p) else 0
+    if offset is None:
+        offset = old_size
+
+    def patched():
+        for block in iter_file(p, 0, min(offset, old_size)):
+            yield block
+        for i in range(old_size, offset, _config['chunk_size']):
+            yield b'\0' * min(_config['chunk_size'], offset - i)
+
+        end = offset
+        for chunk in chunks:
+            end += len(chunk)
+            yield chunk
+
+        if end < old_size:
+            for block in iter_file(p, end):
+                yield block
+
+    remaining = size
+    for block in patched():
+        if remaining is not None:
+            block = block[:remaining]
+            remaining -= len(block)
+        yield block
+
+    while remaining:
+        n = min(_config['chunk_size'], remaining)
+        remaining -= n
+        yield b'\0' * n
+
+
+def write_content(p, chunks):
+    """Replace the content of the local file p by the blocks of chunks, as
+       a manifest of the chunk store if it's used.
+    """
+
+    if _chunks is None:
+        write_atomically(p, chunks)
+        return
+
+    manifest = _chunks.store(chunks)
+    write_atomically(p, [chunk_store.dump_manifest(manifest)])
+
+
+def raise_if_no_chunk_store():
+    """Raise a 400 Bad Request for the chunk requests of a server that
+       doesn't use the chunk store."""
+
+    if _chunks is None:
+        raise web.badrequest()
+
+
+def check_digest(digest):
+    """Raise a 400 Bad Request if digest isn't a sha1, which could escape
+       the chunk store, and return it otherwise."""
+
+    if not isinstance(digest, basestring) or not _digest.match(digest):
+        raise web.badrequest()
+
+    return str(digest)
+
+
+def get_manifest(p):
+    """Return the manifest of the local file p, as JSON. A plain file is
+       stored as chunks first."""
+
+    manifest = chunk_store.load_manifest(p)
+    if manifest is None:
+        manifest = _chunks.store(iter_file(p))
+
+    web.header('Content-Type', 'application/json')
+    return json.dumps(manifest)
+
+
+def collect_chunks(grace=None):
+    """Delete the chunks that no manifest under fsroot refers to anymore,
+       except the ones stored or reused less than grace seconds ago (the
+       chunk_collect_grace of the config by default). Return the number of
+       chunks deleted."""
+
+    if grace is None:
+        grace = _config['chunk_collect_grace']
+
+    def manifests():
+        for directory, dirs, files in os.walk(_config['fsroot']):
+            for name in files:
+                try:
+                    manifest = chunk_store.load_manifest(
+                        os.path.join(directory, name))
+                except (IOError, OSError):
+                    # renamed or deleted since it was listed: its chunks
+                    # are recent enough, or not needed anymore
+                    continue
+                if manifest is not None:
+                    yield manifest
+
+    return _chunks.collect(manifests(), grace)
+
+
+def collect_chunks_forever(interval):
+    """Delete the chunks of the files deleted or overwritten every
+       interval seconds, in a daemon thread started by run_server."""
+
+    while True:
+        time.sleep(interval)
+        try:
+            deleted = collect_chunks()
+        except Exception:
+            logging.exception('Collecting the unused chunks failed.')
+            continue
+        if deleted:
+            logging.info('Deleted %d unused chunks.', deleted)
+
+
+def serve_batch():
+    """Run the operations framed in the body of the request, each as a
+       request of its own, and return their results framed in the same
+       order. A 413 is raised for a batch over the limits of the config.
+    """
+
+    body = io.BytesIO(read_request_body(_config['batch_max_size']))
+
+    try:
+        ops = list(batch.read_frames(body))
+        for op, data in ops:
+            batch.check_operation(op)
+    except ValueError:
+        raise web.badrequest()
+
+    if len(ops) > _config['batch_max_operations']:
+        raise web.webapi.HTTPError('413 Request Entity Too Large',
+                                   {'Content-Type': 'plain/text'})
+
+    web.header('Content-Type', batch.CONTENT_TYPE)
+
+    return iter_batch(ops)
+
+
+def iter_batch(ops):
+    """Yield the framed results of the operations ops, the body of a file
+       streamed from the disk after the header of its frame.
+    """
+
+    server = FileServer()
+
+    for op, data in ops:
+        status, headers, result = run_operation(server, op, data)
+        header = {'status': int(status.split()[0]), 'headers': headers}
+
+        if isinstance(result, basestring):
+            yield batch.encode_frame(header, web.safestr(result))
+        elif 'Content-Length' in headers:
+            yield batch.frame_prefix(header, int(headers['Content-Length']))
+            for chunk in result:
+                yield chunk
+        else:
+            yield batch.encode_frame(header, b''.join(result))
+
+
+def run_operation(server, op, data):
+    """Run the operation op of a batch, with data as body, by the method
+       of server handling it, as if it was a request of its own but for its
+       Host. Return its status, headers and result.
+    """
+
+    ctx = web.ctx
+    saved = ctx.env, ctx.headers, ctx.status
+
+    env = dict((k, v) for k, v in saved[0].items()
+               if not k.startswith('HTTP_') or k == 'HTTP_HOST')
+    env.update({
+        'REQUEST_METHOD': op['method'],
+        'PATH_INFO': op['path'],
+        'QUERY_STRING': op.get('query', ''),
+        'CONTENT_LENGTH': str(len(data)),
+        'wsgi.input': io.BytesIO(data),
+    })
+    for name, value in op.get('headers', {}).items():
+        env['HTTP_' + name.upper().replace('-', '_')] = str(value)
+
+    ctx.env, ctx.headers, ctx.status = env, [], '200 OK'
+
+    try:
+        try:
+            result = getattr(server, op['method'])(op['path'])
+        except web.HTTPError as e:
+            result = e.data
+        except Exception:
+            logging.exception('Batch operation %s %s failed.', op['method'],
+                              op['path'])
+            ctx.status, ctx.headers = '500 Internal Server Error', []
+            result = ''
+
+        return ctx.status, dict(ctx.headers), result
+    finally:
+        ctx.env, ctx.headers, ctx.status = saved
+
+
+def write_atomically(p, chunks):
+    """Write the blocks of chunks to a temporary file next to p, then
+       rename it over p, so readers either see the old or the new file.
+    """
+
+    fd, tmp = tempfile.mkstemp(prefix='.', suffix='.part',
+                               dir=os.path.dirname(p))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+
+        if os.path.exists(p):
+            shutil.copymode(p, tmp)
+        else:
+            os.chmod(tmp, 0o644)
+
+        os.rename(tmp, p)
+    except:
+        os.unlink(tmp)
+        raise
+
+class Leases:
+    """Read leases granted with GET and HEAD responses.
+
+       A client may serve a file from its cache without asking the server
+       until its lease expires. When a leased file is written or deleted,
+       its path is published on a zmq PUB socket, so the clients subscribed
+       drop their lease early. A lost invalidation leaves a client stale
+       for at most the TTL of the lease.
+
+       Every new subscriber first gets WELCOME, not a path, so a client
+       knows when its subscription is live: zmq drops what's published
+       before. zmq only welcomes the subscribers when the socket is used,
+       which a thread does every POLL_INTERVAL seconds.
+    """
+
+    WELCOME = 'WELCOME'
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, url, ttl):
+        self.url = url
+        self.ttl = ttl
+        # filepath -> expiry of the last lease granted on it
+        self.holders = {}
+        self._pruned_size = 0
+        self._socket = None
+        self._lock = threading.Lock()
+
+    def enabled(self):
+        return zmq is not None and self.url is not None and self.ttl > 0
+
+    def grant(self, filepath):
+        """Grant a lease on filepath and send its TTL and the url of the
+           invalidation channel in the X-Lease and X-Invalidation headers.
+        """
+
+        if not self.enabled():
+            return
+
+        with self._lock:
+            self._bind()
+            self.holders[filepath] = time.time() + self.ttl
+
+            if len(self.holders) > 2 * self._pruned_size + 1024:
+                self._prune()
+
+        host = web.ctx.host.split(':')[0]
+        web.header('X-Lease', str(self.ttl))
+        web.header('X-Invalidation', self.url.replace('*', host))
+
+    def revoke(self, filepath):
+        """Publish an invalidation of filepath if it has a valid lease."""
+
+        if not self.enabled():
+            return
+
+        with self._lock:
+            expires = self.holders.pop(filepath, 0)
+
+            if expires > time.time():
+                self._socket.send_string(filepath)
+
+    def _bind(self):
+        if self._socket is None:
+            self._socket = zmq.Context.instance().socket(zmq.XPUB)
+            self._socket.setsockopt(zmq.XPUB_WELCOME_MSG, self.WELCOME)
+            self._socket.bind(self.url)
+
+            welcomer = threading.Thread(target=self._welcome)
+            welcomer.daemon = True
+            welcomer.start()
+
+    def _welcome(self):
+        """Let zmq welcome the new subscribers, and drop their
+           subscriptions.
+        """
+
+        while True:
+            time.sleep(self.POLL_INTERVAL)
+
+            with self._lock:
+                while self._socket.poll(0):
+                    self._socket.recv()
+
+    def _prune(self):
+        now = time.time()
+
+        for filepath, expires in self.holders.items():
+            if expires <= now:
+                del self.holders[filepath]
+
+        self._pruned_size = len(self.holders)
+
 class FileServer:
 
     def GET(self, filepath):
-    
+        """Send the file, or the byte range asked by the Range header, unless
+           the conditional headers of the request show it's not modified.
+        """
+
         web.header('Content-Type', 'text/plain; charset=UTF-8')
 
         raise_if_dir_or_not_servable(filepath)
-        raise_if_not_exists(filepath)
+        meta = raise_if_not_exists(filepath)
 
-        p = get_local_path(filepath)
-        web.header('Last-Modified', time.ctime(os.path.getmtime(p)))
-        with open(p) as f:
-            return f.read()
+        p = meta.p
+        _leases.grant(filepath)
+        params = web.input(_method='get')
+        coding = None if params else get_coding(p, meta.st)
+        st = send_validators(p, coding, meta.st)
+        if meta.version:
+            web.header('X-Version', versions.dump(meta.version))
+        raise_if_not_modified(st)
+
+        if params.get('checksums') is not None:
+            return get_checksums(p, params.checksums)
+
+        if 'manifest' in params or 'chunk' in params:
+            raise_if_no_chunk_store()
+            if 'manifest' in params:
+                return get_manifest(p)
+            digest = check_digest(params.chunk)
+            if not _chunks.has(digest):
+                raise web.notfound()
+            web.header('Content-Type', 'application/octet-stream')
+            return _chunks.get(digest)
+
+        web.header('Accept-Ranges', 'bytes')
+        byte_range = get_range(st)
+
+        if byte_range is None and coding is not None:
+            web.header('Content-Encoding', coding)
+            return compression.compress(iter_file(p), coding,
+                                        _config['compression_level'])
+
+        if byte_range is None:
+            web.header('Content-Length', str(st.st_size))
+            return iter_file(p)
+
+        start, length = byte_range
+        web.ctx.status = '206 Partial Content'
+        web.header('Content-Range', 'bytes %d-%d/%d'
+                   % (start, start + length - 1, st.st_size))
+        web.header('Content-Length', str(length))
+        return iter_file(p, start, length)
 
     def PUT(self, filepath):
-        """Replace the file by the data in the request."""
+        """Replace the file by the data in the request.
+
+           With the chunk store, ?chunk=<sha1> stores one chunk instead, of
+           at most chunk_store.MAX_SIZE bytes, and ?manifest=1 replaces the
+           file by the JSON manifest in the request, with a 409 Conflict
+           listing the chunks missing if any.
+        """
 
         raise_if_dir_or_not_servable(filepath)
 
+        params = web.input(_method='get')
+        if 'chunk' in params:
+            raise_if_no_chunk_store()
+            try:
+                _chunks.put(read_request_body(chunk_store.MAX_SIZE),
+                            check_digest(params.chunk))
+            except ValueError:
+                raise web.badrequest()
+            return ''
+
         p = get_local_path(filepath)
+        raise_if_precondition_failed(p)
+        raise_if_stale_lock(filepath)
+        version = get_new_version(p)
 
-        with open(p, 'w') as f:
-            f.write(web.data())
+        if 'manifest' in params:
+            raise_if_no_chunk_store()
+            try:
+                chunks = [[check_digest(digest), int(length)]
+                          for digest, length in
+                          json.loads(b''.join(iter_request_body()))['chunks']]
+            except (ValueError, KeyError, TypeError):
+                raise web.badrequest()
+            missing = _chunks.missing(digest for digest, length in chunks)
+            if missing:
+                raise web.conflict(json.dumps(missing))
+            manifest = {'size': sum(length for digest, length in chunks),
+                        'chunks': chunks}
+            write_atomically(p, [chunk_store.dump_manifest(manifest)])
+        else:
+            write_content(p, iter_request_body())
+        write_version(p, version)
+        _metadata.invalidate(filepath)
+        _leases.revoke(filepath)
 
-        web.header('Last-Modified', time.ctime(os.path.getmtime(p)))
+        send_validators(p)
 
         return ''
 
+    def PATCH(self, filepath):
+        """Write the data in the request at the offset of its Content-Range
+           header, or append it to the file if there's no Content-Range.
+           The complete length of the Content-Range, if any, becomes the
+           size of the file, e.g. 'bytes */0' truncates the file.
+        """
+
+        raise_if_dir_or_not_servable(filepath)
+
+        p = get_local_path(filepath)
+        raise_if_precondition_failed(p)
+        raise_if_stale_lock(filepath)
+        version = get_new_version(p, partial=True)
+
+        content_range = get_content_range()
+
+        if content_range is None:
+            write_at(p, None, spool_request_body())
+        else:
+            start, total = content_range
+            write_at(p, start or 0, spool_request_body(), total)
+        write_version(p, version)
+        _metadata.invalidate(filepath)
+        _leases.revoke(filepath)
+
+        send_validators(p)
+
+        return ''
+
+    def POST(self, filepath):
+        """Send the delta rebuilding the file from the blocks of an older
+           version, whose signatures are in the request, for ?delta=<block
+           size>. The validators are the ones of the current version.
+
+           With the chunk store, ?missing=1 sends which of the chunks in
+           the JSON list of the request aren't stored yet.
+
+           ?batch=1, on any path, runs the operations framed in the request
+           and sends their results, see the batch module.
+        """
+
+        if 'batch' in web.input(_method='get'):
+            return serve_batch()
+
+        raise_if_dir_or_not_servable(filepath)
+
+        if 'missing' in web.input(_method='get'):
+            raise_if_no_chunk_store()
+            try:
+                digests = json.loads(b''.join(iter_request_body()))
+            except ValueError:
+                raise web.badrequest()
+            web.header('Content-Type', 'application/json')
+            if not isinstance(digests, list):
+                raise web.badrequest()
+            return json.dumps(_chunks.missing(map(check_digest, digests)))
+
+        raise_if_not_exists(filepath)
+
+        try:
+            block_size = int(web.input(_method='get').get('delta'))
+        except (TypeError, ValueError):
+            raise web.badrequest()
+
+        if block_size <= 0:
+            raise web.badrequest()
+
+        p = get_local_path(filepath)
+        sigs = delta.decode_signatures(b''.join(iter_request_body()))
+        send_validators(p)
+        web.header('Content-Type', 'application/octet-stream')
+
+        def iter_delta():
+            with open_content(p) as f:
+                ops = delta.delta(sigs, f, block_size, _config['chunk_size'])
+                for chunk in delta.encode_delta(ops):
+                    yield chunk
+
+        return iter_delta()
+
     def DELETE(self, filepath):
         web.header('Content-Type', 'text/plain; charset=UTF-8')
 
         raise_if_dir_or_not_servable(filepath)
         raise_if_not_exists(filepath)
+        raise_if_stale_lock(filepath)
 
-        os.unlink(get_local_path(filepath))
+        p = get_local_path(filepath)
+        os.unlink(p)
+        write_version(p, None)
+        _metadata.invalidate(filepath)
+        _leases.revoke(filepath)
         return 'OK'
 
     def HEAD(self, filepath):
-        """If the file exists, return the last-modified http
-           header which corresponds to the last time was modified."""
+        """If the file exists, return the last-modified and etag http
+           headers which correspond to the last time was modified."""
 
         web.header('Content-Type', 'text/plain; charset=UTF-8')
 
         raise_if_dir_or_not_servable(filepath)
-        raise_if_not_exists(filepath)
+        meta = raise_if_not_exists(filepath)
 
-        p = get_local_path(filepath)
-        web.header('Last-Modified', time.ctime(os.path.getmtime(p)))
+        _leases.grant(filepath)
+        st = send_validators(meta.p, st=meta.st)
+        if meta.version:
+            web.header('X-Version', versions.dump(meta.version))
+        raise_if_not_modified(st)
+
+        web.header('Accept-Ranges', 'bytes')
+        web.header('Content-Length', str(st.st_size))
         return ''
 
 
@@ -141,12 +1216,36 @@ def get_host_port(s):
     host, port = s.split(':')
     return host, int(port)
 
+
+def run_server():
+    """Serve the FileServer on the srv host:port of the config, with the
+       concurrency limits of the config, collecting the unused chunks of
+       the chunk store in the background.
+    """
+
+    logging.basicConfig(level=logging.INFO)
+
+    if _chunks is not None and _config['chunk_collect_interval'] > 0:
+        t = threading.Thread(target=collect_chunks_forever,
+                             args=(_config['chunk_collect_interval'],))
+        t.daemon = True
+        t.start()
+
+    # the reloader of web.py stats every module on every request
+    app = web.application(('(/.*)', 'FileServer'), {'FileServer': FileServer},
+                          autoreload=False)
+    runtime.serve(app.wsgifunc(), get_host_port(_config['srv']),
+                  threads=_config['server_threads'],
+                  max_reads=_config['max_reads'],
+                  max_writes=_config['max_writes'],
+                  backlog=_config['request_backlog'],
+                  queue_timeout=_config['queue_timeout'],
+                  timeout=_config['client_timeout'])
+
 def get_server(filepath, host, port):
 
-    with closing(HTTPConnection(host, port)) as con:
-        con.request('GET', filepath)
-        response = con.getresponse()
-        status, srv = response.status, response.read()
+    response = _pool.request(host, port, 'GET', filepath)
+    status, srv = response.status, response.data
 
     if status == 200:
         return srv
@@ -158,9 +1257,60 @@ _config = {
         'directories': [],
         'fsroot': 'fs/',
         'srv': None,
+        'chunk_size': 64 * 1024,
+        'lease_ttl': 30,
+        'invalidation_url': 'tcp://*:7900',
+        'pool_size': 8,
+        'pool_idle_timeout': 30,
+        'chunk_store': None,
+        'chunk_store_compression': False,
+        # seconds between two collections of the chunks no file uses, and
+        # how long a chunk stored or reused is kept anyway
+        'chunk_collect_interval': 3600,
+        'chunk_collect_grace': 3600,
+        # content codings offered to the clients, best first
+        'compression': ['gzip'],
+        'compression_level': 1,
+        'compression_min_size': 1024,
+        # connections served at once, and file reads and writes among them
+        'server_threads': 64,
+        'max_reads': 32,
+        'max_writes': 8,
+        # requests waiting for a read or write, and for how long at most
+        'request_backlog': 256,
+        'queue_timeout': 5,
+        # seconds a client may stay silent, e.g. in the middle of a body
+        'client_timeout': 10,
+        # seconds the metadata of a file is cached, and how many files
+        'metadata_ttl': 1,
+        'metadata_cache_size': 100000,
+        # bounds of a batch request, in bytes and in operations
+        'batch_max_size': 64 * 1024**2,
+        'batch_max_operations': 10000,
         }
 
 logging.info('Loading config file fileserver.dfs.json.')
 load_config(_config, 'fileserver.dfs.json')
 
 _config['directories'] = set(_config['directories'])
+
+# (local path, etag) -> whether its content is worth compressing
+_compressible = {}
+_digest = re.compile(r'^[0-9a-f]{40}$')
+
+# filepath -> greatest fencing token of the writes done on it
+_fences = {}
+_fences_lock = threading.Lock()
+
+_pool = ConnectionPool(_config['pool_size'], _config['pool_idle_timeout'])
+_leases = Leases(_config['invalidation_url'], _config['lease_ttl'])
+_metadata = MetadataCache(_config['metadata_ttl'],
+                          _config['metadata_cache_size'])
+_chunks = None
+if _config['chunk_store']:
+    _chunks = chunk_store.ChunkStore(_config['chunk_store'],
+                                     _config['chunk_store_compression'])
+
+
+if __name__ == '__main__':
+    run_server()
@@ -0,0 +1,234 @@
+"""Downloads of a file by chunks from all the nodes holding it at once.
+
+The md5 of every chunk is asked first to one of the nodes (GET with
+?checksums=<chunk size>), then the chunks are fetched with Range
+requests by a few connections per node. A node pulls the next chunk as
+soon as it's done with one, so fast nodes take most of the work, and
+once no chunk is left a fast node also asks for the chunks still in
+flight on nodes much slower than itself, the first answer winning.
+
+Every chunk is checked against its md5: a node sending bad chunks, e.g.
+because it holds another version of the file, or failing requests is
+dropped after `max_failures` of them and its chunks go to the others.
+The chunks done are saved along the partial file, so an interrupted
+download resumes where it stopped.
+"""
+
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+
+from collections import deque
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class Source(object):
+    """ A node holding the file, and how fast it sends it """
+
+    def __init__(self, node):
+        host, port = node.split(':')
+        self.node = node
+        self.host = host
+        self.port = int(port)
+        self.rate = None  # bytes/s, moving average
+        self.failures = 0
+        self.received = 0
+
+    def record(self, size, elapsed):
+        rate = size / max(elapsed, 1e-6)
+        if self.rate is None:
+            self.rate = rate
+        else:
+            self.rate = 0.7 * self.rate + 0.3 * rate
+        self.received += size
+
+
+class ChunkedDownload(object):
+    """ Downloads `filepath` from the "host:port" `nodes` to `local_path`
+
+    The file is written to `local_path + '.part'` and the chunks done to
+    `local_path + '.part.json'` until it's complete and renamed.
+
+    """
+
+    def __init__(self, pool, filepath, nodes, local_path,
+                 chunk_size=CHUNK_SIZE, connections_per_node=2,
+                 max_failures=3):
+        self.pool = pool
+        self.filepath = filepath
+        self.sources = [Source(node) for node in nodes]
+        self.local_path = local_path
+        self.part_path = local_path + '.part'
+        self.state_path = local_path + '.part.json'
+        self.chunk_size = chunk_size
+        self.connections_per_node = connections_per_node
+        self.max_failures = max_failures
+        self.checksums = []
+        self.size = 0
+        self._lock = threading.Condition()
+        self._pending = deque()
+        self._in_flight = {}  # chunk -> sources fetching it
+        self._done = set()
+        self._fd = None
+
+    def _get_checksums(self):
+        """Asks the size and the chunk md5s of the file to the nodes
+        until one answers"""
+        url = '%s?checksums=%d' % (self.filepath, self.chunk_size)
+        for source in self.sources:
+            try:
+                response = self.pool.request(source.host, source.port,
+                                             'GET', url)
+            except Exception:
+                continue
+            if response.status == 200:
+                info = json.loads(response.data)
+                return info['size'], info['md5']
+        raise IOError('No node could send the checksums of %s'
+                      % self.filepath)
+
+    def _load_state(self):
+        """Returns the chunks done by a previous download of the same
+        version"""
+        if not (os.path.exists(self.state_path) and
+                os.path.exists(self.part_path)):
+            return set()
+        try:
+            with io.open(self.state_path, 'rb') as f:
+                state = json.loads(f.read().decode('utf-8'))
+        except ValueError:
+            return set()
+        if (state.get('chunk_size') != self.chunk_size or
+                state.get('md5') != self.checksums):
+            return set()
+        return set(state['done'])
+
+    def _save_state(self):
+        os.fsync(self._fd)
+        state = {'chunk_size': self.chunk_size, 'md5': self.checksums,
+                 'done': sorted(self._done)}
+        with io.open(self.state_path + '.tmp', 'wb') as f:
+            f.write(json.dumps(state).encode('utf-8'))
+        os.rename(self.state_path + '.tmp', self.state_path)
+
+    def _fetch(self, source, chunk):
+        start = chunk * self.chunk_size
+        end = min(start + self.chunk_size, self.size) - 1
+        began = time.time()
+        response = self.pool.request(
+            source.host, source.port, 'GET', self.filepath,
+            headers={'Range': 'bytes=%d-%d' % (start, end)})
+        if response.status not in (200, 206):
+            raise IOError('Chunk %d of %s from %s failed with %d'
+                          % (chunk, self.filepath, source.node,
+                             response.status))
+        data = response.data
+        if response.status == 200:
+            data = data[start:end + 1]
+        if hashlib.md5(data).hexdigest() != self.checksums[chunk]:
+            raise IOError('Chunk %d of %s from %s is corrupted'
+                          % (chunk, self.filepath, source.node))
+        source.record(len(data), time.time() - began)
+        return data
+
+    def _next_chunk(self, source):
+        """Returns the next chunk for `source`, or `None` if there's none
+        it should fetch"""
+        if self._pending:
+            return self._pending.popleft()
+        # End game: helps the sources much slower than this one
+        for chunk, sources in self._in_flight.items():
+            if source in sources:
+                continue
+            if source.rate and all(other.rate is None or
+                                   other.rate < source.rate / 2
+                                   for other in sources):
+                return chunk
+        return None
+
+    def _work(self, source):
+        while True:
+            with self._lock:
+                if source.failures >= self.max_failures:
+                    return
+                chunk = self._next_chunk(source)
+                if chunk is None:
+                    if not self._in_flight:
+                        return
+                    # Chunks in flight elsewhere may fail and come back
+                    self._lock.wait(0.5)
+                    continue
+                self._in_flight.setdefault(chunk, set()).add(source)
+
+            try:
+                data = self._fetch(source, chunk)
+            except Exception:
+                data = None
+
+            with self._lock:
+                sources = self._in_flight.get(chunk, set())
+                sources.discard(source)
+                if data is None:
+                    source.failures += 1
+                    if chunk not in self._done and not sources:
+                        self._pending.appendleft(chunk)
+                        self._in_flight.pop(chunk, None)
+                        self._lock.notify_all()
+                    continue
+                if chunk in self._done:
+                    continue
+                os.lseek(self._fd, chunk * self.chunk_size, os.SEEK_SET)
+                os.write(self._fd, data)
+                self._done.add(chunk)
+                # The slower sources still fetching it lose the race
+                self._in_flight.pop(chunk, None)
+                self._lock.notify_all()
+                if len(self._done) % 16 == 0:
+                    self._save_state()
+
+    def run(self):
+        """Downloads the file, raises IOError if it couldn't be done.
+
+        Returns the number of bytes received from each node.
+
+        """
+        self.size, self.checksums = self._get_checksums()
+        done = self._load_state()
+        count = len(self.checksums)
+        self._done = done
+        self._pending = deque(chunk for chunk in range(count)
+                              if chunk not in done)
+
+        flags = os.O_WRONLY | os.O_CREAT
+        if not done:
+            flags |= os.O_TRUNC
+        self._fd = os.open(self.part_path, flags, 0o644)
+        try:
+            workers = [threading.Thread(target=self._work, args=(source,))
+                       for source in self.sources
+                       for i in range(self.connections_per_node)]
+            for worker in workers:
+                worker.daemon = True
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+            if len(self._done) < count:
+                self._save_state()
+                raise IOError('Download of %s stopped with %d chunks left, '
+                              'all its nodes failed'
+                              % (self.filepath, count - len(self._done)))
+            os.ftruncate(self._fd, self.size)
+            os.fsync(self._fd)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+        os.rename(self.part_path, self.local_path)
+        if os.path.exists(self.state_path):
+            os.unlink(self.state_path)
+        return dict((source.node, source.received) for source in self.sources)
@@ -0,0 +1,160 @@
+import threading
+
+from contextlib import contextmanager
+
+
+class memoryFileDb(object):
+    '''
+	In-memory FileDb, for tests and single-process setups.
+
+	It records the size of every file and the nodes holding a replica
+	of it: kn, the number of replicas of a file, is the number of its
+	nodes. Files are indexed per kn, globally and per node, so the
+	queries of the Replicator don't depend on the number of files.
+
+	Loaded with loadFileDb("memory").
+
+    '''
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        #file -> size
+        self.sizes = {}
+        #file -> set of the nodes holding it
+        self.nodes = {}
+        #kn -> set of the files with kn replicas
+        self.byKn = {}
+        #node -> {kn: set of the files of the node with kn replicas}
+        self.byNode = {}
+
+    @contextmanager
+    def batch(self):
+        '''
+        Groups updates: other threads see all of them or none.
+        '''
+        with self.lock:
+            yield self
+
+    def _index(self, file, kn, add):
+        '''
+        Adds file to (or removes it from) the indexes of kn.
+        '''
+        buckets = [self.byKn] + [self.byNode.setdefault(node, {})
+                                 for node in self.nodes[file]]
+        for bucket in buckets:
+            if add:
+                bucket.setdefault(kn, set()).add(file)
+            else:
+                bucket[kn].discard(file)
+                if not bucket[kn]:
+                    del bucket[kn]
+
+    def addFile(self, file, size, nodes=()):
+        '''
+        Adds file, or updates its size, and the nodes holding it.
+        '''
+        with self.lock:
+            if file in self.sizes:
+                self.sizes[file] = size
+            else:
+                self.sizes[file] = size
+                self.nodes[file] = set()
+                self._index(file, 0, True)
+            for node in nodes:
+                self.addNode(file, node)
+
+    def addFiles(self, files):
+        '''
+        Adds the (file, size, nodes) of files in one batch.
+        '''
+        with self.batch():
+            for file, size, nodes in files:
+                self.addFile(file, size, nodes)
+
+    def removeFile(self, file):
+        with self.lock:
+            if file not in self.sizes:
+                return
+            self._index(file, len(self.nodes[file]), False)
+            del self.sizes[file]
+            del self.nodes[file]
+
+    def addNode(self, file, node):
+        '''
+        Records a replica of file on node.
+        '''
+        with self.lock:
+            nodes = self.nodes[file]
+            if node in nodes:
+                return
+            self._index(file, len(nodes), False)
+            nodes.add(node)
+            self._index(file, len(nodes), True)
+
+    def removeNode(self, file, node):
+        '''
+        Records that node doesn't hold file anymore.
+        '''
+        with self.lock:
+            nodes = self.nodes.get(file, ())
+            if node not in nodes:
+                return
+            self._index(file, len(nodes), False)
+            nodes.remove(node)
+            self._index(file, len(nodes), True)
+
+    def getSize(self, file):
+        return self.sizes.get(file)
+
+    def getNodes(self, file):
+        return sorted(self.nodes.get(file, ()))
+
+    def getKn(self, file):
+        return len(self.nodes.get(file, ()))
+
+    def getMaxKnInNode(self, node):
+        '''
+        Returns [file] of a file of node with the most replicas, or []
+        if node holds no file.
+        '''
+        with self.lock:
+            buckets = self.byNode.get(node)
+            if not buckets:
+                return []
+            return [next(iter(buckets[max(buckets)]))]
+
+    def getFilesInNode(self, node):
+        '''
+        Yields the (file, kn, size) of the files of node.
+        '''
+        with self.lock:
+            files = [(file, kn, self.sizes[file])
+                     for kn, bucket in self.byNode.get(node, {}).items()
+                     for file in bucket]
+        return files
+
+    def selectFilesToReplicate(self, node, count=1, exclude=(), target=3):
+        '''
+        Returns the data of up to count files with less than target
+        replicas, not held by node nor in exclude, fewest replicas
+        first: dicts of "file", "nodes", "size" and "kn".
+        '''
+        selected = []
+        with self.lock:
+            for kn in sorted(self.byKn):
+                if kn >= target or len(selected) >= count:
+                    break
+                for file in self.byKn[kn]:
+                    if node in self.nodes[file] or file in exclude:
+                        continue
+                    selected.append({"file": file,
+                                     "nodes": self.getNodes(file),
+                                     "size": self.sizes[file],
+                                     "kn": kn})
+                    if len(selected) >= count:
+                        break
+        return selected
+
+    def selectFileToReplicate(self, node, target=3):
+        selected = self.selectFilesToReplicate(node, 1, (), target)
+        return selected[0] if selected else None
@@ -0,0 +1,184 @@
+import sqlite3
+import threading
+
+from contextlib import contextmanager
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    file TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    kn INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS files_kn ON files (kn);
+CREATE TABLE IF NOT EXISTS replicas (
+    file TEXT NOT NULL,
+    node TEXT NOT NULL,
+    kn INTEGER NOT NULL,
+    PRIMARY KEY (file, node)
+);
+CREATE INDEX IF NOT EXISTS replicas_node_kn ON replicas (node, kn);
+'''
+
+
+class sqliteFileDb(object):
+    '''
+	FileDb stored in an SQLite database in WAL mode.
+
+	It records the size of every file and the nodes holding a replica
+	of it: kn, the number of replicas of a file, is the number of its
+	nodes. kn is copied in the replicas rows so the index on (node, kn)
+	answers getMaxKnInNode without scanning the files of the node.
+
+	Loaded with loadFileDb("sqlite", path).
+
+    '''
+
+    def __init__(self, path="filedb.sqlite"):
+        self.path = path
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.db = sqlite3.connect(path, isolation_level=None,
+                                  check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        #WAL stays consistent on a crash, only the last commits may be lost
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    @contextmanager
+    def batch(self):
+        '''
+        Groups updates in one transaction, committed at the end of the
+        outermost batch.
+        '''
+        with self.lock:
+            if not self.depth:
+                self.db.execute("BEGIN")
+            self.depth += 1
+            try:
+                yield self
+            except:
+                self.depth -= 1
+                if not self.depth:
+                    self.db.execute("ROLLBACK")
+                raise
+            self.depth -= 1
+            if not self.depth:
+                self.db.execute("COMMIT")
+
+    def _query(self, sql, args=()):
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def _refreshKn(self, files):
+        '''
+        Recounts the replicas of files, after their nodes changed.
+        '''
+        files = [(file,) for file in files]
+        self.db.executemany(
+            "UPDATE files SET kn = (SELECT count(*) FROM replicas"
+            " WHERE replicas.file = files.file) WHERE file = ?", files)
+        self.db.executemany(
+            "UPDATE replicas SET kn = (SELECT kn FROM files"
+            " WHERE files.file = replicas.file) WHERE file = ?", files)
+
+    def addFile(self, file, size, nodes=()):
+        '''
+        Adds file, or updates its size, and the nodes holding it.
+        '''
+        self.addFiles([(file, size, nodes)])
+
+    def addFiles(self, files):
+        '''
+        Adds the (file, size, nodes) of files in one batch.
+        '''
+        files = list(files)
+        with self.batch():
+            self.db.executemany(
+                "INSERT OR IGNORE INTO files (file, size) VALUES (?, ?)",
+                [(file, size) for file, size, nodes in files])
+            self.db.executemany(
+                "UPDATE files SET size = ? WHERE file = ?",
+                [(size, file) for file, size, nodes in files])
+            self.db.executemany(
+                "INSERT OR IGNORE INTO replicas (file, node, kn)"
+                " VALUES (?, ?, 0)",
+                [(file, node) for file, size, nodes in files
+                 for node in nodes])
+            self._refreshKn(file for file, size, nodes in files if nodes)
+
+    def removeFile(self, file):
+        with self.batch():
+            self.db.execute("DELETE FROM replicas WHERE file = ?", (file,))
+            self.db.execute("DELETE FROM files WHERE file = ?", (file,))
+
+    def addNode(self, file, node):
+        '''
+        Records a replica of file on node.
+        '''
+        with self.batch():
+            self.db.execute("INSERT OR IGNORE INTO replicas (file, node, kn)"
+                            " VALUES (?, ?, 0)", (file, node))
+            self._refreshKn([file])
+
+    def removeNode(self, file, node):
+        '''
+        Records that node doesn't hold file anymore.
+        '''
+        with self.batch():
+            self.db.execute("DELETE FROM replicas WHERE file = ? AND node = ?",
+                            (file, node))
+            self._refreshKn([file])
+
+    def getSize(self, file):
+        rows = self._query("SELECT size FROM files WHERE file = ?", (file,))
+        return rows[0][0] if rows else None
+
+    def getNodes(self, file):
+        return [node for node, in self._query(
+            "SELECT node FROM replicas WHERE file = ? ORDER BY node",
+            (file,))]
+
+    def getKn(self, file):
+        rows = self._query("SELECT kn FROM files WHERE file = ?", (file,))
+        return rows[0][0] if rows else 0
+
+    def getMaxKnInNode(self, node):
+        '''
+        Returns [file] of a file of node with the most replicas, or []
+        if node holds no file.
+        '''
+        return [file for file, in self._query(
+            "SELECT file FROM replicas WHERE node = ?"
+            " ORDER BY kn DESC LIMIT 1", (node,))]
+
+    def getFilesInNode(self, node):
+        '''
+        Returns the (file, kn, size) of the files of node.
+        '''
+        return self._query(
+            "SELECT replicas.file, replicas.kn, files.size"
+            " FROM replicas JOIN files ON files.file = replicas.file"
+            " WHERE replicas.node = ?", (node,))
+
+    def selectFilesToReplicate(self, node, count=1, exclude=(), target=3):
+        '''
+        Returns the data of up to count files with less than target
+        replicas, not held by node nor in exclude, fewest replicas
+        first: dicts of "file", "nodes", "size" and "kn".
+        '''
+        rows = self._query(
+            "SELECT file, size, kn FROM files WHERE kn < ?"
+            " AND NOT EXISTS (SELECT 1 FROM replicas"
+            " WHERE replicas.file = files.file AND replicas.node = ?)"
+            " ORDER BY kn LIMIT ?", (target, node, count + len(exclude)))
+        return [{"file": file, "nodes": self.getNodes(file),
+                 "size": size, "kn": kn}
+                for file, size, kn in rows if file not in exclude][:count]
+
+    def selectFileToReplicate(self, node, target=3):
+        selected = self.selectFilesToReplicate(node, 1, (), target)
+        return selected[0] if selected else None
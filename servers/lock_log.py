@@ -0,0 +1,151 @@
+import io
+import json
+import os
+
+
+class LockLog(object):
+    """ Write-ahead log of the lock grants and releases, with snapshots
+
+    Records are `[lsn, 'G', name, id, mode, token]` for a grant,
+    `[lsn, 'U', name, id]` for a release and `[lsn, 'E', epoch]` when a
+    standby takes over from the primary, one JSON line each, appended
+    to `directory/locks.log`. They are written and fsynced by batches in
+    `commit` (aka group commit), the lock server only answering the
+    requests of a batch once it's durable.
+
+    The log also keeps the holders it describes in memory, which are
+    written to `directory/locks.snapshot` every `snapshot_every` records
+    before the log is truncated, so recovering only replays the records
+    since the last snapshot.
+
+    """
+
+    def __init__(self, directory, snapshot_every=10000):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.lsn = 0
+        self.token = 0
+        # number of the takeovers by a standby
+        self.epoch = 0
+        # name -> {id: [mode, fencing token]}
+        self.holders = {}
+        self._pending = []
+        self._since_snapshot = 0
+        self._file = None
+        self._log_path = os.path.join(directory, 'locks.log')
+        self._snapshot_path = os.path.join(directory, 'locks.snapshot')
+
+    @property
+    def pending(self):
+        return bool(self._pending)
+
+    def recover(self):
+        """Loads the last snapshot and replays the log after it
+
+        A record torn by a crash while it was written is cut off the log.
+
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        if os.path.exists(self._snapshot_path):
+            with io.open(self._snapshot_path, 'rb') as f:
+                self._load(json.loads(f.read().decode('utf-8')))
+        good = 0
+        if os.path.exists(self._log_path):
+            with io.open(self._log_path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        break
+                    good += len(line)
+                    if record[0] > self.lsn:
+                        self._apply(record)
+                        self._since_snapshot += 1
+        self._file = io.open(self._log_path, 'ab')
+        self._file.truncate(good)
+        return self
+
+    def state(self):
+        return {'lsn': self.lsn, 'token': self.token, 'epoch': self.epoch,
+                'holders': self.holders}
+
+    def _load(self, state):
+        self.lsn = state['lsn']
+        self.token = state['token']
+        self.epoch = state.get('epoch', 0)
+        self.holders = state['holders']
+
+    def _apply(self, record):
+        lsn, op = record[:2]
+        if op == 'G':
+            name, id_, mode, token = record[2:]
+            self.holders.setdefault(name, {})[id_] = [mode, token]
+            self.token = max(self.token, token)
+        elif op == 'U':
+            name, id_ = record[2:]
+            holders = self.holders.get(name, {})
+            holders.pop(id_, None)
+            if not holders:
+                self.holders.pop(name, None)
+        elif op == 'E':
+            self.epoch = record[2]
+        self.lsn = lsn
+
+    def append(self, op, *args):
+        """Logs a change, durable after the next `commit`"""
+        record = [self.lsn + 1, op] + list(args)
+        self._apply(record)
+        self._pending.append(record)
+
+    def extend(self, records):
+        """Logs the records of another log, e.g. of the primary server
+        for a standby, skipping the ones already logged"""
+        for record in records:
+            if record[0] > self.lsn:
+                self._apply(record)
+                self._pending.append(record)
+
+    def reset(self, state):
+        """Replaces everything logged by `state`, as returned by `state()`
+        on another log"""
+        self._pending = []
+        self._load(state)
+        self.snapshot()
+
+    def commit(self):
+        """Writes and fsyncs the pending records, and returns them"""
+        if not self._pending:
+            return []
+        records, self._pending = self._pending, []
+        self._file.write(b''.join(json.dumps(record).encode('utf-8') + b'\n'
+                                  for record in records))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._since_snapshot += len(records)
+        if self._since_snapshot >= self.snapshot_every:
+            self.snapshot()
+        return records
+
+    def snapshot(self):
+        """Writes the holders to the snapshot and truncates the log"""
+        temp = self._snapshot_path + '.tmp'
+        with io.open(temp, 'wb') as f:
+            f.write(json.dumps(self.state()).encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp, self._snapshot_path)
+        # The rename must be durable before the log is truncated
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self._file.close()
+        self._file = io.open(self._log_path, 'wb')
+        self._since_snapshot = 0
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
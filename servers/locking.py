@@ -1,9 +1,139 @@
+import bisect
+import hashlib
+import heapq
+import json
 import logging
+import multiprocessing as mp
+import struct
+import time
 import zmq
 
+from collections import deque
+
+from lock_log import LockLog
+
+
+class HashRing(object):
+    """ Consistent hashing of lock names over the urls of the shards
+
+    Every shard has `replicas` points on the ring, so adding or removing
+    a shard only moves about 1/N of the names, spread over all shards.
+
+    """
+
+    def __init__(self, urls=(), replicas=64):
+        self.replicas = replicas
+        self._points = []
+        self._owners = {}
+        for url in urls:
+            self.add(url)
+
+    @staticmethod
+    def _hash(key):
+        digest = hashlib.md5(key.encode('utf-8')).digest()
+        return struct.unpack('!Q', digest[:8])[0]
+
+    @property
+    def urls(self):
+        return sorted(set(self._owners.values()))
+
+    def add(self, url):
+        for i in range(self.replicas):
+            point = self._hash('%s#%d' % (url, i))
+            if point not in self._owners:
+                bisect.insort(self._points, point)
+            self._owners[point] = url
+
+    def remove(self, url):
+        for i in range(self.replicas):
+            point = self._hash('%s#%d' % (url, i))
+            if self._owners.get(point) == url:
+                del self._owners[point]
+                self._points.remove(point)
+
+    def get(self, name):
+        """Returns the url of the shard owning `name`"""
+        if not self._points:
+            return None
+        i = bisect.bisect(self._points, self._hash(name))
+        return self._owners[self._points[i % len(self._points)]]
+
+
+class _Waiter(object):
+    """ A LOCK request of one or more names
+
+    The names are acquired one at a time in sorted order: as every
+    request goes through the names in the same global order, two
+    requests can never wait for each other. The client is only answered
+    once it holds all of them.
+
+    """
+
+    __slots__ = ('address', 'id_', 'mode', 'names', 'tokens', 'ticket',
+                 'binary')
+
+    def __init__(self, address, id_, mode, names, binary):
+        self.address = address
+        self.id_ = id_
+        self.mode = mode
+        self.names = sorted(set(names))
+        self.tokens = []
+        self.ticket = None
+        self.binary = binary
+
+    def next_name(self):
+        return self.names[len(self.tokens)]
+
+    def done(self):
+        return len(self.tokens) == len(self.names)
+
 
 class LockerServer(object):
-    """ Server that manages locks across a network """
+    """ Server that manages locks across a network
+
+    A lock is either held exclusively by one client or shared by several
+    readers. Waiting clients are served in the order they asked: a
+    reader doesn't join the current readers while someone is waiting,
+    so writers can't be starved by a stream of readers.
+
+    Locks are granted as leases of `lease_ttl` seconds, renewed by the
+    heartbeats of their holder. A lock whose lease expires, e.g. because
+    its holder died, is handed over to the next waiting client. The
+    names granted to a client still waiting for its next names are
+    renewed by the server until it holds them all, since the client only
+    renews the locks it knows it holds.
+
+    Every grant comes with a fencing token, greater than all the tokens
+    granted before, so that stale writes of an expired holder can be
+    told apart from the writes of the current one. Tokens are the time
+    of the grant in microseconds, made unique: they keep increasing when
+    a server restarts without a log, and the tokens of the shards of a
+    ring stay comparable as long as their clocks are about in sync. The
+    epoch of the log, the number of takeovers by a standby, comes above
+    the time, so the tokens of a new primary are greater than all the
+    ones of the primary it fenced.
+
+    Two protocols are served on the same socket: single frame messages
+    `COMMAND:name:id[:mode:timeout]`, and multipart binary messages
+    acting on many names at once (see `HEADER`).
+
+    A server given a `ring` is one shard of the lock service, `url`
+    being its entry in the ring: it refuses to lock the names it doesn't
+    own, replying ST_MOVED with the urls of the ring so the client can
+    route again. Locks it already holds can still be released and
+    renewed, so the ring should only change while the names moving to
+    another shard are not held.
+
+    A server given a `log` (a `LockLog`) survives restarts: the grants
+    and releases are logged, and a batch of requests is only answered
+    once its records are durable, with one fsync for the whole batch.
+    The locks held are recovered from the log, their leases starting
+    again from the recovery. Committed records are published on
+    `replication_url` for the `LockStandby` replicas. A server told
+    `FENCE:epoch` of an epoch greater than its own stops serving: a
+    standby took over.
+
+    """
 
     PING = 'PING'
     PONG = 'PONG'
@@ -13,90 +143,650 @@ class LockerServer(object):
     MSG_ERROR = 'MSG_ERROR'
     UNLOCK = 'UNLOCK'
     UNLOCKED = 'UNLOCKED'
+    RENEW = 'RENEW'
+    RENEWED = 'RENEWED'
+    LEASE_ERROR = 'LEASE_ERROR'
     GO = 'the file is available'
     WAIT = 'the file is locked'
     DELIMITER = ':'
     DEFAULT_LOCK = '_DEFAULT_'
     CLOSE = 'CLOSE'
+    SYNC = 'SYNC'
+    FENCE = 'FENCE'
+    FENCED = 'FENCED'
+    EXCLUSIVE = 'X'
+    SHARED = 'S'
 
-    def __init__(self, url="tcp://127.0.0.1:7899"):
+    # Binary protocol: a request is a header frame (operation, mode index
+    # in MODES, timeout in seconds or -1), the id of the client, then one
+    # frame per lock name. The reply is a frame (status, lease ttl)
+    # followed by one fencing token per name in sorted order for ST_GO,
+    # by an error message for ST_ERROR, or by the urls of the shards for
+    # ST_MOVED. OP_RING replaces the ring by the urls in the name frames.
+    HEADER = struct.Struct('!BBd')
+    REPLY = struct.Struct('!Bd')
+    TOKEN = struct.Struct('!Q')
+    OP_LOCK = 1
+    OP_UNLOCK = 2
+    OP_RENEW = 3
+    OP_RING = 4
+    ST_GO = 0
+    ST_WAIT = 1
+    ST_DONE = 2
+    ST_ERROR = 3
+    ST_MOVED = 4
+    MODES = (EXCLUSIVE, SHARED)
+
+    # Most requests handled before their records are committed at once
+    MAX_BATCH = 256
+
+    # Bits of the time in microseconds in a token, below the epoch
+    EPOCH_SHIFT = 52
+
+    def __init__(self, url="tcp://127.0.0.1:7899", lease_ttl=10.0,
+                 ring=None, log=None, replication_url=None):
+        # name -> {id: fencing token} of the clients holding it
         self._locks = {}
+        # name -> EXCLUSIVE or SHARED, the mode it's held in
+        self._modes = {}
+        # name -> deque of the _Waiters waiting for it,
+        # in the order they asked for it
+        self._queues = {}
+        # ticket -> _Waiter of the clients waiting with a timeout
+        self._waiting = {}
+        # token -> [name, id, expiry] of the current leases
+        self._leases = {}
+        # tokens granted to the waiters still waiting for their next names
+        self._partial = set()
+        # heap of (time, token or ticket), entries of renewed or released
+        # leases and of served waiters are skipped when they come up
+        self._timers = []
+        self._token = 0
+        self._epoch = 0
+        self._lease_ttl = lease_ttl
+        self._ring = ring
         self._url = url
         self._logger = None
+        self._socket = None
+        self._log = log
+        self._replication_url = replication_url
+        self._publisher = None
+        # (address, reply, _Waiter or None) waiting for the next commit
+        self._outbox = []
+        if log is not None:
+            self._restore(log)
+
+    def _restore(self, log):
+        """Takes the locks held according to `log`"""
+        expires = time.time() + self._lease_ttl
+        for name, holders in log.holders.items():
+            for id_, (mode, token) in holders.items():
+                self._locks.setdefault(name, {})[id_] = token
+                self._modes[name] = mode
+                self._leases[token] = [name, id_, expires]
+                heapq.heappush(self._timers, (expires, token))
+        self._token = max(self._token, log.token)
+        self._epoch = log.epoch
+
+    def _send(self, address, response, waiter=None):
+        """Sends `response`, a string or a list of frames, to the client
+        at `address`.
+
+        Returns `False` if the client is gone. With a log, the response
+        is only sent by `_flush`, which aborts `waiter` if the client is
+        gone by then.
+
+        """
+        if self._log is not None:
+            self._outbox.append((address, response, waiter))
+            return True
+        return self._deliver(address, response)
+
+    def _deliver(self, address, response):
+        if not isinstance(response, list):
+            response = [response.encode('utf-8')]
+        try:
+            self._socket.send_multipart([address, b''] + response)
+            return True
+        except zmq.ZMQError:
+            return False
+
+    def _reply(self, binary, status, text, tokens=()):
+        """Formats a reply in the protocol of the request"""
+        if not binary:
+            return text
+        frames = [self.REPLY.pack(status, self._lease_ttl)]
+        if status == self.ST_ERROR:
+            frames.append(text.encode('utf-8'))
+        frames.extend(self.TOKEN.pack(token) for token in tokens)
+        return frames
+
+    def _go(self, waiter):
+        """Returns the reply to `waiter`, which now holds all its names:
+        their leases start again, renewed by the client from now on."""
+        expires = time.time() + self._lease_ttl
+        for token in waiter.tokens:
+            self._partial.discard(token)
+            self._leases[token][2] = expires
+            heapq.heappush(self._timers, (expires, token))
+        return self._reply(waiter.binary, self.ST_GO,
+                           self.GO + self.DELIMITER + str(waiter.tokens[0]) +
+                           self.DELIMITER + repr(self._lease_ttl),
+                           waiter.tokens)
+
+    def _next_token(self):
+        # Tokens and tickets share the counter, so they share the heap
+        self._token = max(self._token + 1, (self._epoch << self.EPOCH_SHIFT) +
+                          int(time.time() * 10**6))
+        return self._token
+
+    def _grant(self, name, id_, mode):
+        """Locks `name` for `id_` and returns the fencing token.
 
-    def _lock(self, name, id_):
-        if name not in self._locks:
-            # Lock is available and unlocked.
-            # Client locks it (aka addition to dict) and
+        A lock asked again by one of its holders keeps its token and its
+        mode, its lease being renewed, so that it's released only once.
+
+        """
+        expires = time.time() + self._lease_ttl
+        holders = self._locks.setdefault(name, {})
+        if id_ in holders:
+            token = holders[id_]
+            self._leases[token][2] = expires
+            heapq.heappush(self._timers, (expires, token))
+            return token
+        token = self._next_token()
+        holders[id_] = token
+        self._modes[name] = mode
+        self._leases[token] = [name, id_, expires]
+        heapq.heappush(self._timers, (expires, token))
+        if self._log is not None:
+            self._log.append('G', name, id_, mode, token)
+        return token
+
+    def _drop(self, name, id_, token=None):
+        """Releases `name` held by `id_`, only under the lease `token` if
+        given. Returns `False` if there was nothing to release."""
+        holders = self._locks.get(name, {})
+        if id_ not in holders or token not in (None, holders[id_]):
+            # A lease replaced or already released
+            self._leases.pop(token, None)
+            return False
+        token = holders.pop(id_)
+        del self._leases[token]
+        self._partial.discard(token)
+        if self._log is not None:
+            self._log.append('U', name, id_)
+        if not holders:
+            del self._locks[name]
+            del self._modes[name]
+        return True
+
+    def _available(self, name, mode):
+        """Tells if `name` can be locked in `mode` given its holders"""
+        return (name not in self._locks or
+                mode == self.SHARED == self._modes[name])
+
+    def _holds(self, name, id_, mode):
+        """Tells if `id_` already holds `name` in `mode`, or exclusively"""
+        return (id_ in self._locks.get(name, {}) and
+                mode in (self.SHARED, self._modes[name]))
+
+    def _advance(self, waiter, wait=True):
+        """Acquires the next names of `waiter` while they are available.
+
+        Returns `True` once it holds all of them. Otherwise the waiter is
+        put in the queue of the first name not available, unless `wait`
+        is `False`. A name it already holds is granted again at once, it
+        mustn't wait behind the requests waiting for it to be released.
+
+        """
+        while not waiter.done():
+            name = waiter.next_name()
+            if (not self._holds(name, waiter.id_, waiter.mode) and
+                    (not self._available(name, waiter.mode) or
+                     self._queues.get(name))):
+                if wait:
+                    self._queues.setdefault(name, deque()).append(waiter)
+                    self._partial.update(waiter.tokens)
+                return False
+            waiter.tokens.append(self._grant(name, waiter.id_, waiter.mode))
+        return True
+
+    def _abort(self, waiter):
+        """Releases the names already acquired by `waiter`"""
+        names = waiter.names[:len(waiter.tokens)]
+        self._partial.difference_update(waiter.tokens)
+        del waiter.tokens[:]
+        for name in names:
+            self._drop(name, waiter.id_)
+        for name in names:
+            self._hand_over(name)
+
+    def _request(self, waiter, timeout=None):
+        """Acquires all the names of `waiter` (aka all-or-nothing)
+
+        Returns the reply to send, or `None` if the client waits.
+
+        """
+        try_only = timeout is not None and timeout <= 0
+        if self._advance(waiter, wait=not try_only):
+            # Locks are available and unlocked (or only shared).
+            # Client locks them (aka addition to dict) and
             # can go on into a sequential code block.
-            self._locks[name] = id_
-            return self.GO
+            return self._go(waiter)
+        elif try_only:
+            # Locks are not available and the client doesn't wait.
+            self._abort(waiter)
+            return self._reply(waiter.binary, self.ST_WAIT, self.WAIT)
         else:
-            # Lock is not available and locked by someone else.
-            # Client needs to wait until it is released
-            return self.WAIT
+            # A lock is not available and locked by someone else.
+            # Client waits in line, without any answer,
+            # until the locks are handed over to it.
+            if timeout is not None:
+                waiter.ticket = self._next_token()
+                self._waiting[waiter.ticket] = waiter
+                heapq.heappush(self._timers,
+                               (time.time() + timeout, waiter.ticket))
+            return None
+
+    def _lock(self, name, id_, address, mode=EXCLUSIVE, timeout=None):
+        return self._request(_Waiter(address, id_, mode, [name], False),
+                             timeout)
+
+    def _unlock_many(self, names, id_):
+        """Releases `names` held by `id_`
+
+        Returns the names that were not held by `id_`.
+
+        """
+        missing = [name for name in names
+                   if id_ not in self._locks.get(name, {})]
+        released = [name for name in set(names) if name not in missing]
+        for name in released:
+            # Unlocks the lock (aka removal from dict).
+            self._drop(name, id_)
+        for name in released:
+            # And hands it over to the next waiting clients.
+            self._hand_over(name)
+        return missing
 
     def _unlock(self, name, id_):
-        locker_id = self._locks[name]
-        if locker_id != id_:
-            # Locks can only be locked and 
+        if self._unlock_many([name], id_):
+            # Locks can only be locked and
             # then unlocked by the same client.
             response = (self.RELEASE_ERROR + self.DELIMITER +
                         'Lock was acquired by `%s` and not by '
-                        '`%s`.' % (locker_id, id_))
+                        '`%s`.' % ('`, `'.join(self._locks.get(name, {})),
+                                   id_))
             self._logger.error(response)
             return response
+        return self.UNLOCKED
+
+    def _renew_many(self, names, id_):
+        """Renews the leases of `names` held by `id_`
+
+        Returns the names that were not held by `id_`: their lease
+        expired, and they may already belong to someone else.
+
+        """
+        missing = []
+        expires = time.time() + self._lease_ttl
+        for name in names:
+            token = self._locks.get(name, {}).get(id_)
+            if token is None:
+                missing.append(name)
+            else:
+                self._leases[token][2] = expires
+                heapq.heappush(self._timers, (expires, token))
+        return missing
+
+    def _renew(self, name, id_):
+        if self._renew_many([name], id_):
+            response = (self.LEASE_ERROR + self.DELIMITER +
+                        'Lock `%s` is not held by `%s`.' % (name, id_))
+            self._logger.error(response)
+            return response
+        return self.RENEWED
+
+    def _hand_over(self, name):
+        """Gives the lock `name` to the first waiting clients still there:
+        one writer, or all the readers in front of the queue."""
+        queue = self._queues.get(name)
+        while queue and self._available(name, queue[0].mode):
+            waiter = queue.popleft()
+            waiter.tokens.append(self._grant(name, waiter.id_, waiter.mode))
+            if not self._advance(waiter):
+                # Now waiting for one of its next names
+                continue
+            self._waiting.pop(waiter.ticket, None)
+            if not self._send(waiter.address, self._go(waiter), waiter):
+                self._abort(waiter)
+        if not queue:
+            self._queues.pop(name, None)
+
+    def _give_up(self, ticket):
+        """Answers WAIT to a client that waited until its timeout"""
+        waiter = self._waiting.pop(ticket)
+        name = waiter.next_name()
+        self._queues[name].remove(waiter)
+        self._abort(waiter)
+        self._send(waiter.address,
+                   self._reply(waiter.binary, self.ST_WAIT, self.WAIT))
+        # Readers waiting behind a writer that gave up may go now
+        self._hand_over(name)
+
+    def _expire(self):
+        """Reclaims the locks whose lease expired and answers the clients
+        whose wait timed out.
+
+        Returns the time in ms until the next timer, or `None` if there
+        is no timer.
+
+        """
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            when, key = heapq.heappop(self._timers)
+            if key in self._waiting:
+                self._give_up(key)
+            elif key in self._partial and self._leases[key][2] <= now:
+                # Its holder is waiting for its next names
+                self._leases[key][2] = now + self._lease_ttl
+                heapq.heappush(self._timers, (now + self._lease_ttl, key))
+            elif key in self._leases and self._leases[key][2] <= now:
+                name, id_, expires = self._leases[key]
+                if self._drop(name, id_, key):
+                    self._logger.warning('Lease of `%s` held by `%s` '
+                                         'expired' % (name, id_))
+                    self._hand_over(name)
+        if not self._timers:
+            return None
+        return max(0, int((self._timers[0][0] - now) * 1000) + 1)
+
+    def _parse_lock(self, args):
+        """Returns the mode and timeout of the optional `args` of LOCK"""
+        mode = self.EXCLUSIVE
+        timeout = None
+        if len(args) > 0 and args[0]:
+            mode = args[0]
+            if mode not in self.MODES:
+                raise ValueError('Unknown lock mode `%s`' % mode)
+        if len(args) > 1 and args[1]:
+            timeout = float(args[1])
+        return mode, timeout
+
+    def _handle_binary(self, address, frames):
+        """Serves a multipart request of the binary protocol"""
+        try:
+            op, mode, timeout = self.HEADER.unpack(frames[0])
+            id_ = frames[1].decode('utf-8')
+            names = [frame.decode('utf-8') for frame in frames[2:]]
+            mode = self.MODES[mode]
+        except (struct.error, IndexError, UnicodeDecodeError):
+            response = 'Binary request not understood'
+            self._logger.error(response)
+            return self._reply(True, self.ST_ERROR, response)
+
+        if op == self.OP_LOCK:
+            if self._ring is not None and any(
+                    self._ring.get(name) != self._url for name in names):
+                return ([self.REPLY.pack(self.ST_MOVED, self._lease_ttl)] +
+                        [url.encode('utf-8') for url in self._ring.urls])
+            return self._request(_Waiter(address, id_, mode, names, True),
+                                 None if timeout < 0 else timeout)
+        elif op == self.OP_UNLOCK:
+            missing = self._unlock_many(names, id_)
+            error = 'Locks `%s` not held by `%s`.'
+        elif op == self.OP_RENEW:
+            missing = self._renew_many(names, id_)
+            error = 'Leases of `%s` held by `%s` expired.'
+        elif op == self.OP_RING:
+            self._ring = HashRing(names)
+            self._logger.info('Shards are now %s' % ', '.join(names))
+            missing = []
         else:
-            # Unlocks the lock (aka removal from dict).
-            del self._locks[name]
-            return self.UNLOCKED
+            response = 'Operation `%d` not understood' % op
+            self._logger.error(response)
+            return self._reply(True, self.ST_ERROR, response)
+
+        if missing:
+            response = error % ('`, `'.join(missing), id_)
+            self._logger.error(response)
+            return self._reply(True, self.ST_ERROR, response)
+        return self._reply(True, self.ST_DONE, '')
+
+    def _flush(self):
+        """Commits the pending records, publishes them to the replicas,
+        then sends the replies that waited for them."""
+        while self._outbox or self._log.pending:
+            records = self._log.commit()
+            if records and self._publisher is not None:
+                self._publisher.send_string(json.dumps(records))
+            outbox, self._outbox = self._outbox, []
+            for address, response, waiter in outbox:
+                if not self._deliver(address, response) and waiter:
+                    # Its grants are logged, and released again
+                    self._abort(waiter)
+
+    def _handle_string(self, address, msg):
+        """Serves a single frame request, returns `False` on DONE"""
+        name = None
+        id_ = None
+        args = []
+        if self.DELIMITER in msg:
+            parts = msg.split(self.DELIMITER)
+            msg, name, id_ = (parts + [None])[:3]
+            args = parts[3:]
+        if msg == self.DONE:
+            self._send(address, self.CLOSE + self.DELIMITER +
+                       'Closing Lock Server')
+            self._logger.info('Closing Lock Server')
+            return False
+        elif msg == self.LOCK:
+            if name is None or id_ is None:
+                response = (self.MSG_ERROR + self.DELIMITER +
+                            'Please provide name and id for locking')
+                self._logger.error(response)
+            elif (self._ring is not None and
+                  self._ring.get(name) != self._url):
+                response = (self.MSG_ERROR + self.DELIMITER +
+                            'Lock `%s` belongs to another shard' % name)
+                self._logger.error(response)
+            else:
+                try:
+                    mode, timeout = self._parse_lock(args)
+                    response = self._lock(name, id_, address, mode, timeout)
+                except ValueError as e:
+                    response = self.MSG_ERROR + self.DELIMITER + str(e)
+                    self._logger.error(response)
+            if response is not None:
+                self._send(address, response)
+        elif msg == self.UNLOCK:
+            if name is None or id_ is None:
+                response = (self.MSG_ERROR + self.DELIMITER +
+                            'Please provide name and id for unlocking')
+                self._logger.error(response)
+            else:
+                response = self._unlock(name, id_)
+            self._send(address, response)
+        elif msg == self.RENEW:
+            if name is None or id_ is None:
+                response = (self.MSG_ERROR + self.DELIMITER +
+                            'Please provide name and id for renewing')
+                self._logger.error(response)
+            else:
+                response = self._renew(name, id_)
+            self._send(address, response)
+        elif msg == self.PING:
+            self._send(address, self.PONG)
+        elif msg == self.SYNC and self._log is not None:
+            # A standby starting to replicate the log
+            self._send(address, json.dumps(self._log.state()))
+        elif msg == self.FENCE and name is not None and name.isdigit():
+            if int(name) > self._epoch:
+                # A standby took over, its clients must not see two servers
+                self._send(address, self.FENCED)
+                self._logger.warning('Fenced by epoch %s, stopping' % name)
+                return False
+            self._send(address, self.MSG_ERROR + self.DELIMITER +
+                       'Epoch %s is not after %d' % (name, self._epoch))
+        else:
+            response = (self.MSG_ERROR + self.DELIMITER +
+                        'MSG `%s` not understood' % msg)
+            self._logger.error(response)
+            self._send(address, response)
+        return True
+
     def run(self):
         """Runs Server"""
         try:
             self._logger = logging.getLogger('LockServer')
             self._logger.info('Starting Lock Server')
             context = zmq.Context()
-            socket_ = context.socket(zmq.REP)
+            socket_ = context.socket(zmq.ROUTER)
+            # Fail on sending to clients that are gone instead of
+            # silently dropping the message
+            socket_.setsockopt(zmq.ROUTER_MANDATORY, 1)
             socket_.bind(self._url)
-            while True:
-
-                msg = socket_.recv_string()
-                name = None
-                id_ = None
-                if self.DELIMITER in msg:
-                    msg, name, id_ = msg.split(self.DELIMITER)
-                if msg == self.DONE:
-                    socket_.send_string(self.CLOSE + self.DELIMITER +
-                                        'Closing Lock Server')
-                    self._logger.info('Closing Lock Server')
-                    break
-                elif msg == self.LOCK:
-                    if name is None or id_ is None:
-                        response = (self.MSG_ERROR + self.DELIMITER +
-                                    'Please provide name and id for locking')
-                        self._logger.error(response)
-                    else:
-                        response = self._lock(name, id_)
-                    socket_.send_string(response)
-                elif msg == self.UNLOCK:
-                    if name is None or id_ is None:
-                        response = (self.MSG_ERROR + self.DELIMITER +
-                                    'Please provide name and id for unlocking')
-                        self._logger.error(response)
+            self._socket = socket_
+            if self._replication_url is not None:
+                self._publisher = context.socket(zmq.PUB)
+                self._publisher.bind(self._replication_url)
+            running = True
+            while running:
+
+                ready = socket_.poll(self._expire())
+                # Serves the requests already there as one batch
+                # before committing their records
+                for i in range(self.MAX_BATCH if ready else 0):
+                    frames = socket_.recv_multipart()
+                    address = frames[0]
+                    if len(frames) > 3:
+                        response = self._handle_binary(address, frames[2:])
+                        if response is not None:
+                            self._send(address, response)
                     else:
-                        response = self._unlock(name, id_)
-                    socket_.send_string(response)
-                elif msg == self.PING:
-                    socket_.send_string(self.PONG)
-                else:
-                    response = (self.MSG_ERROR + self.DELIMITER +
-                               'MSG `%s` not understood' % msg)
-                    self._logger.error(response)
-                    socket_.send_string(response)
+                        running = self._handle_string(
+                            address, frames[2].decode('utf-8'))
+                    if not running or not socket_.poll(0):
+                        break
+                if self._log is not None:
+                    self._flush()
+            if self._log is not None:
+                self._log.close()
         except Exception:
             self._logger.exception('Crashed Lock Server!')
             raise
 
+class LockStandby(object):
+    """ Hot standby of a lock server, taking over when it fails
+
+    Replicates the log of the primary server into its own `log`: the
+    log is copied at start with SYNC, then the records the primary
+    commits are applied as they are published on `replication_url`.
+
+    The primary is pinged every `interval` seconds. Once it has not been
+    heard of for `failover_timeout` seconds, the standby fences it (see
+    `take_over`), then serves the locks on its own `url`, as a server
+    recovered from the log would.
+
+    """
+
+    def __init__(self, primary_url, replication_url, url, log,
+                 lease_ttl=10.0, interval=1.0, failover_timeout=5.0):
+        self.primary_url = primary_url
+        self.replication_url = replication_url
+        self.url = url
+        self.log = log
+        self.lease_ttl = lease_ttl
+        self.interval = interval
+        self.failover_timeout = failover_timeout
+        self._logger = logging.getLogger('LockStandby')
+
+    def _ask(self, context, msg):
+        """Sends `msg` to the primary, returns the reply or `None` if it
+        doesn't answer within `interval`"""
+        socket_ = context.socket(zmq.REQ)
+        socket_.setsockopt(zmq.LINGER, 0)
+        try:
+            socket_.connect(self.primary_url)
+            socket_.send_string(msg)
+            if socket_.poll(int(self.interval * 1000)):
+                return socket_.recv_string()
+            return None
+        finally:
+            socket_.close()
+
+    def replicate(self):
+        """Follows the primary until it fails"""
+        context = zmq.Context()
+        subscriber = context.socket(zmq.SUB)
+        subscriber.setsockopt_string(zmq.SUBSCRIBE, u'')
+        subscriber.connect(self.replication_url)
+        synced = False
+        last_seen = time.time()
+        next_ping = last_seen
+        try:
+            while time.time() - last_seen < self.failover_timeout:
+                if not synced:
+                    state = self._ask(context, LockerServer.SYNC)
+                    if state is not None:
+                        self.log.reset(json.loads(state))
+                        last_seen = time.time()
+                        synced = True
+                        self._logger.info('Synced at %d' % self.log.lsn)
+                    continue
+                if time.time() >= next_ping:
+                    if self._ask(context, LockerServer.PING) is not None:
+                        last_seen = time.time()
+                    next_ping = time.time() + self.interval
+                while subscriber.poll(int(self.interval * 1000)):
+                    records = json.loads(subscriber.recv_string())
+                    last_seen = time.time()
+                    if records[0][0] > self.log.lsn + 1:
+                        # Records were published before subscribing
+                        self._logger.warning('Log gap after %d, syncing '
+                                             'again' % self.log.lsn)
+                        synced = False
+                        break
+                    self.log.extend(records)
+                    self.log.commit()
+                    if time.time() >= next_ping:
+                        break
+        finally:
+            subscriber.close()
+        self._logger.warning('Primary `%s` failed, taking over at %d'
+                             % (self.primary_url, self.log.lsn))
+
+    def take_over(self):
+        """Fences the primary before serving its locks
+
+        The next epoch is committed to the log first, so every token
+        granted from now on is greater than the ones of the primary, and
+        the primary is told to stop in case it still runs. Then the
+        leases the primary may have granted or renewed without the
+        standby knowing have a lease ttl to expire.
+
+        """
+        epoch = self.log.epoch + 1
+        self.log.append('E', epoch)
+        self.log.commit()
+        context = zmq.Context()
+        try:
+            reply = self._ask(context, LockerServer.FENCE +
+                              LockerServer.DELIMITER + str(epoch))
+        finally:
+            context.term()
+        if reply == LockerServer.FENCED:
+            self._logger.warning('Primary `%s` fenced' % self.primary_url)
+        self._logger.warning('Serving epoch %d in %.1f s'
+                             % (epoch, self.lease_ttl))
+        time.sleep(self.lease_ttl)
+
+    def run(self):
+        """Replicates the primary, then serves the locks once it failed"""
+        self.replicate()
+        self.take_over()
+        LockerServer(self.url, self.lease_ttl, log=self.log).run()
 
 def run_server():
     logging.basicConfig(level=logging.DEBUG)
@@ -104,5 +794,21 @@ def run_server():
     server.run()
 
 
+def _run_shard(url, urls, lease_ttl):
+    logging.basicConfig(level=logging.INFO)
+    LockerServer(url, lease_ttl, HashRing(urls)).run()
+
+
+def run_shards(urls, lease_ttl=10.0):
+    """Runs one shard of the lock service per url, each in its own
+    process so they use all the cores, and returns the processes"""
+    processes = [mp.Process(target=_run_shard, args=(url, urls, lease_ttl))
+                 for url in urls]
+    for process in processes:
+        process.daemon = True
+        process.start()
+    return processes
+
+
 if __name__ == '__main__':
     run_server()
@@ -1,13 +1,25 @@
+import heapq
+import itertools
+import os.path
 import threading
 import time
 import random
 
 import imp,traceback
 
+import chunk_store
+import delta
+import versions
+from connection_pool import ConnectionPool
+from download import ChunkedDownload, CHUNK_SIZE
+
+#the FileDb backends, e.g. filedb/sqlite.py for loadFileDb("sqlite")
+filedbPath = [os.path.join(os.path.dirname(os.path.abspath(__file__)), "filedb")]
+
 def loadFileDb(id,*args,**kwargs):
     
     try:
-        fp, pathname, description = imp.find_module(id,__path__)
+        fp, pathname, description = imp.find_module(id,filedbPath)
         assert fp
         return getattr(imp.load_module(id.replace(".",""),fp, pathname, description),"%sFileDb" % id)(*args,**kwargs)
     except Exception, err:
@@ -16,6 +28,134 @@ def loadFileDb(id,*args,**kwargs):
         return False
     
 
+class ReplicationQueue(object):
+    '''
+	Priority queue of the files waiting for replication.
+	
+	Files with the fewest replicas (kn) come first, then the most
+	accessed ones, then the smallest ones, which get a new replica
+	fastest. A file is queued once, queueing it again only updates
+	its priority.
+	
+    '''
+    
+    def __init__(self):
+        self.heap = []
+        #file -> [priority, order, data], data is None once removed
+        self.entries = {}
+        self.order = itertools.count()
+        self.cond = threading.Condition()
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def __contains__(self, file):
+        return file in self.entries
+    
+    def put(self, data, heat=0):
+        '''
+        Queues data, a dict like the ones of fs.selectFileToReplicate(),
+        and wakes up a worker waiting in get().
+        '''
+        with self.cond:
+            entry = self.entries.get(data["file"])
+            if entry:
+                entry[-1] = None
+            entry = [(data["kn"], -heat, data["size"]), next(self.order), data]
+            self.entries[data["file"]] = entry
+            heapq.heappush(self.heap, entry)
+            self.cond.notify()
+    
+    def get(self, timeout=None):
+        '''
+        Returns the data of the most urgent file, waiting up to timeout
+        seconds for one. Returns None if there is still none by then.
+        '''
+        with self.cond:
+            if not self.entries:
+                self.cond.wait(timeout)
+            while self.heap:
+                priority, order, data = heapq.heappop(self.heap)
+                if data is not None:
+                    del self.entries[data["file"]]
+                    return data
+            return None
+
+
+class EvictionIndex(object):
+    '''
+	Index of the files of the node, in the order they should be evicted:
+	the files with the most replicas (kn) first, then the least recently
+	accessed ones, then the largest ones.
+	
+	It's a heap updated incrementally: updating a file pushes a new
+	entry and invalidates the old one, so no update nor eviction depends
+	on the number of files of the node.
+	
+    '''
+    
+    def __init__(self):
+        self.heap = []
+        #file -> [key, file, valid]
+        self.entries = {}
+        self.lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def __contains__(self, file):
+        return file in self.entries
+    
+    def update(self, file, kn=None, size=None, lastAccess=None):
+        '''
+        Adds file, or updates the fields given. kn and size are required
+        for a new file.
+        '''
+        with self.lock:
+            old = self.entries.get(file)
+            if old:
+                old[-1] = False
+                oldKn, oldAccess, oldSize = old[0]
+                kn = -oldKn if kn is None else kn
+                size = -oldSize if size is None else size
+                lastAccess = oldAccess if lastAccess is None else lastAccess
+            entry = [(-kn, lastAccess or 0, -size), file, True]
+            self.entries[file] = entry
+            heapq.heappush(self.heap, entry)
+            #drop the invalid entries once they are the majority
+            if len(self.heap) > 2 * len(self.entries) + 64:
+                self.heap = [e for e in self.heap if e[-1]]
+                heapq.heapify(self.heap)
+    
+    def touch(self, file):
+        if file in self.entries:
+            self.update(file, lastAccess=time.time())
+    
+    def remove(self, file):
+        with self.lock:
+            entry = self.entries.pop(file, None)
+            if entry:
+                entry[-1] = False
+    
+    def pop(self, minKn):
+        '''
+        Removes the first file to evict and returns its (file, kn, size,
+        lastAccess), or returns None if it has less than minKn replicas.
+        '''
+        with self.lock:
+            while self.heap:
+                (kn, lastAccess, size), file, valid = self.heap[0]
+                if not valid:
+                    heapq.heappop(self.heap)
+                    continue
+                if -kn < minKn:
+                    return None
+                heapq.heappop(self.heap)
+                del self.entries[file]
+                return file, -kn, -size, lastAccess
+            return None
+
+
 class Replicator(threading.Thread):
     '''
 	This is the Replicator class.
@@ -23,12 +163,48 @@ class Replicator(threading.Thread):
 	
 	It takes a Filesystem instance in argument which is saved in self.fs.
 	
+	Files are replicated by a pool of fs.config["replicatorWorkers"]
+	threads, most urgent first (see ReplicationQueue), up to
+	fs.config["replicatorTarget"] replicas. The scheduler fills the
+	queue with fs.filedb.selectFilesToReplicate() or
+	fs.selectFileToReplicate() (see schedule) and sleeps until
+	something happens: notify() a written file, or wake() it when a
+	node failed.
+	
+	With fs.config["replicatorDelta"], a file of which the node holds an
+	old copy is updated by a delta transfer (see downloadDelta). A file
+	larger than one chunk is fetched from all its nodes at once (see
+	downloadChunks). With fs.config["replicatorChunkStore"], the
+	directory of the chunk store of the node, only the chunks the node
+	doesn't store yet are downloaded (see downloadManifest). The
+	version vector of the file comes with it (see fetchVersion).
+	
+	The files to evict when the disk is full are taken from an
+	EvictionIndex seeded by fs.filedb.getFilesInNode(host), which
+	yields the (file, kn, size) of the node, and kept up to date by
+	updateFile(). Without getFilesInNode, files are evicted one at a
+	time by querying fs.filedb.getMaxKnInNode().
+	
     '''
     
     def __init__(self, fs):
         threading.Thread.__init__(self)
         self.fs = fs
         self.stopnow = False
+        self.queue = ReplicationQueue()
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        #files being downloaded by the workers
+        self.inFlight = set()
+        #bytes of free disk promised to the downloads in flight
+        self.reserved = 0
+        #file -> number of accesses
+        self.heat = {}
+        self.workers = []
+        self.pool = ConnectionPool()
+        self.index = EvictionIndex()
+        self.indexed = False
+        self.chunks = None
         
     
     def shutdown(self):
@@ -37,13 +213,65 @@ class Replicator(threading.Thread):
         It breaks the while which runs the Replicator.
         '''
         self.stopnow = True
+        self.wake()
+    
+    def wake(self):
+        '''
+        Makes the scheduler select files to replicate right away, e.g.
+        after a node failure left files under-replicated.
+        '''
+        self.wakeup.set()
+    
+    def notify(self, data):
+        '''
+        Schedules the replication of a file right away, e.g. when it
+        was just written. data is a dict like the ones of
+        fs.selectFileToReplicate().
+        '''
+        with self.lock:
+            if data["file"] in self.inFlight:
+                return
+        self.queue.put(data, self.heat.get(data["file"], 0))
+        self.wake()
+    
+    def touch(self, file):
+        '''
+        Counts an access to file, hot files being replicated first and
+        evicted last.
+        '''
+        self.heat[file] = self.heat.get(file, 0) + 1
+        self.index.touch(file)
+    
+    def updateFile(self, file, kn=None, size=None):
+        '''
+        Tells the eviction index that a file of the node was written
+        (size) or got or lost replicas on other nodes (kn), or that it
+        was deleted if both are None.
+        '''
+        if kn is None and size is None:
+            self.index.remove(file)
+        elif file in self.index or (kn is not None and size is not None):
+            self.index.update(file, kn, size)
     
     def run(self):
         '''
-        to write
+        Starts the workers, then schedules the files to replicate until
+        shutdown() is called.
         '''
         
         self.filedb = self.fs.filedb
+        
+        getFilesInNode = getattr(self.filedb, "getFilesInNode", None)
+        if getFilesInNode:
+            for file, kn, size in getFilesInNode(self.fs.host):
+                self.index.update(file, kn, size)
+            self.indexed = True
+        
+        for i in range(self.fs.config.get("replicatorWorkers", 4)):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
 
         while not self.stopnow:
             
@@ -51,22 +279,116 @@ class Replicator(threading.Thread):
             
             try:
                 
-                didSomething = self.replicateNextFile()
+                didSomething = self.schedule()
                 
             except Exception,e:
                 
-                self.fs.error("When replicating : %s" % (e))
+                self.fs.error("When scheduling replication : %s" % (e))
             
             
             #Sleep for one minute unless something happens..
             if not didSomething and self.fs.config["replicatorIdleTime"]>0:
                 self.fs.debug("Idling for %s seconds max..." % self.fs.config["replicatorIdleTime"],"repl")
-                [time.sleep(1) for i in range(self.fs.config["replicatorIdleTime"]) if not self.stopnow]
+                self.wakeup.wait(self.fs.config["replicatorIdleTime"])
             
             else:
-                time.sleep(self.fs.config["replicatorInterval"])
+                self.wakeup.wait(self.fs.config["replicatorInterval"])
+            
+            self.wakeup.clear()
+        
+        for worker in self.workers:
+            worker.join()
     
     
+    def schedule(self):
+        '''
+        Queues the files selected by fs until every worker has one.
+        Returns True if a file was queued.
+        
+        If fs.filedb has a selectFilesToReplicate(node, count, exclude,
+        target) method, the files of less than
+        fs.config["replicatorTarget"] replicas are selected at once,
+        excluding the ones the node holds, already queued or being
+        downloaded. Otherwise fs.selectFileToReplicate() is asked one
+        file at a time, skipping the files queued or in flight up to once
+        per worker.
+        '''
+        
+        queued = False
+        count = len(self.workers) - len(self.queue)
+        
+        if count <= 0:
+            return queued
+        
+        selectFiles = getattr(self.fs.filedb, "selectFilesToReplicate", None)
+        if selectFiles:
+            with self.lock:
+                exclude = self.inFlight | set(self.queue.entries)
+            for data in selectFiles(self.fs.host, count, exclude,
+                                    self.fs.config.get("replicatorTarget", 3)):
+                self.queue.put(data, self.heat.get(data["file"], 0))
+                queued = True
+            return queued
+        
+        skipped = 0
+        
+        while (len(self.queue) < len(self.workers) and
+               skipped < len(self.workers)):
+            
+            data = self.fs.selectFileToReplicate()
+            
+            if not data:
+                break
+            
+            with self.lock:
+                busy = data["file"] in self.inFlight
+            
+            if busy or data["file"] in self.queue:
+                skipped += 1
+                continue
+            
+            self.queue.put(data, self.heat.get(data["file"], 0))
+            queued = True
+        
+        return queued
+    
+    
+    def work(self):
+        '''
+        Replicates the files of the queue until shutdown() is called.
+        '''
+        
+        while not self.stopnow:
+            
+            data = self.queue.get(1)
+            
+            if not data:
+                continue
+            
+            with self.lock:
+                if data["file"] in self.inFlight:
+                    continue
+                self.inFlight.add(data["file"])
+            
+            replicated = False
+            
+            try:
+                
+                replicated = self.replicateFile(data)
+                
+            except Exception,e:
+                
+                self.fs.error("When replicating %s : %s" % (data["file"], e))
+            
+            finally:
+                with self.lock:
+                    self.inFlight.discard(data["file"])
+            
+            #a slot is free for the next file. A file that couldn't be
+            #replicated is retried after replicatorInterval, not right away
+            if replicated:
+                self.wake()
+    
     
     def replicateNextFile(self):
         
@@ -77,30 +399,292 @@ class Replicator(threading.Thread):
         
         if not data:
             return None
+        
+        return self.replicateFile(data)
     
+    
+    def replicateFile(self, data):
+        
         #do we have enough space to download the file ?
-        while self.fs.getFreeDisk()<data["size"]:
+        #(minus the space promised to the other downloads)
+        with self.lock:
             
-            maxKnFile = self.fs.filedb.getMaxKnInNode(self.fs.host)
+            if self.indexed:
+                if not self.makeSpace(data["size"], data["kn"]+1):
+                    return None
             
-            #no files to delete to make space!
-            if not len(maxKnFile):
-                return None
+            while (not self.indexed and
+                   self.fs.getFreeDisk()-self.reserved<data["size"]):
+                
+                maxKnFile = self.fs.filedb.getMaxKnInNode(self.fs.host)
+                
+                #no files to delete to make space!
+                if not len(maxKnFile):
+                    return None
+                    
+                maxKn = self.fs.filedb.getKn(maxKnFile[0])
+                
+                #no files with a high enough kn to make space!
+                if maxKn<data["kn"]+1:
+                    return None
+                    
+                self.fs.debug("Deleting file %s because it has kn=%s" % (
+								maxKnFile[0],
+								maxKn
+							),"repl")
                 
-            maxKn = self.fs.filedb.getKn(maxKnFile[0])
+                self.deleteFile(maxKnFile[0])
             
-            #no files with a high enough kn to make space!
-            if maxKn<data["kn"]+1:
-                return None
+            self.reserved += data["size"]
+        
+        try:
+            version = self.fetchVersion(data)
+            downloaded = (self.downloadManifest(data) or
+                          self.downloadDelta(data) or
+                          self.downloadChunks(data) or
+                          self.fs.downloadFile(data["file"],data["nodes"]))
+            if downloaded:
+                self.storeVersion(data, version)
+        finally:
+            with self.lock:
+                self.reserved -= data["size"]
+        
+        if downloaded and self.indexed:
+            self.index.update(data["file"], data["kn"]+1, data["size"],
+                              time.time())
+
+        return downloaded
+    
+    
+    def deleteFile(self, file):
+        '''
+        Deletes the local copy of file and its version.
+        '''
+        
+        self.fs.deleteFile(file)
+        self.storeVersion({"file": file}, None)
+    
+    
+    def fetchVersion(self, data):
+        '''
+        Returns the version vector of the file on the first of its nodes
+        answering, or None if it has none. It's asked before the file is
+        downloaded, so a replica is never given a newer version than the
+        copy it got.
+        '''
+        
+        if not getattr(self.fs, "getLocalPath", None):
+            return None
+        
+        for node in data["nodes"]:
+            
+            host, port = node.split(":")
+            
+            try:
+                
+                response = self.pool.request(host, int(port), "HEAD", data["file"])
+                
+            except Exception,e:
                 
+                self.fs.error("Version of %s from %s : %s" % (data["file"], node, e))
+                continue
+            
+            if response.status != 200:
+                continue
+            
+            try:
+                return versions.parse(response.getheader("X-Version")) or None
+            except ValueError:
+                return None
+        
+        return None
+    
+    
+    def storeVersion(self, data, version):
+        '''
+        Writes the version vector of the file next to its local copy, or
+        removes the one of an older copy if it has none.
+        '''
+        
+        getLocalPath = getattr(self.fs, "getLocalPath", None)
+        
+        if not getLocalPath:
+            return
+        
+        path = versions.sidecar(getLocalPath(data["file"]))
+        
+        if version is None:
+            if os.path.exists(path):
+                os.unlink(path)
+            return
+        
+        with open(path + ".part", "wb") as f:
+            f.write(versions.dump(version))
+        os.rename(path + ".part", path)
+    
+    
+    def makeSpace(self, size, minKn):
+        '''
+        Evicts the first files of the index until size bytes are free,
+        checking the free disk once. The files are planned before any is
+        deleted, so nothing is deleted if the files with at least minKn
+        replicas can't free enough space. Returns True if there is
+        enough space now.
+        '''
+        
+        free = self.fs.getFreeDisk()-self.reserved
+        planned = []
+        
+        while free < size:
+            
+            entry = self.index.pop(minKn)
+            
+            #no files with a high enough kn to make space!
+            if not entry:
+                break
+            
+            file, kn, fileSize, lastAccess = entry
+            
+            #the index may lag behind the filedb
+            realKn = self.fs.filedb.getKn(file)
+            if realKn < minKn:
+                self.index.update(file, realKn, fileSize, lastAccess)
+                continue
+            
+            planned.append((file, realKn, fileSize, lastAccess))
+            free += fileSize
+        
+        if free < size:
+            for entry in planned:
+                self.index.update(*entry)
+            return False
+        
+        for file, kn, fileSize, lastAccess in planned:
+            
             self.fs.debug("Deleting file %s because it has kn=%s" % (
-							maxKnFile[0],
-							maxKn
+							file,
+							kn
 						),"repl")
             
-            self.fs.deleteFile(maxKnFile[0])
+            self.deleteFile(file)
         
+        return True
+    
+    
+    def downloadManifest(self, data):
+        '''
+        Writes the manifest of the file to fs.getLocalPath(file) after
+        downloading the chunks of the file missing from the chunk store
+        of the node. Returns False if there is no chunk store or if no
+        node could send them.
+        '''
         
-        downloaded = self.fs.downloadFile(data["file"],data["nodes"])
-
-        return downloaded
\ No newline at end of file
+        getLocalPath = getattr(self.fs, "getLocalPath", None)
+        root = self.fs.config.get("replicatorChunkStore")
+        
+        if not root or not getLocalPath:
+            return False
+        
+        if self.chunks is None:
+            self.chunks = chunk_store.ChunkStore(root)
+        
+        for node in data["nodes"]:
+            
+            host, port = node.split(":")
+            
+            try:
+                
+                received, reused = chunk_store.fetch(self.pool, host, int(port),
+                                                     data["file"], self.chunks,
+                                                     getLocalPath(data["file"]))
+                
+            except Exception,e:
+                
+                self.fs.error("Chunks of %s from %s : %s" % (data["file"], node, e))
+                continue
+            
+            self.fs.debug("File %s replicated from %s, %s bytes received, %s already stored" % (
+							data["file"], node, received, reused
+						),"repl")
+            
+            return True
+        
+        return False
+    
+    
+    def downloadDelta(self, data):
+        '''
+        Updates the old copy of the file at fs.getLocalPath(file) from
+        one of its "host:port" nodes, only fetching the blocks that
+        changed. Returns False if delta transfers are not enabled, if
+        there is no old copy or if no node could send the delta.
+        '''
+        
+        getLocalPath = getattr(self.fs, "getLocalPath", None)
+        
+        if not self.fs.config.get("replicatorDelta") or not getLocalPath:
+            return False
+        
+        localPath = getLocalPath(data["file"])
+        
+        if not os.path.exists(localPath):
+            return False
+        
+        blockSize = self.fs.config.get("replicatorBlockSize", delta.BLOCK_SIZE)
+        
+        for node in data["nodes"]:
+            
+            host, port = node.split(":")
+            
+            try:
+                
+                copied, received = delta.fetch(self.pool, host, int(port),
+                                               data["file"], localPath,
+                                               blockSize)
+                
+            except Exception,e:
+                
+                self.fs.error("Delta of %s from %s : %s" % (data["file"], node, e))
+                continue
+            
+            self.fs.debug("File %s updated from %s, %s bytes received, %s copied" % (
+							data["file"], node, received, copied
+						),"repl")
+            
+            return True
+        
+        return False
+    
+    
+    def downloadChunks(self, data):
+        '''
+        Downloads the file to fs.getLocalPath(file) by chunks of
+        fs.config["replicatorChunkSize"] bytes from all its "host:port"
+        nodes at once, resuming a download that was interrupted. Returns
+        False if the file fits in one chunk or if the download failed.
+        '''
+        
+        getLocalPath = getattr(self.fs, "getLocalPath", None)
+        chunkSize = self.fs.config.get("replicatorChunkSize", CHUNK_SIZE)
+        
+        if not getLocalPath or data["size"] <= chunkSize:
+            return False
+        
+        download = ChunkedDownload(self.pool, data["file"], data["nodes"],
+                                   getLocalPath(data["file"]), chunkSize,
+                                   self.fs.config.get("replicatorConnections", 2))
+        
+        try:
+            
+            received = download.run()
+            
+        except Exception,e:
+            
+            self.fs.error("Chunked download of %s : %s" % (data["file"], e))
+            return False
+        
+        self.fs.debug("File %s downloaded, bytes per node: %s" % (
+						data["file"], received
+					),"repl")
+        
+        return True
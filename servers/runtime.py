@@ -0,0 +1,183 @@
+"""Serving a WSGI application with bounded concurrency.
+
+The HTTP server runs every connection in a thread of a pool, so a slow
+client only holds its own thread. The requests doing file I/O are then
+admitted by Limiters, one for reads and one for writes: a large upload
+can't starve the reads, and past the limits requests wait a bounded
+time in a bounded queue before being rejected with 503, instead of
+piling up until the disk or the memory gives in. A read only holds
+its slot while it reads the disk, not while a slow client receives the
+blocks read.
+
+Request bodies are read from the socket as the handler writes them to
+disk, so a client sending faster than the disk is slowed down by TCP,
+and one sending slower than `timeout` is disconnected.
+"""
+
+import logging
+import threading
+import time
+
+from web import wsgiserver
+
+READ_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+
+class Overloaded(Exception):
+    pass
+
+
+class Limiter(object):
+    """ At most `limit` holders at once and `backlog` waiting ones """
+
+    def __init__(self, limit, backlog, timeout):
+        self.limit = limit
+        self.backlog = backlog
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, admit=True):
+        """Waits for a slot, raises Overloaded if the backlog is full or
+        no slot frees up within the timeout. A request already admitted,
+        e.g. a response being sent, waits as long as it takes instead"""
+        with self._cond:
+            if self.active < self.limit and not self.waiting:
+                self.active += 1
+                return
+            if admit and self.waiting >= self.backlog:
+                self.rejected += 1
+                raise Overloaded()
+            self.waiting += 1
+            deadline = time.time() + self.timeout
+            try:
+                while self.active >= self.limit:
+                    if not admit:
+                        self._cond.wait()
+                        continue
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        raise Overloaded()
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.active += 1
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+
+class LimitedApp(object):
+    """ WSGI middleware admitting the requests through Limiters """
+
+    def __init__(self, app, reads, writes, retry_after=1):
+        self.app = app
+        self.reads = reads
+        self.writes = writes
+        self.retry_after = retry_after
+
+    def __call__(self, environ, start_response):
+        if environ.get('REQUEST_METHOD') in READ_METHODS:
+            limiter = self.reads
+        else:
+            limiter = self.writes
+        try:
+            limiter.acquire()
+        except Overloaded:
+            start_response('503 Service Unavailable',
+                           [('Content-Type', 'plain/text'),
+                            ('Content-Length', '0'),
+                            ('Retry-After', str(self.retry_after))])
+            return []
+        try:
+            result = self.app(environ, start_response)
+        except:
+            limiter.release()
+            raise
+        if limiter is self.reads:
+            limiter.release()
+            return ReadResponse(result, limiter)
+        # A streamed response holds its slot until it's sent
+        return Response(result, limiter)
+
+
+class Response(object):
+    """ Response of an application, releasing its slot once closed """
+
+    def __init__(self, result, limiter):
+        self.result = result
+        self.limiter = limiter
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.result)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            close = getattr(self.result, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self.limiter.release()
+
+
+class ReadResponse(object):
+    """ Response of a read, holding a slot only while the next block is
+    read, not while it's sent to the client """
+
+    def __init__(self, result, limiter):
+        self.result = result
+        self.limiter = limiter
+
+    def __iter__(self):
+        blocks = iter(self.result)
+        while True:
+            self.limiter.acquire(admit=False)
+            try:
+                block = next(blocks)
+            except StopIteration:
+                return
+            finally:
+                self.limiter.release()
+            yield block
+
+    def close(self):
+        close = getattr(self.result, 'close', None)
+        if close is not None:
+            close()
+
+
+def make_server(app, address, threads=64, max_reads=32, max_writes=8,
+                backlog=256, queue_timeout=5.0, timeout=10):
+    """Returns the HTTP server of the WSGI application `app` on
+    `address`, a (host, port) tuple, with `threads` connections served
+    at once and the file I/O limited to `max_reads` reads and
+    `max_writes` writes, `backlog` requests waiting at most
+    `queue_timeout` seconds for them."""
+    reads = Limiter(max_reads, backlog, queue_timeout)
+    writes = Limiter(max_writes, backlog, queue_timeout)
+    server = wsgiserver.CherryPyWSGIServer(
+        address, LimitedApp(app, reads, writes), numthreads=threads,
+        max=threads, request_queue_size=backlog, timeout=timeout,
+        server_name=address[0])
+    server.reads = reads
+    server.writes = writes
+    return server
+
+
+def serve(app, address, **limits):
+    server = make_server(app, address, **limits)
+    logging.info('Serving on %s:%d with %d threads.', address[0], address[1],
+                 server.requests.min)
+    try:
+        server.start()
+    except (KeyboardInterrupt, SystemExit):
+        server.stop()
@@ -0,0 +1,81 @@
+"""Version vectors of the replicas of a file.
+
+A version vector maps the id of every writer of a file to the number of
+writes it made, and travels in the X-Version header as JSON. A replica
+is stale when its vector is dominated by the one of another replica;
+two vectors neither dominating the other are concurrent writes.
+
+The version of a file is stored next to it in a hidden sidecar file,
+which is never served itself.
+"""
+
+import json
+import os.path
+import re
+
+_SIDECAR = re.compile(r'^\..+\.version$')
+
+
+def parse(header):
+    """Returns the version vector of the X-Version header `header`, {} if
+    it's missing, raises ValueError if it's malformed"""
+    if not header:
+        return {}
+    vector = json.loads(header)
+    if not isinstance(vector, dict) or not all(
+            isinstance(n, (int, long)) and n >= 0 for n in vector.values()):
+        raise ValueError('Invalid version vector %r' % header)
+    return vector
+
+
+def sidecar(p):
+    """Returns the path of the file holding the version of the file `p`"""
+    directory, name = os.path.split(p)
+    return os.path.join(directory, '.%s.version' % name)
+
+
+def is_sidecar(p):
+    return bool(_SIDECAR.match(os.path.basename(p)))
+
+
+def dump(vector):
+    return json.dumps(vector, sort_keys=True, separators=(',', ':'))
+
+
+def descends(a, b):
+    """Tells if the version `a` includes all the writes of `b`"""
+    return all(a.get(writer, 0) >= n for writer, n in b.items())
+
+
+def follows(a, b):
+    """Tells if the version `a` is `b` plus exactly one write"""
+    return descends(a, b) and sum(a.values()) == sum(b.values()) + 1
+
+
+def increment(vector, writer):
+    """Returns the version following `vector` after a write of `writer`"""
+    vector = dict(vector)
+    vector[writer] = vector.get(writer, 0) + 1
+    return vector
+
+
+def newest(vectors):
+    """Returns the index of the version of `vectors` including all the
+    others, or of the one with the most writes if some are concurrent"""
+    best = 0
+    for i, vector in enumerate(vectors):
+        if descends(vector, vectors[best]) and vector != vectors[best]:
+            best = i
+        elif (not descends(vectors[best], vector) and
+              sum(vector.values()) > sum(vectors[best].values())):
+            best = i
+    return best
+
+
+def merge(vectors):
+    """Returns the version including all the writes of `vectors`"""
+    merged = {}
+    for vector in vectors:
+        for writer, n in vector.items():
+            merged[writer] = max(merged.get(writer, 0), n)
+    return merged